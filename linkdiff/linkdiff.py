@@ -2,18 +2,42 @@
 # By Travis Leithead
 # 2016/10/05
 
-from HTMLParser import HTMLParser
+from HTMLParser import HTMLParser, HTMLParseError
 import sys
 import platform
 import os.path
 import codecs
 import json
+import pickle
+import cPickle
+import hashlib
 import urllib
-#import time
+import urllib2
+import httplib
+import zlib
+import gzip
+import time
 import math
-from multiprocessing import Process, Pipe, Pool, Manager
+import random
+import subprocess
+import tempfile
+import shutil
+import threading
+import BaseHTTPServer
+from multiprocessing import Process, Pipe, Pool, Manager, Value
+from collections import namedtuple, Counter
 import re
 import multiprocessing
+from array import array
+from itertools import izip
+from StringIO import StringIO
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+try: # optional: only needed for the 'numpy' match engine (see -matchengine)
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
 
 # Subclass the parser to build the DOM described below. Since the
 # DOM will only be used for tracking links and what they link to, the
@@ -24,6 +48,11 @@ import multiprocessing
 # first traversal of markup tags) will let me build a linear representation
 # of the start tags that matter and put the text in the right logical
 # order for comparison.
+# The representation is kept compact: the text is coalesced into one string
+# (with the end offset of each run the parser reported), and the elements are
+# kept in a list along with their text offsets. The prev/next links of the
+# nodes are found from those arrays when asked for, and TextNodes are only
+# created then (see getNextNode and getPreviousNode).
 class LinkAndTextHTMLParser(HTMLParser):
     """Parses links and text from HTML"""
     def handle_starttag(self, tag, attrs):
@@ -53,8 +82,9 @@ class LinkAndTextHTMLParser(HTMLParser):
         self.handle_starttag(tag, attrs)
 
     def handle_data(self, data):
-        text = TextNode(data)
-        self._append_to_head(text)
+        self.textParts.append(data)
+        self.textLength += len(data)
+        self.doc.textRunEnds.append(self.textLength)
 
     def handle_entityref(self, name):
         self.handle_data("&"+name+";") #pass these through un-modified
@@ -63,31 +93,160 @@ class LinkAndTextHTMLParser(HTMLParser):
         self.handle_data("&#"+name+";")
 
     def _append_to_head(self, node):
-        if self.head == None:
-            self.head = node
-            self.doc.start = node
-        else: #Hook up the bidirectional links
-            self.head.next = node
-            node.prev = self.head
-            self.head = node
+        node.textOffset = self.textLength
+        node._doc = self.doc
+        node._elementIndex = len(self.doc.elements)
+        self.doc.elements.append(node)
+        self.doc.elementOffsets.append(self.textLength)
 
     def _append_to_map(self, key, node):
         if key not in self.doc._idMap:
             self.doc._idMap[key] = node
 
     def parse(self, markup):
+        return self.parseChunks([markup])
+
+    # Feeds the markup to the parser piece by piece as the chunks are produced (e.g., see readDocumentChunks),
+    # so that parsing can start before all the markup is available.
+    def parseChunks(self, chunks):
         self.doc = Document()
         self.linkCountIndex = 0
-        self.head = None
         self.droppedTagCount = 0
+        self.textParts = []
+        self.textLength = 0
         HTMLParser.reset(self) # among other things, resets the line numbering :-)
-        HTMLParser.feed(self, markup)
+        for chunk in chunks:
+            HTMLParser.feed(self, chunk)
         HTMLParser.close(self)
-        self.head = None
+        self.doc.text = ''.join(self.textParts)
+        self.textParts = None
+        tokenizeDocument(self.doc)
         doc = self.doc
         self.doc = None
         return doc
 
+# Regular expressions for FastScanHTMLParser. The first four are the same as HTMLParser's (2.7) own.
+FAST_SCAN_ENTITYREF = re.compile('&([a-zA-Z][-.a-zA-Z0-9]*)[^a-zA-Z0-9]')
+FAST_SCAN_CHARREF = re.compile('&#(?:[0-9]+|[xX][0-9a-fA-F]+)[^0-9a-fA-F]')
+FAST_SCAN_INCOMPLETE = re.compile('&[a-zA-Z#]')
+FAST_SCAN_STARTTAG_OPEN = re.compile('<[a-zA-Z]')
+# A strict subset of the start tags HTMLParser accepts (plain names, whitespace separated attributes, no '/' in
+# bare values), for which the tag name and whether an id attribute may be present can be read off directly.
+FAST_SCAN_STARTTAG = re.compile('<([a-zA-Z][a-zA-Z0-9]*)((?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'=<>`/]+))?)*)\s*/?>')
+FAST_SCAN_ENDTAG = re.compile('</[a-zA-Z][-.a-zA-Z0-9:_]*\s*>')
+FAST_SCAN_ID = re.compile('id', re.I)
+# The HTMLParser internals used by FastScanHTMLParser.goahead (the first two are set by HTMLParser.reset)
+FAST_SCAN_INTERNALS = ['interesting', 'cdata_elem', 'updatepos', 'parse_starttag', 'parse_endtag', 'parse_comment', 'parse_pi', 'parse_html_declaration']
+
+# Same as LinkAndTextHTMLParser (and produces the same Document), but scans the markup with its own loop
+# (a copy of HTMLParser.goahead) that skips over the common tags the DOM doesn't keep: start tags that are
+# not links and have no id, and end tags. Only those need no attribute parsing or callbacks; everything else
+# (links, ids, script/style, comments, unusual markup) is handed to HTMLParser's own methods.
+# goahead is copied from Python 2.7.18's HTMLParser.py, and relies on HTMLParser internals (see
+# FAST_SCAN_INTERNALS); getParser falls back to LinkAndTextHTMLParser when they are missing.
+class FastScanHTMLParser(LinkAndTextHTMLParser):
+    """Parses links and text from HTML, skipping uninteresting tags quickly"""
+    def goahead(self, end):
+        rawdata = self.rawdata
+        i = 0
+        n = len(rawdata)
+        while i < n:
+            match = self.interesting.search(rawdata, i) # < or &
+            if match:
+                j = match.start()
+            else:
+                if self.cdata_elem:
+                    break
+                j = n
+            if i < j: self.handle_data(rawdata[i:j])
+            i = self.updatepos(i, j)
+            if i == n: break
+            startswith = rawdata.startswith
+            if startswith('<', i):
+                if self.cdata_elem == None:
+                    match = FAST_SCAN_STARTTAG.match(rawdata, i)
+                    if match and match.group(1).lower() not in ('a', 'script', 'style') and not FAST_SCAN_ID.search(match.group(2)):
+                        self.doc.droppedTags += 1
+                        i = self.updatepos(i, match.end())
+                        continue
+                    match = FAST_SCAN_ENDTAG.match(rawdata, i)
+                    if match:
+                        i = self.updatepos(i, match.end())
+                        continue
+                if FAST_SCAN_STARTTAG_OPEN.match(rawdata, i): # < + letter
+                    k = self.parse_starttag(i)
+                elif startswith("</", i):
+                    k = self.parse_endtag(i)
+                elif startswith("<!--", i):
+                    k = self.parse_comment(i)
+                elif startswith("<?", i):
+                    k = self.parse_pi(i)
+                elif startswith("<!", i):
+                    k = self.parse_html_declaration(i)
+                elif (i + 1) < n:
+                    self.handle_data("<")
+                    k = i + 1
+                else:
+                    break
+                if k < 0:
+                    if not end:
+                        break
+                    k = rawdata.find('>', i + 1)
+                    if k < 0:
+                        k = rawdata.find('<', i + 1)
+                        if k < 0:
+                            k = i + 1
+                    else:
+                        k += 1
+                    self.handle_data(rawdata[i:k])
+                i = self.updatepos(i, k)
+            elif startswith("&#", i):
+                match = FAST_SCAN_CHARREF.match(rawdata, i)
+                if match:
+                    name = match.group()[2:-1]
+                    self.handle_charref(name)
+                    k = match.end()
+                    if not startswith(';', k-1):
+                        k = k - 1
+                    i = self.updatepos(i, k)
+                    continue
+                else:
+                    if ";" in rawdata[i:]: # bail by consuming '&#'
+                        self.handle_data(rawdata[i:i+2])
+                        i = self.updatepos(i, i+2)
+                    break
+            elif startswith('&', i):
+                match = FAST_SCAN_ENTITYREF.match(rawdata, i)
+                if match:
+                    name = match.group(1)
+                    self.handle_entityref(name)
+                    k = match.end()
+                    if not startswith(';', k-1):
+                        k = k - 1
+                    i = self.updatepos(i, k)
+                    continue
+                match = FAST_SCAN_INCOMPLETE.match(rawdata, i)
+                if match:
+                    # match.group() will contain at least 2 chars
+                    if end and match.group() == rawdata[i:]:
+                        self.error("EOF in middle of entity or char ref")
+                    # incomplete
+                    break
+                elif (i + 1) < n:
+                    # not the end of the buffer, and can't be confused
+                    # with some other construct
+                    self.handle_data("&")
+                    i = self.updatepos(i, i + 1)
+                else:
+                    break
+            else:
+                assert 0, "interesting.search() lied"
+        # end while
+        if end and i < n and not self.cdata_elem:
+            self.handle_data(rawdata[i:n])
+            i = self.updatepos(i, n)
+        self.rawdata = rawdata[i:]
+
 # Document produced by the Parser has the following IDL
 
 # interface Document {
@@ -95,6 +254,14 @@ class LinkAndTextHTMLParser(HTMLParser):
 #   readonly attribute Node start;
 #   TreeNode getElementById(str id);
 #   readonly attribute unsigned long droppedTags;
+#   readonly attribute Element[] elements; // all retained elements (including links), in order
+#   readonly attribute unsigned long[] elementOffsets; // the textOffset of each element
+#   readonly attribute str text; // all the text, coalesced
+#   readonly attribute unsigned long[] textRunEnds; // text offset where each TextNode ends
+#   readonly attribute str[] words; // the lowercased words of all the text, in order
+#   readonly attribute unsigned long[] wordStarts; // text offset of each word
+#   readonly attribute unsigned long[] wordEnds;
+#   readonly attribute unsigned long textLength;
 # };
 
 # interface Node {
@@ -109,6 +276,8 @@ class LinkAndTextHTMLParser(HTMLParser):
 # only nodes with an ID are retained by the parser.
 # interface Element : Node {
 #   readonly attribute str id; #reflects the id content attribute
+#   readonly attribute unsigned long textOffset; #length of all the text preceeding this element
+#   readonly attribute unsigned long wordOffset; #index of the first word ending after textOffset
 # };
 
 # interface LinkElement : Element {
@@ -132,14 +301,85 @@ class LinkAndTextHTMLParser(HTMLParser):
 #   "correct-external"
 # };
 
-class Document:
+class Document(object):
     def __init__(self):
         self.links = []
-        self.start = None
+        self.elements = []
+        self.elementOffsets = array('I')
+        self.text = u''
+        self.textRunEnds = array('I')
         self._idMap = {}
         self.droppedTags = 0
+        self._linkTargetMap = {} # href <-> target Element (or None), filled in by getLinkTargetElement
+        self.statsTargetLookups = 0
+        self.statsTargetCacheHits = 0
         #self.index #added during indexing! hash of "word" <-> [0:count, 1-n:link index]
-        #self.unIndexed #added during indexing! list of "words" too common to be useful in indexing.
+        #self.unIndexed #added during indexing! set of "words" too common to be useful in indexing.
+        #self.compactIndex #added during indexing! CompactIndex form of index/unIndexed and the links' words.
+        self.loadedFromCache = False
+
+    # called by pickle protocol (see saveCachedDocument) once the document is indexed. The elements, links
+    # and word stream go as flat arrays, the links' words are restored from the compact index, and index
+    # and unIndexed are not kept (only the compact index is used past indexing).
+    def __getstate__(self):
+        wordIds = {}
+        wordStream = [wordIds.setdefault(word, len(wordIds)) for word in self.words]
+        words = [None] * len(wordIds)
+        for word in wordIds:
+            words[wordIds[word]] = word
+        state = {'droppedTags': self.droppedTags, 'text': self.text, 'textLength': self.textLength, 'words': words, 'compactIndex': self.compactIndex,
+                 'elementIds': [elem.id for elem in self.elements], 'linkHrefs': [link.href for link in self.links]}
+        for name in ['statsWordsTooCommonCount', 'statsUniqueWordCount', 'statsAverageCountPerWord', 'statsCompactIndexBytes']:
+            state[name] = getattr(self, name)
+        state['wordStream'] = packArray(array(getArrayTypeCode(len(words)), wordStream))
+        state['wordStarts'] = packArray(self.wordStarts)
+        state['wordEnds'] = packArray(self.wordEnds)
+        state['textRunEnds'] = packArray(self.textRunEnds)
+        state['elementOffsets'] = packArray(self.elementOffsets)
+        state['elementWordOffsets'] = packArray(array('I', [elem.wordOffset for elem in self.elements]))
+        state['linkElementIndexes'] = packArray(array('I', [link._elementIndex for link in self.links]))
+        state['linkLineNos'] = packArray(array('I', [link.lineNo for link in self.links]))
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.loadedFromCache = True
+        for name in ['droppedTags', 'text', 'textLength', 'compactIndex', 'statsWordsTooCommonCount', 'statsUniqueWordCount', 'statsAverageCountPerWord', 'statsCompactIndexBytes']:
+            setattr(self, name, state[name])
+        words = state['words']
+        self.words = [words[wordId] for wordId in unpackArray(state['wordStream'])]
+        self.wordStarts = unpackArray(state['wordStarts'])
+        self.wordEnds = unpackArray(state['wordEnds'])
+        self.textRunEnds = unpackArray(state['textRunEnds'])
+        self.elementOffsets = unpackArray(state['elementOffsets'])
+        elementWordOffsets = unpackArray(state['elementWordOffsets'])
+        linkElementIndexes = unpackArray(state['linkElementIndexes'])
+        linkLineNos = unpackArray(state['linkLineNos'])
+        linkHrefs = state['linkHrefs']
+        vocabulary = self.compactIndex.getWords()
+        for elementIndex, elemId in enumerate(state['elementIds']):
+            linkIndex = len(self.links)
+            if linkIndex < len(linkElementIndexes) and linkElementIndexes[linkIndex] == elementIndex:
+                elem = LinkElement(linkIndex, linkHrefs[linkIndex], linkLineNos[linkIndex], elemId)
+                start, end = self.compactIndex.getLinkWordsRange(linkIndex)
+                elem.words = []
+                for n in xrange(start, end):
+                    elem.words.append(vocabulary[self.compactIndex.linkWordIds[n]])
+                    elem.words.append(self.compactIndex.linkWordCounts[n])
+                self.links.append(elem)
+            else:
+                elem = Element(elemId)
+            elem.textOffset = self.elementOffsets[elementIndex]
+            elem.wordOffset = elementWordOffsets[elementIndex]
+            elem._doc = self
+            elem._elementIndex = elementIndex
+            self.elements.append(elem)
+            if (not isinstance(elem, LinkElement) or elemId != "") and elemId not in self._idMap: # as the parser does
+                self._idMap[elemId] = elem
+
+    @property
+    def start(self):
+        return getNextNode(self, 0, 0)
 
     def getElementById(self, id):
         if id in self._idMap:
@@ -147,27 +387,79 @@ class Document:
         else:
             return None
 
-class Node():
-    def __init__(self):
-        self.prev = None
-        self.next = None
+    def getLinkTargetElement(self, href):
+        if href not in self._linkTargetMap:
+            self._linkTargetMap[href] = self.getElementById(getLinkTarget(href))
+        return self._linkTargetMap[href]
+
+# The first node at textOffset, from the element at elementIndex on (or None)
+def getNextNode(doc, elementIndex, textOffset):
+    if elementIndex < len(doc.elements) and doc.elementOffsets[elementIndex] == textOffset:
+        return doc.elements[elementIndex]
+    runIndex = bisect_right(doc.textRunEnds, textOffset)
+    if runIndex < len(doc.textRunEnds):
+        return TextNode(doc, runIndex)
+    return None
+
+# The last node at textOffset, before the element at elementIndex (or None)
+def getPreviousNode(doc, elementIndex, textOffset):
+    if elementIndex > 0 and doc.elementOffsets[elementIndex - 1] == textOffset:
+        return doc.elements[elementIndex - 1]
+    if textOffset > 0:
+        return TextNode(doc, bisect_left(doc.textRunEnds, textOffset))
+    return None
 
+class Node(object):
+    __slots__ = ()
+
+# A view of one run of the document's text (created as needed; equal views compare equal)
 class TextNode(Node):
-    def __init__(self, initialText):
-        Node.__init__(self)
-        self.textContent = initialText
+    __slots__ = ('_doc', '_runIndex')
+    def __init__(self, doc, runIndex):
+        self._doc = doc
+        self._runIndex = runIndex
+    def _getStart(self):
+        return self._doc.textRunEnds[self._runIndex - 1] if self._runIndex > 0 else 0
+    @property
+    def textContent(self):
+        return self._doc.text[self._getStart():self._doc.textRunEnds[self._runIndex]]
+    @property
+    def next(self):
+        end = self._doc.textRunEnds[self._runIndex]
+        return getNextNode(self._doc, bisect_left(self._doc.elementOffsets, end), end)
+    @property
+    def prev(self):
+        start = self._getStart()
+        return getPreviousNode(self._doc, bisect_right(self._doc.elementOffsets, start), start)
+    def __eq__(self, other):
+        return isinstance(other, TextNode) and other._doc is self._doc and other._runIndex == self._runIndex
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash((id(self._doc), self._runIndex))
     def __str__(self):
         return "text<"+self.textContent[:40]+ ( "..." if len(self.textContent) > 40 else "" ) + "> (len:"+str(len(self.textContent))+")"
 
 class Element(Node):
+    __slots__ = ('id', 'textOffset', 'wordOffset', '_cachedContextualText', '_doc', '_elementIndex')
     def __init__(self, elemId):
-        Node.__init__(self)
         self.id = elemId
+        self.textOffset = 0
+        self.wordOffset = 0
         self._cachedContextualText = None
+        self._doc = None # set by the parser, along with the index in doc.elements
+        self._elementIndex = -1
+    @property
+    def next(self):
+        return getNextNode(self._doc, self._elementIndex + 1, self.textOffset)
+    @property
+    def prev(self):
+        return getPreviousNode(self._doc, self._elementIndex, self.textOffset)
     def __str__(self):
         return '{ "id":"' + self.id.encode('ascii', 'xmlcharrefreplace') + '" }' #because attrs have their entites handled by the parser, and ascii output may not handle them.
 
 class LinkElement(Element):
+    __slots__ = ('index', 'href', 'lineNo', 'words', 'status', 'matchIndex', 'matchRatio', 'correctRatio')
     def __init__(self, index, href, lineNo, elemId):
         Element.__init__(self, elemId)
         self.index = index
@@ -179,29 +471,116 @@ class LinkElement(Element):
         self.matchRatio = 0.0
         self.correctRatio = 0.0
     def __str__(self): # called for str(link)
-        return '{"index":' + str(self.index) + ',"matchIndex":' + str(self.matchIndex) + ',"matchRatio":' + str(self.matchRatio)[:5] + ',"correctRatio":' + str(self.correctRatio)[:5] + ',"lineNo":' + str(self.lineNo) + ',"status":"' + self.status + '","href":"' + self.href.encode('ascii', 'xmlcharrefreplace') + '"' + (',"id":"' + self.id + '"' if self.id != '' else '') + '}'
-    def __getstate__(self): # called by pickle protocol (see when mem.baseAllLinks is set)
+        return LINK_JSON_FORMAT % (self.index, self.matchIndex, self.matchRatio, self.correctRatio, self.lineNo, self.status, getJSONString(self.href), ',"id":' + getJSONString(self.id) if self.id != '' else '')
+    def __getstate__(self): # called by pickle protocol (but see packLinkResults)
         return {'index': self.index, 'matchIndex': self.matchIndex, 'matchRatio': self.matchRatio, 'correctRatio': self.correctRatio, 'lineNo': self.lineNo, 'status': self.status, 'href': self.href, 'id': self.id}
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+# The links' results (what the report shows of them) as a few flat arrays and lists, which are much faster to
+# pass between processes than the links themselves (see when mem.baseAllLinks is set).
+def packLinkResults(links):
+    return {'matchIndexes': packArray(array('i', [link.matchIndex for link in links])),
+            'ratios': packArray(array('d', [ratio for link in links for ratio in (link.matchRatio, link.correctRatio)])),
+            'lineNos': packArray(array('I', [link.lineNo for link in links])),
+            'statuses': [link.status for link in links], 'hrefs': [link.href for link in links], 'ids': [link.id for link in links]}
+
+# Returns LinkElements (not part of any Document) with the packed results
+def unpackLinkResults(state):
+    matchIndexes = unpackArray(state['matchIndexes'])
+    ratios = unpackArray(state['ratios'])
+    lineNos = unpackArray(state['lineNos'])
+    statuses = state['statuses']
+    hrefs = state['hrefs']
+    ids = state['ids']
+    links = []
+    for index in xrange(len(matchIndexes)):
+        link = LinkElement(index, hrefs[index], lineNos[index], ids[index])
+        link.status = statuses[index]
+        link.matchIndex = matchIndexes[index]
+        link.matchRatio = ratios[2 * index]
+        link.correctRatio = ratios[2 * index + 1]
+        links.append(link)
+    return links
+
+LINK_JSON_FORMAT = '{"index":%d,"matchIndex":%d,"matchRatio":%.3f,"correctRatio":%.3f,"lineNo":%d,"status":"%s","href":%s%s}'
+JSON_UNSAFE_PATTERN = re.compile(r'["\\\x00-\x1f\x7f]')
+
+# A JSON string literal for the (href or id) text, kept ASCII as before (non-ASCII characters become character
+# references); quotes, backslashes and control characters are escaped (rare, so only then is json.dumps used).
+def getJSONString(text):
+    text = text.encode('ascii', 'xmlcharrefreplace')
+    if JSON_UNSAFE_PATTERN.search(text) == None:
+        return '"' + text + '"'
+    return json.dumps(text)
+
+# Splits the text of the document (all text nodes, in order) into the flat word stream, once. Each
+# distinct word is kept as one shared string. Then records the word offset of every element so
+# that the context words on either side of it are a slice of the stream.
+def tokenizeDocument(doc):
+    text = doc.text
+    canonicalWords = {}
+    doc.words = []
+    doc.wordStarts = array('I')
+    doc.wordEnds = array('I')
+    doc.textLength = len(text)
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group().lower()
+        doc.words.append(canonicalWords.setdefault(word, word))
+        doc.wordStarts.append(match.start())
+        doc.wordEnds.append(match.end())
+    wordsLen = len(doc.words)
+    wordIndex = 0
+    for elem in doc.elements:
+        while wordIndex < wordsLen and doc.wordEnds[wordIndex] <= elem.textOffset:
+            wordIndex += 1
+        elem.wordOffset = wordIndex
+
+WORD_PATTERN = re.compile('\\w+') # the complement of the '\\W+' used to split context text
+
+def getParser():
+    if PARSER == 'fastscan' and isFastScanSupported():
+        return FastScanHTMLParser()
+    return LinkAndTextHTMLParser()
+
+# True if this Python's HTMLParser has the internals FastScanHTMLParser depends on
+def isFastScanSupported():
+    parser = HTMLParser()
+    for name in FAST_SCAN_INTERNALS:
+        if not hasattr(parser, name):
+            return False
+    return True
 
 def parseTextToDocument(htmlText, statusText = None):
-    parser = LinkAndTextHTMLParser()
+    parser = getParser()
     if statusText != None:
         statusUpdate(statusText)
-    return parser.parse(htmlText)
+    with ProfilePhase('parse'):
+        return parser.parse(htmlText)
+
+def parseChunksToDocument(htmlChunks, statusText = None):
+    parser = getParser()
+    if statusText != None:
+        statusUpdate(statusText)
+    with ProfilePhase('parse'):
+        return parser.parseChunks(htmlChunks)
 
 # index is a hashtable of "name" <-> [n:matching link index, n+1:number of occurances of "name" at the matching index, ...]
+# Built in two passes: the first gathers each link's words and counts the number of links each word
+# appears in (its document frequency), which decides the too-common words up front; the second only
+# emits postings for the rest. So no postings are built and thrown away, and the result doesn't depend
+# on the order of the links.
 def buildIndex(doc, statusText = None):
     if statusText != None:
         statusUpdate(statusText)
-    doc.index = {}
-    doc.unIndexed = [] # because they're too common to be useful...
     tooCommonThreshold = len(doc.links)
     if len(doc.links) > 100:
         tooCommonThreshold = tooCommonThreshold / 3 #if more than 1/3 of all links have this word, then it's too common!
     # slice the text in the document up into words and attach (HALF_WORD_COUNT * 2) number of words to each link
-    for linkIndex in xrange(len(doc.links)):
-        link = doc.links[linkIndex]
-        wordsList = getDirectionalContextualWords(link, True) + getDirectionalContextualWords(link, False)
+    documentFrequency = {}
+    for link in doc.links:
+        wordsList = getDirectionalContextualWords(doc, link, True) + getDirectionalContextualWords(doc, link, False)
         # Group duplicate word entries in the wordsList so that each word has an occurence count
         uniqueWords = {}
         for word in wordsList:
@@ -209,22 +588,25 @@ def buildIndex(doc, statusText = None):
                 uniqueWords[word] += 1
             else:
                 uniqueWords[word] = 1
-        link.words = []           
+        # Assemble local saved words into a structure similar to the index: ['word', occurence count, ...]
+        link.words = [item for wordAndCount in uniqueWords.iteritems() for item in wordAndCount]
         for uniqueWord in uniqueWords:
-            # Assemble local saved words into a structure similar to the index: ['word', occurence count, ...]        
-            link.words.append(uniqueWord)
-            link.words.append(uniqueWords[uniqueWord])
-            # Build the index
-            if uniqueWord in doc.unIndexed:
+            documentFrequency[uniqueWord] = documentFrequency.get(uniqueWord, 0) + 1
+    unIndexed = doc.unIndexed = set([word for word in documentFrequency if documentFrequency[word] > tooCommonThreshold]) # because they're too common to be useful...
+    # Build the index
+    index = doc.index = {}
+    for linkIndex in xrange(len(doc.links)):
+        words = doc.links[linkIndex].words
+        for i in xrange(0, len(words), 2):
+            word = words[i]
+            if word in unIndexed:
                 continue # too common to be included.
-            if uniqueWord in doc.index:
-                doc.index[uniqueWord].append(linkIndex)
-                doc.index[uniqueWord].append(uniqueWords[uniqueWord])
-                if len(doc.index[uniqueWord]) / 2 > tooCommonThreshold:
-                    doc.unIndexed.append(uniqueWord)
-                    del doc.index[uniqueWord] # remove it from the index
+            postings = index.get(word)
+            if postings == None:
+                index[word] = [linkIndex, words[i+1]]
             else:
-                doc.index[uniqueWord] = [linkIndex, uniqueWords[uniqueWord]]
+                postings.append(linkIndex)
+                postings.append(words[i+1])
     doc.statsWordsTooCommonCount = len(doc.unIndexed)
     doc.statsUniqueWordCount = len(doc.index)
     ave = 0
@@ -234,29 +616,263 @@ def buildIndex(doc, statusText = None):
         doc.statsAverageCountPerWord = 0.0
     else:
         doc.statsAverageCountPerWord = ave / float(len(doc.index))
+    doc.compactIndex = CompactIndex(doc)
+    doc.statsCompactIndexBytes = doc.compactIndex.byteSize()
+
+# Compact form of a document's index (see buildIndex) used for matching and correctness checking. Words
+# are interned to integer ids, and the postings and each link's word list are held in flat array
+# buffers (CSR style) instead of lists of boxed ints and duplicated strings.
+#  * ids [0, indexedWordsLen) are the indexed words; the postings of word id n are the entries
+#    [postingOffsets[n], postingOffsets[n+1]) of postingLinks (link index) and postingCounts (occurences)
+#  * ids [indexedWordsLen, len(vocabulary)) are the words too common to be indexed
+#  * the word list of link n is the entries [linkOffsets[n], linkOffsets[n+1]) of linkWordIds and linkWordCounts
+class CompactIndex:
+    BUFFER_NAMES = ['postingOffsets', 'postingLinks', 'postingCounts', 'linkOffsets', 'linkWordIds', 'linkWordCounts']
+
+    def __init__(self, doc):
+        countTypeCode = getArrayTypeCode(HALF_WORD_COUNT * 2) # a word can't occur more often than there are context words
+        self.vocabulary = {}
+        self.postingOffsets = array('I', [0])
+        self.postingLinks = array(getArrayTypeCode(len(doc.links)))
+        self.postingCounts = array(countTypeCode)
+        for word in sorted(doc.index): # sorted, so that the ids don't depend on hashing/insertion order
+            self.vocabulary[word] = len(self.vocabulary)
+            postings = doc.index[word]
+            self.postingLinks.extend(postings[0::2])
+            self.postingCounts.extend(postings[1::2])
+            self.postingOffsets.append(len(self.postingLinks))
+        self.indexedWordsLen = len(self.vocabulary)
+        for word in sorted(doc.unIndexed):
+            self.vocabulary[word] = len(self.vocabulary)
+        self.linksLen = len(doc.links)
+        self.linkOffsets = array('I', [0])
+        self.linkWordIds = array(getArrayTypeCode(len(self.vocabulary)))
+        self.linkWordCounts = array(countTypeCode)
+        for link in doc.links:
+            self.linkWordIds.extend([self.vocabulary[word] for word in link.words[0::2]])
+            self.linkWordCounts.extend(link.words[1::2])
+            self.linkOffsets.append(len(self.linkWordIds))
+
+    # Returns the word's id, or -1 if the word isn't in this document's links' context words at all.
+    def getWordId(self, word):
+        return self.vocabulary.get(word, -1)
+
+    def isTooCommon(self, wordId):
+        return wordId >= self.indexedWordsLen
+
+    # Returns the (start, end) range of the postings of an indexed word id.
+    def getPostingsRange(self, wordId):
+        return (self.postingOffsets[wordId], self.postingOffsets[wordId + 1])
+
+    # Returns the (start, end) range of the link's entries in linkWordIds/linkWordCounts.
+    def getLinkWordsRange(self, linkIndex):
+        return (self.linkOffsets[linkIndex], self.linkOffsets[linkIndex + 1])
+
+    # Returns the word ids for the given list of words. Words not in the vocabulary get ids from (and
+    # added to) overflowVocabulary, so lists interned with the same overflowVocabulary are comparable.
+    def internWords(self, words, overflowVocabulary):
+        vocabulary = self.vocabulary
+        wordIds = []
+        for word in words:
+            wordId = vocabulary.get(word)
+            if wordId == None:
+                wordId = overflowVocabulary.get(word)
+                if wordId == None:
+                    wordId = len(vocabulary) + len(overflowVocabulary)
+                    overflowVocabulary[word] = wordId
+            wordIds.append(wordId)
+        return wordIds
+
+    # Returns the words in id order.
+    def getWords(self):
+        words = [None] * len(self.vocabulary)
+        for word in self.vocabulary:
+            words[self.vocabulary[word]] = word
+        return words
+
+    def byteSize(self):
+        size = sys.getsizeof(self.vocabulary)
+        for word in self.vocabulary:
+            size += sys.getsizeof(word)
+        for name in CompactIndex.BUFFER_NAMES:
+            buffer = getattr(self, name)
+            size += buffer.itemsize * len(buffer)
+        return size
+
+    def __getstate__(self): # called by pickle protocol; buffers go as raw bytes and the vocabulary as a list of words in id order
+        state = {'indexedWordsLen': self.indexedWordsLen, 'linksLen': self.linksLen, 'words': self.getWords()}
+        for name in CompactIndex.BUFFER_NAMES:
+            state[name] = packArray(getattr(self, name))
+        return state
+
+    def __setstate__(self, state):
+        self.indexedWordsLen = state['indexedWordsLen']
+        self.linksLen = state['linksLen']
+        words = state['words']
+        self.vocabulary = dict(izip(words, xrange(len(words))))
+        for name in CompactIndex.BUFFER_NAMES:
+            setattr(self, name, unpackArray(state[name]))
+
+# An array as a (typecode, raw bytes) pair, which pickles much smaller and faster than the array itself
+def packArray(buffer):
+    return (buffer.typecode, buffer.tostring())
+
+def unpackArray(packedBuffer):
+    typecode, bytes = packedBuffer
+    buffer = array(typecode)
+    buffer.fromstring(bytes)
+    return buffer
+
+# Returns the smallest unsigned array type code that can hold values up to maxValue.
+def getArrayTypeCode(maxValue):
+    if maxValue < 256:
+        return 'B'
+    if maxValue < 65536:
+        return 'H'
+    return 'I'
+
+# Pool initializer for the matching workers. The run config, progress counter and the other document's
+# (compact) index are handed to each worker exactly once here (inherited through the fork on POSIX)
+# rather than being pickled into (or fetched through the Manager for) every task. In batch mode (see
+# diffLinksBatchWithFilenames) the pool stays up for the following sources, whose index each worker
+# fetches once through the Manager when it gets its first task for that source (see useSourceIndex).
+def initMatchWorker(config, progress, mem, sourceNumber, otherIndex, otherIndexMatrices = None, busy = None):
+    global MATCH_PROGRESS
+    global MATCH_BUSY
+    global MATCH_MEM
+    global MATCH_SOURCE_NUMBER
+    global OTHER_INDEX
+    global OTHER_INDEX_MATRICES
+    setGlobals(config)
+    MATCH_PROGRESS = progress
+    MATCH_BUSY = busy
+    MATCH_MEM = mem
+    MATCH_SOURCE_NUMBER = sourceNumber
+    OTHER_INDEX = otherIndex
+    OTHER_INDEX_MATRICES = otherIndexMatrices
+
+def useSourceIndex(sourceNumber):
+    global MATCH_SOURCE_NUMBER
+    global OTHER_INDEX
+    global OTHER_INDEX_MATRICES
+    if sourceNumber == MATCH_SOURCE_NUMBER:
+        return
+    OTHER_INDEX = MATCH_MEM.srcIndex
+    OTHER_INDEX_MATRICES = buildIndexMatrices(OTHER_INDEX) if MATCH_ENGINE == 'numpy' else None
+    MATCH_SOURCE_NUMBER = sourceNumber
 
 # Process entry point
-# For a given list of words, find the matching (set of) index(es) in the provided index.
+# For a given list of words, find the matching (set of) index(es) in the index provided to the
+# worker by initMatchWorker.
 # Returns an array of candidates that meet the MATCH_RATIO_THRESHOLD bar (>=). Consisting of
 # tuples (ratio, associatedIndex, associatedIndex) in preferential order from most preferred (index 0) to
 # least preferred.
 def StartBuildMatchResult(tuple):
-    wordList, otherIndex, otherNonIndexed, otherLinksLen, wordListOriginIndex, renderProgress, mem = tuple
-    setGlobals(mem)
+    wordList, wordListOriginIndex, renderProgress = tuple
+    candidates = buildPrunedMatchResult(wordList, wordListOriginIndex)
+    if candidates == None:
+        candidates = buildExhaustiveMatchResult(wordList, wordListOriginIndex)
+    if renderProgress:
+        reportMatchProgress(1)
+    return candidates
+
+# Same result as buildExhaustiveMatchResult, but only does the work needed to find links that can meet
+# the threshold (MaxScore style): words are processed rarest-first, and once the remaining words can
+# no longer lift a not-yet-seen link over the threshold, no new links are admitted--only links already
+# seen keep accumulating. Only the admitted links are scanned for candidates. Returns None when the
+# threshold is zero (then every link is a candidate, and there is nothing to prune).
+def buildPrunedMatchResult(wordList, wordListOriginIndex):
+    otherIndex = OTHER_INDEX
+    vocabulary = otherIndex.vocabulary
+    indexedWordsLen = otherIndex.indexedWordsLen
+    postingOffsets = otherIndex.postingOffsets
+    possibleMatches = 0
+    queryWords = []
+    for i in xrange(0, len(wordList), 2):
+        wordId = vocabulary.get(wordList[i], -1)
+        if wordId >= indexedWordsLen:
+            continue # too common
+        possibleMatches += wordList[i+1]
+        if wordId != -1:
+            start = postingOffsets[wordId]
+            end = postingOffsets[wordId + 1]
+            queryWords.append((end - start, start, end, wordList[i+1]))
+    if possibleMatches == 0:
+        return [(0.0, -1, -1)]
+    matchValueThreshold = int(math.ceil(possibleMatches * MATCH_RATIO_THRESHOLD))
+    if matchValueThreshold == 0:
+        return None
+    queryWords.sort() # rarest first (the postings offset breaks ties so that the order is deterministic)
+    possibleMatches = float(possibleMatches)
+    scores, notAdmittedMax = accumulatePrunedScores(queryWords, matchValueThreshold)
+    candidates = [(scores[i]/possibleMatches, i, wordListOriginIndex) for i in sorted(scores) if scores[i] >= matchValueThreshold]
+    if len(candidates) > 0:
+        return candidates
+    highestMatchValueFound, bestMatchingIndex = getBestScore(scores)
+    if highestMatchValueFound <= notAdmittedMax:
+        # A link that was never admitted might beat (or tie with) the best one found. Query again,
+        # admitting every link that can still reach the best value found so far.
+        scores, notAdmittedMax = accumulatePrunedScores(queryWords, max(highestMatchValueFound, 1))
+        highestMatchValueFound, bestMatchingIndex = getBestScore(scores)
+    return [(highestMatchValueFound/possibleMatches, bestMatchingIndex, -1)]
+
+# Returns a tuple of the accumulated scores {linkIndex: matches} for the admitted links, and the most
+# any link that was not admitted could have (0 if all links were admitted). queryWords must be sorted
+# rarest-first.
+def accumulatePrunedScores(queryWords, minimumMatches):
+    postingLinks = OTHER_INDEX.postingLinks
+    postingCounts = OTHER_INDEX.postingCounts
+    remainingMatches = 0 # upper bound on what the words not yet processed can add to any link
+    for queryWord in queryWords:
+        remainingMatches += queryWord[3]
+    scores = {}
+    notAdmittedMax = 0
+    for postingsLen, start, end, wordCount in queryWords:
+        if remainingMatches >= minimumMatches:
+            for linkIndex, count in izip(postingLinks[start:end], postingCounts[start:end]):
+                scores[linkIndex] = scores.get(linkIndex, 0) + min(wordCount, count)
+        else:
+            if notAdmittedMax == 0:
+                notAdmittedMax = remainingMatches
+            for linkIndex, count in izip(postingLinks[start:end], postingCounts[start:end]):
+                if linkIndex in scores:
+                    scores[linkIndex] += min(wordCount, count)
+        remainingMatches -= wordCount
+    return (scores, notAdmittedMax)
+
+# Returns a tuple of the highest score and its link index (the first in document order on ties), or
+# (0, -1) if there are no non-zero scores.
+def getBestScore(scores):
+    highestMatchValueFound = 0
+    bestMatchingIndex = -1
+    for i in scores:
+        if scores[i] > highestMatchValueFound or (scores[i] == highestMatchValueFound and i < bestMatchingIndex):
+            highestMatchValueFound = scores[i]
+            bestMatchingIndex = i
+    return (highestMatchValueFound, bestMatchingIndex)
+
+# The reference implementation: accumulates every posting of every word, then scans all the links.
+def buildExhaustiveMatchResult(wordList, wordListOriginIndex):
+    otherIndex = OTHER_INDEX
+    postingLinks = otherIndex.postingLinks
+    postingCounts = otherIndex.postingCounts
+    otherLinksLen = otherIndex.linksLen
     possibleMatches = 0
     for i in xrange(1, len(wordList), 2): #sum the [initial] total number of possible matches (the count of all non-unique words in the list)
         possibleMatches += wordList[i]
     allLinks = [0] * otherLinksLen # creates an array initialized with zeros
     for i in xrange(0, len(wordList), 2):
         word = wordList[i]
-        if word in otherNonIndexed:  # skip and reduce the ratio threshold for any too-common words
+        wordId = otherIndex.getWordId(word)
+        if wordId == -1:
+            continue
+        if otherIndex.isTooCommon(wordId):  # skip and reduce the ratio threshold for any too-common words
             possibleMatches -= wordList[i+1] # change can be merged into this loop because each word is unique
             continue
-        if word in otherIndex:
-            linkIndexes = otherIndex[word]  # around 250 on average (could be much smaller or a lot bigger)
-            for n in xrange(0, len(linkIndexes), 2):
-                allLinks[ linkIndexes[n] ] += min(wordList[i+1], linkIndexes[n+1]) # when dups are involved, only select from what is available at each link
-                assert allLinks[linkIndexes[n]] <= possibleMatches, "There cannot be a value greater than possible matches (word: " + word + ", read: " + str(allLinks[linkIndexes[n]]) + ", max: " + str(possibleMatches) + ") wordlist: " + str(wordList)
+        start, end = otherIndex.getPostingsRange(wordId) # around 250 links on average (could be much smaller or a lot bigger)
+        for linkIndex, count in izip(postingLinks[start:end], postingCounts[start:end]):
+            allLinks[linkIndex] += min(wordList[i+1], count) # when dups are involved, only select from what is available at each link
+            assert allLinks[linkIndex] <= possibleMatches, "There cannot be a value greater than possible matches (word: " + word + ", read: " + str(allLinks[linkIndex]) + ", max: " + str(possibleMatches) + ") wordlist: " + str(wordList)
     if possibleMatches == 0:
         return [(0.0, -1, -1)]
     matchValueThreshold = int(math.ceil(possibleMatches * MATCH_RATIO_THRESHOLD))
@@ -278,14 +894,203 @@ def StartBuildMatchResult(tuple):
     if not candidacyAchieved:
         candidates.append((highestMatchValueFound/possibleMatches, bestMatchingIndex, -1))
     # candidates.sort(key=itemgetter(0),reverse=True) # sorts based on 0th item in each tuple (biggest value first)
-    if renderProgress:
-        progress = mem.progress
-        progress += 1
-        mem.progress = progress # potentially racy... might loose progress if multiple processes read/write the value while overlapping
-        statusUpdateInline("matching... " + str(progress) + "%")
     # Return the list of tuples (ratio, bestMatchingIndex)
     return candidates
 
+# Process entry point
+# Scores a contiguous chunk of baseline links with the selected match engine. Input tuple is a list of
+# word lists, the origin index of the first one, and the number of progress ticks (percent) this chunk
+# accounts for. Returns a list of candidate lists (see StartBuildMatchResult), one per word list.
+def StartBuildMatchResultChunk(tuple):
+    wordLists, firstOriginIndex, progressTicks, sourceNumber = tuple
+    startTime = time.time()
+    useSourceIndex(sourceNumber)
+    if MATCH_ENGINE == 'numpy':
+        results = buildMatchResultBatch(wordLists, firstOriginIndex)
+    else:
+        results = [StartBuildMatchResult((wordLists[i], firstOriginIndex + i, False)) for i in xrange(len(wordLists))]
+    if progressTicks > 0:
+        reportMatchProgress(progressTicks)
+    if MATCH_BUSY != None:
+        addPoolBusyTime(MATCH_BUSY, startTime)
+    return results
+
+def reportMatchProgress(ticks):
+    with MATCH_PROGRESS.get_lock():
+        MATCH_PROGRESS.value += ticks
+        progress = MATCH_PROGRESS.value
+    statusUpdateInline("matching... " + str(progress) + "%")
+
+# Incremental matching (see -incremental)
+# The match results of a baseline link only depend on its words, on the words of each source link and on which
+# words are too common in the source. So when the baseline and the source's too-common words are the same as in
+# the previous run, only the source links that changed (or are new) need to be scored against the baseline links;
+# the previous results for the others carry over. Conflict resolution and correctness checking are not incremental
+# (they are fast compared to matching), which keeps the report identical to a full run's.
+
+# Returns a digest of each link's (word, count) pairs, from a compact index
+def getLinkSignatures(compactIndex):
+    words = compactIndex.getWords()
+    signatures = []
+    for linkIndex in xrange(compactIndex.linksLen):
+        start, end = compactIndex.getLinkWordsRange(linkIndex)
+        pairs = sorted([(words[compactIndex.linkWordIds[n]], compactIndex.linkWordCounts[n]) for n in xrange(start, end)])
+        signatures.append(hashlib.md5(repr(pairs)).digest())
+    return signatures
+
+def getTooCommonWords(compactIndex):
+    return compactIndex.getWords()[compactIndex.indexedWordsLen:]
+
+def loadIncrementalState(path):
+    state = loadPickleFile(path)
+    if state == None or state.get('version') != INCREMENTAL_STATE_VERSION:
+        return None
+    return state
+
+# Saves what the next run needs to match incrementally: the baseline links' matches (before conflict resolution),
+# the signatures of the documents' links, and the settings and too-common words they depend on.
+def saveIncrementalState(path, baselineSignature, srcIndex, srcSignatures, rawMatches):
+    savePickleFile(path, {'version': INCREMENTAL_STATE_VERSION, 'ratio': MATCH_RATIO_THRESHOLD, 'halfWordCount': HALF_WORD_COUNT,
+                          'baselineSignature': baselineSignature, 'sourceSignatures': srcSignatures,
+                          'sourceTooCommonWords': getTooCommonWords(srcIndex), 'matches': rawMatches})
+
+# Returns the match results (see StartBuildMatchResult) of the baseline links (given by their word lists) derived
+# from the previous run's state, with None for the links that have to be matched again. Returns None if the state
+# can't be used (different settings, baseline or too-common words). The source links are aligned with the previous
+# run's by their signatures; those that didn't change keep their scores (only their index may have moved).
+def buildIncrementalMatchResults(wordLists, baselineSignature, srcIndex, srcSignatures, state):
+    if state['ratio'] != MATCH_RATIO_THRESHOLD or MATCH_RATIO_THRESHOLD == 0 or state['halfWordCount'] != HALF_WORD_COUNT:
+        return None
+    if state['baselineSignature'] != baselineSignature or state['sourceTooCommonWords'] != getTooCommonWords(srcIndex):
+        return None
+    previousToCurrent = {} # previous source link index <-> current index, for the links that didn't change
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, state['sourceSignatures'], srcSignatures, False).get_opcodes():
+        if tag == 'equal':
+            for n in xrange(i2 - i1):
+                previousToCurrent[i1 + n] = j1 + n
+    unchangedLinks = set(previousToCurrent.itervalues())
+    # a small index of the changed links only (without too-common words, as in buildPrunedMatchResult)
+    changedPostings = {}
+    for linkIndex in xrange(srcIndex.linksLen):
+        if linkIndex in unchangedLinks:
+            continue
+        start, end = srcIndex.getLinkWordsRange(linkIndex)
+        for n in xrange(start, end):
+            wordId = srcIndex.linkWordIds[n]
+            if not srcIndex.isTooCommon(wordId):
+                changedPostings.setdefault(wordId, []).append((linkIndex, srcIndex.linkWordCounts[n]))
+    results = []
+    for rowIndex, wordList in enumerate(wordLists):
+        previous = state['matches'][rowIndex]
+        possibleMatches = 0
+        scores = {}
+        for i in xrange(0, len(wordList), 2):
+            wordId = srcIndex.getWordId(wordList[i])
+            if wordId != -1 and srcIndex.isTooCommon(wordId):
+                continue
+            possibleMatches += wordList[i+1]
+            for linkIndex, count in changedPostings.get(wordId, ()):
+                scores[linkIndex] = scores.get(linkIndex, 0) + min(wordList[i+1], count)
+        if possibleMatches == 0:
+            results.append(previous) # [(0.0, -1, -1)], as before
+            continue
+        matchValueThreshold = int(math.ceil(possibleMatches * MATCH_RATIO_THRESHOLD))
+        possibleMatches = float(possibleMatches)
+        candidates = [(scores[i]/possibleMatches, i, rowIndex) for i in scores if scores[i] >= matchValueThreshold]
+        if previous[0][2] != -1: # the unchanged candidates carry over
+            candidates += [(ratio, previousToCurrent[i], rowIndex) for ratio, i, originIndex in previous if i in previousToCurrent]
+        if len(candidates) > 0:
+            candidates.sort(key=lambda candidate: candidate[1])
+            results.append(candidates)
+            continue
+        highestRatio, bestIndex, originIndex = previous[0] if previous[0][2] == -1 else (0.0, -1, -1)
+        if previous[0][2] != -1 or (bestIndex != -1 and bestIndex not in previousToCurrent):
+            results.append(None) # the best (non-)match could now be any link
+            continue
+        bestIndex = previousToCurrent.get(bestIndex, -1)
+        for i in scores: # the previous best, unless a changed link beats it (or ties with it from an earlier position)
+            ratio = scores[i]/possibleMatches
+            if ratio > highestRatio or (ratio == highestRatio and i < bestIndex):
+                highestRatio = ratio
+                bestIndex = i
+        results.append([(highestRatio, bestIndex, -1)])
+    return results
+
+# 'numpy' match engine
+# --------------------
+# Scores a batch of word lists at once against sparse term-count matrices of the other document,
+# producing exactly the same candidate tuples as StartBuildMatchResult (which remains the reference
+# implementation). The min-overlap of two word counts is accumulated as a sum of "levels":
+# min(a, b) == sum over k >= 1 of (a >= k) * (b >= k), so each level is a plain sparse product of
+# 0/1 matrices.
+
+# Returns a list of level matrices (one for each possible occurence count, 1-based) shaped
+# [indexed words x links] built from the postings buffers of the provided CompactIndex.
+def buildIndexMatrices(compactIndex):
+    linkIndexes = numpy.frombuffer(compactIndex.postingLinks, dtype=compactIndex.postingLinks.typecode).astype(numpy.int32)
+    counts = numpy.frombuffer(compactIndex.postingCounts, dtype=compactIndex.postingCounts.typecode).astype(numpy.int32)
+    wordIds = numpy.repeat(numpy.arange(compactIndex.indexedWordsLen, dtype=numpy.int32), numpy.diff(numpy.frombuffer(compactIndex.postingOffsets, dtype=compactIndex.postingOffsets.typecode)))
+    levels = []
+    for level in xrange(1, (counts.max() if len(counts) > 0 else 0) + 1):
+        mask = counts >= level
+        levels.append(scipy.sparse.csr_matrix((numpy.ones(mask.sum(), dtype=numpy.int32), (wordIds[mask], linkIndexes[mask])), shape=(compactIndex.indexedWordsLen, compactIndex.linksLen)))
+    return levels
+
+# Scores a list of word lists whose origin indexes start at firstOriginIndex. Returns a list of
+# candidate lists (see StartBuildMatchResult).
+def buildMatchResultBatch(wordLists, firstOriginIndex):
+    levels = OTHER_INDEX_MATRICES
+    vocabulary = OTHER_INDEX.vocabulary
+    indexedWordsLen = OTHER_INDEX.indexedWordsLen
+    otherLinksLen = OTHER_INDEX.linksLen
+    possibleMatchesList = []
+    rows = []
+    wordIds = []
+    counts = []
+    for row in xrange(len(wordLists)):
+        wordList = wordLists[row]
+        possibleMatches = 0
+        for i in xrange(0, len(wordList), 2):
+            wordId = vocabulary.get(wordList[i], -1)
+            if wordId >= indexedWordsLen:
+                continue # too common
+            possibleMatches += wordList[i+1]
+            if wordId != -1:
+                rows.append(row)
+                wordIds.append(wordId)
+                counts.append(wordList[i+1])
+        possibleMatchesList.append(possibleMatches)
+    rows = numpy.array(rows, dtype=numpy.int32)
+    wordIds = numpy.array(wordIds, dtype=numpy.int32)
+    counts = numpy.array(counts, dtype=numpy.int32)
+    scores = numpy.zeros((len(wordLists), otherLinksLen), dtype=numpy.int32)
+    for level in xrange(1, min(len(levels), counts.max() if len(counts) > 0 else 0) + 1):
+        mask = counts >= level
+        queryLevel = scipy.sparse.csr_matrix((numpy.ones(mask.sum(), dtype=numpy.int32), (rows[mask], wordIds[mask])), shape=(len(wordLists), indexedWordsLen))
+        scores += (queryLevel * levels[level - 1]).toarray()
+    results = []
+    for row in xrange(len(wordLists)):
+        results.append(selectMatchCandidates(scores[row], possibleMatchesList[row], firstOriginIndex + row))
+    return results
+
+# Array thresholding equivalent of the candidate selection loop at the end of StartBuildMatchResult
+def selectMatchCandidates(allLinks, possibleMatches, wordListOriginIndex):
+    if possibleMatches == 0:
+        return [(0.0, -1, -1)]
+    matchValueThreshold = int(math.ceil(possibleMatches * MATCH_RATIO_THRESHOLD))
+    possibleMatches = float(possibleMatches)
+    if matchValueThreshold > 0:
+        candidateIndexes = numpy.flatnonzero(allLinks >= matchValueThreshold)
+    else: # with a zero threshold, every link after the first non-zero one qualifies
+        nonZero = numpy.flatnonzero(allLinks)
+        candidateIndexes = numpy.arange(nonZero[0], len(allLinks)) if len(nonZero) > 0 else nonZero
+    if len(candidateIndexes) > 0:
+        return [(numMatches/possibleMatches, i, wordListOriginIndex) for i, numMatches in zip(candidateIndexes.tolist(), allLinks[candidateIndexes].tolist())]
+    if len(allLinks) == 0 or allLinks.max() == 0:
+        return [(0.0, -1, -1)]
+    bestMatchingIndex = int(allLinks.argmax()) # first of the highest values, like the loop
+    return [(int(allLinks[bestMatchingIndex])/possibleMatches, bestMatchingIndex, -1)]
+
 # Performs the following: 1) in-place modifies the provided matchResultsArray to contain the result
 # set for the "own" links collection, (resolved hits and misses combined and in the cannonical order
 # AND 2) returns a sparce list for "near-matches" (the links potentially matching--with qualifying
@@ -295,45 +1100,53 @@ def StartBuildMatchResult(tuple):
 # (matched and "near-matched" are handled here) which will have a 0.0 ratio--which is probably not
 # true. To get the best-match ratio for these unmatched links, the StartBuildMatchResult algorithm
 # must be run for each of them (with no expected "new" matches--just refined un-matched best-case
-# ratios).
-def resolveMatchResultConflicts(matchResultsArray):
+# ratios). See applyUnmatchedRatios (-unmatchedratios).
+# The row/col buckets (of ResolverLine) may be supplied pre-filled (see bucketMatchResultRows), which
+# lets the caller bucket results while they are still streaming in from the matching workers.
+# Given a pool p (of matching workers, see initMatchWorker), conflicts are resolved on it when there are enough of
+# them, and dense enough, to be worth sending to the workers (see resolveConflictComponents); busy is the pool's
+# busy time counter when profiling.
+def resolveMatchResultConflicts(matchResultsArray, rowResults = None, colResults = None, over50Count = 0, p = None, busy = None):
     # These two maps are used for eliminating match combinations w/out affecting the original array
-    rowResults = {}
-    colResults = {}
     matchResultsArrayLen = len(matchResultsArray)
-    over50Count = 0 # Match resolving can be expensive. If a row has over 50 matches, that's a sure sign of potential slowness for the whole algorithm.
-    statusUpdate('\nResolving match conflicts...(this may take a few minutes)')
-    for i in xrange(matchResultsArrayLen):
-        if matchResultsArray[i][0][2] == -1:
-            matchResultsArray[i] = matchResultsArray[i][0]
-        else:
-            rowResults[i] = matchResultsArray[i]
-            if len(matchResultsArray[i]) >= 50:
-                over50Count += 1
-            for matchTuple in matchResultsArray[i]:
-                if matchTuple[1] not in colResults:
-                    colResults[matchTuple[1]] = []
-                colResults[matchTuple[1]].append(matchTuple)
+    if rowResults == None:
+        rowResults = {}
+        colResults = {}
+        over50Count = bucketMatchResultRows(matchResultsArray, 0, matchResultsArrayLen, rowResults, colResults)
+    statusUpdate('\nResolving match conflicts...')
     if matchResultsArrayLen > 1000 and over50Count > (matchResultsArrayLen / 10): # show this at >10% of all links
         statusUpdate('**Note** ' + str(int(float(over50Count) / matchResultsArrayLen * 100)) + '% of all links have more than 50 match conflicts each.')
         statusUpdate('  Consider increasing the match ratio to reduce match conflicts (via the -ratio command line flag).')
-    onePercent = matchResultsArrayLen / 100 if matchResultsArrayLen > 1000 else matchResultsArrayLen + 1
-    i = 0
+    if p != None and CPU_COUNT > 1 and isWorthResolvingInParallel(colResults):
+        return resolveConflictComponents(matchResultsArray, rowResults, colResults, p, busy)
+    resolveConflictRows(sorted(rowResults.keys()), rowResults, colResults, matchResultsArray, True)
+    return getNearMatches(colResults)
+
+# Resolves the rows (in ascending order) of rowResults, putting their results in finalMatchArray (a list, or a
+# dict for a subset of the rows).
+def resolveConflictRows(rowIndexes, rowResults, colResults, finalMatchArray, showProgress = False):
+    rowIndexesLen = len(rowIndexes)
+    onePercent = rowIndexesLen / 100 if rowIndexesLen > 1000 else rowIndexesLen + 1
+    n = 0
     count = 0
     percent = 0
-    while i < matchResultsArrayLen:
+    while n < rowIndexesLen:
+        i = rowIndexes[n]
         if not i in rowResults: # Resolved in a previous iteration--move along without trying to resolve
-            i += 1
+            n += 1
             continue
         # resolveMatchRow may not resolve the row it's on, but it is guaranteed to resolve one row somewhere.
-        if resolveMatchRow(i, rowResults, colResults, matchResultsArray):
-            i += 1 # resolved the row it was on. Move to next row.
+        if resolveMatchRow(i, rowResults, colResults, finalMatchArray):
+            n += 1 # resolved the row it was on. Move to next row.
         count += 1 # spent time resolving a row.
-        if count % onePercent + 1 == onePercent:
+        if showProgress and count % onePercent + 1 == onePercent:
             percent += 1
             statusUpdateInline("resolving... " + str(percent) + "%")
+
+# Returns the "near-matches" (in column order) of the columns left after resolving
+def getNearMatches(colResults):
     otherNearMatches = [] # fill-in for "near-matches" where no match was found in a column despite there being options for a potential match.
-    for colIndex in colResults.keys():
+    for colIndex in sorted(colResults.keys()):
         # find local maxiumum ratio among remaining options
         biggestRatio = -0.1
         biggestRowIndex = -1
@@ -344,26 +1157,225 @@ def resolveMatchResultConflicts(matchResultsArray):
         otherNearMatches.append((biggestRatio, colIndex, biggestRowIndex))
     return otherNearMatches
 
+# Parallel conflict resolution
+# Resolving a row only ever involves the rows it shares a column with, and theirs, and so on: the connected
+# component of the row in the graph of candidate tuples. And the rows of a component are resolved in the same
+# (ascending) order whether or not the other components are resolved in between. So the components are
+# resolved independently on the pool's workers, in tasks of at least RESOLVE_TASK_TUPLES candidate tuples (the
+# small components are grouped together), and the results merged back are identical to resolving serially.
+# Most rows usually share no column with another row, and resolving one of those is cheaper than sending it to
+# a worker: they are resolved by the caller, while the workers resolve the rest. If the rest doesn't make at
+# least two tasks (such as when it is one big component), there is nothing to split, and all rows are resolved
+# serially.
+def resolveConflictComponents(matchResultsArray, rowResults, colResults, p, busy = None, taskTuples = None):
+    if taskTuples == None:
+        taskTuples = RESOLVE_TASK_TUPLES
+    taskRows = [[]]
+    tupleCount = 0
+    for component in getConflictComponents(colResults):
+        if tupleCount >= taskTuples:
+            taskRows.append([])
+            tupleCount = 0
+        taskRows[-1] += component
+        tupleCount += sum([len(rowResults[rowIndex]) for rowIndex in component])
+    if len(taskRows) < 2:
+        resolveConflictRows(sorted(rowResults.keys()), rowResults, colResults, matchResultsArray, True)
+        return getNearMatches(colResults)
+    statusUpdate('Resolving ' + str(len(taskRows)) + ' independent sets of match conflicts in parallel...')
+    tasks = []
+    for rows in taskRows: # handed over to the workers: what is left in rowResults and colResults is resolved here
+        tasks.append([])
+        for rowIndex in rows:
+            candidates = list(rowResults.pop(rowIndex))
+            for tuple in candidates:
+                colResults.pop(tuple[1], None)
+            tasks[-1].append((rowIndex, candidates))
+    startTime = time.time()
+    if busy != None:
+        busy.value = 0.0
+    results = p.imap(StartResolveConflictRows, tasks)
+    resolveConflictRows(sorted(rowResults.keys()), rowResults, colResults, matchResultsArray)
+    otherNearMatches = getNearMatches(colResults)
+    for resolvedRows, nearMatches in results:
+        for rowIndex, tuple in resolvedRows:
+            matchResultsArray[rowIndex] = tuple
+        otherNearMatches += nearMatches
+    if busy != None:
+        recordPoolUse('resolve', CPU_COUNT, len(tasks), startTime, busy)
+    otherNearMatches.sort(key=lambda tuple: tuple[1])
+    return otherNearMatches
+
+# True if there are enough candidate tuples in conflict (in the columns that more than one row has a candidate
+# in), and enough of them per row, for resolving them in parallel to pay for handing the rows to the workers.
+def isWorthResolvingInParallel(colResults):
+    conflictCols = [col for col in colResults.itervalues() if len(col) > 1]
+    tupleCount = sum([len(col) for col in conflictCols])
+    if tupleCount < RESOLVE_PARALLEL_MIN_TUPLES:
+        return False
+    rows = set()
+    for col in conflictCols:
+        rows.update([tuple[2] for tuple in col])
+    return tupleCount >= RESOLVE_PARALLEL_MIN_ROW_TUPLES * len(rows)
+
+# Returns the rows of each connected component of the candidate tuples (rows linked by the columns they share)
+# that has more than one row, as lists of ascending row indexes, in the order of their first rows. Uses
+# union-find over the rows of the columns that more than one row has a candidate in.
+def getConflictComponents(colResults):
+    parents = {}
+    rows = set()
+    for col in colResults.itervalues():
+        if len(col) < 2:
+            continue
+        root = None
+        for tuple in col:
+            rows.add(tuple[2])
+            rowRoot = findConflictRoot(parents, tuple[2])
+            if root == None:
+                root = rowRoot
+            elif rowRoot != root:
+                if rowRoot < root: # the smallest row is the root
+                    root, rowRoot = rowRoot, root
+                parents[rowRoot] = root
+    components = {} # root <-> rows
+    for rowIndex in sorted(rows):
+        components.setdefault(findConflictRoot(parents, rowIndex), []).append(rowIndex)
+    return [components[root] for root in sorted(components.keys())]
+
+def findConflictRoot(parents, rowIndex):
+    root = rowIndex
+    while root in parents:
+        root = parents[root]
+    while rowIndex != root: # path compression
+        parents[rowIndex], rowIndex = root, parents[rowIndex]
+    return root
+
+# Process entry point
+# Resolves the rows of some whole conflict components (see getConflictComponents), given as a list of (row index,
+# candidate tuples) in ascending row order. Returns a tuple of the [(row index, resolved tuple)] and the near-matches.
+def StartResolveConflictRows(rows):
+    startTime = time.time()
+    rowResults = {}
+    colResults = {}
+    for rowIndex, candidates in rows:
+        bucketRow(rowIndex, candidates, rowResults, colResults)
+    resolvedRows = {}
+    resolveConflictRows([rowIndex for rowIndex, candidates in rows], rowResults, colResults, resolvedRows)
+    if MATCH_BUSY != None:
+        addPoolBusyTime(MATCH_BUSY, startTime)
+    return (resolvedRows.items(), getNearMatches(colResults))
+
+# A row (keyIndex 1: its tuples are keyed by their column) or column (keyIndex 2: keyed by their row) of match
+# tuples being resolved, in their original order. Removing a tuple is O(1): it leaves a None behind in tuples (the
+# list is compacted once most of it is None), and positions maps the key of each remaining tuple to its place.
+# The tuples are also kept by decreasing ratio (ties in their original order) once getRanked is first called.
+class ResolverLine(object):
+    __slots__ = ['tuples', 'positions', 'keyIndex', 'ranked']
+
+    def __init__(self, keyIndex, tuples = ()):
+        self.tuples = list(tuples)
+        self.positions = {}
+        for i in xrange(len(tuples)):
+            self.positions[tuples[i][keyIndex]] = i
+        self.keyIndex = keyIndex
+        self.ranked = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        for tuple in self.tuples:
+            if tuple != None:
+                yield tuple
+
+    def __contains__(self, tuple):
+        return tuple[self.keyIndex] in self.positions
+
+    def first(self):
+        for tuple in self.tuples:
+            if tuple != None:
+                return tuple
+
+    def append(self, tuple):
+        self.positions[tuple[self.keyIndex]] = len(self.tuples)
+        self.tuples.append(tuple)
+        self.ranked = None
+
+    def remove(self, tuple):
+        self.tuples[self.positions.pop(tuple[self.keyIndex])] = None
+        if len(self.tuples) > 2 * len(self.positions) + 8:
+            self.__init__(self.keyIndex, [tuple for tuple in self.tuples if tuple != None])
+
+    # The tuples by decreasing ratio. Removed tuples are not taken out: check them with 'in'.
+    def getRanked(self):
+        if self.ranked == None:
+            self.ranked = sorted([tuple for tuple in self.tuples if tuple != None], key=lambda tuple: -tuple[0])
+        return self.ranked
+
+    # The first of the tuples with the biggest ratio
+    def getBiggest(self):
+        for tuple in self.getRanked():
+            if tuple in self:
+                return tuple
+
+# Buckets the candidates of rows [startRow, endRow) into the row/col maps (of ResolverLine) used by
+# resolveMatchResultConflicts. Rows must be bucketed in ascending order (the cols are expected to be in row
+# order). Rows without a qualifying match are in-place replaced with their single best (non-)match tuple.
+# Returns the number of bucketed rows with 50 or more candidates.
+def bucketMatchResultRows(matchResultsArray, startRow, endRow, rowResults, colResults):
+    over50Count = 0 # Match resolving can be expensive. If a row has over 50 matches, that's a sure sign of potential slowness for the whole algorithm.
+    for i in xrange(startRow, endRow):
+        if matchResultsArray[i][0][2] == -1:
+            matchResultsArray[i] = matchResultsArray[i][0]
+        else:
+            bucketRow(i, matchResultsArray[i], rowResults, colResults)
+            if len(matchResultsArray[i]) >= 50:
+                over50Count += 1
+    return over50Count
+
+def bucketRow(rowIndex, candidates, rowResults, colResults):
+    rowResults[rowIndex] = ResolverLine(1, candidates)
+    for matchTuple in candidates:
+        if matchTuple[1] not in colResults:
+            colResults[matchTuple[1]] = ResolverLine(2)
+        colResults[matchTuple[1]].append(matchTuple)
+
+# Buckets the rows from nextRow on that have their match results, up to the first one that doesn't yet. Before
+# that, a copy of each row's results is put in rawMatches (unless None), as bucketing and resolving change them.
+# Returns a tuple of the next row to bucket and the number of bucketed rows with 50 or more candidates.
+def bucketReadyMatchResultRows(matchResultsArray, nextRow, rowResults, colResults, rawMatches):
+    endRow = nextRow
+    while endRow < len(matchResultsArray) and matchResultsArray[endRow] != None:
+        if rawMatches != None:
+            rawMatches[endRow] = list(matchResultsArray[endRow])
+        endRow += 1
+    return (endRow, bucketMatchResultRows(matchResultsArray, nextRow, endRow, rowResults, colResults))
+
 # Returns true if the designated row was resolved; false if some other row was resolved.
 # in-place modifies both rowDict and colDict when a match occurs, both the related row/col dictionary
 # entry are removed; for rowDict this helps with later skipping an already-resolved row when iterating
 # the rowIndexes; for colDict this excludes columns from being considered for "near matches" after
 # all rows have been resolved.
 def resolveMatchRow(rowIndex, rowDict, colDict, finalMatchArray):
-    rowLen = len(rowDict[rowIndex])
+    row = rowDict[rowIndex]
+    rowLen = len(row)
     assert rowLen != 0, 'If there is a row, it must have more than zero elements...'
     colConstrained = False
     rowConstrained = False
     if rowLen == 1:
-        colIndex = rowDict[rowIndex][0][1]
+        colIndex = row.first()[1]
         colLen = len(colDict[colIndex])
-        assert len(colDict[colIndex]) > 0, "I don't think this array should ever be empty, if I do maintenance right"
+        assert colLen > 0, "I don't think this array should ever be empty, if I do maintenance right"
+        if colLen == 1: # the most common case: the only match of each other
+            finalMatchArray[rowIndex] = row.first()
+            del colDict[colIndex]
+            del rowDict[rowIndex]
+            return True
         for tuple in colDict[colIndex]:
             if len(rowDict[tuple[2]]) > 1:
                 break
         else:
             colConstrained = True
-    for tuple in rowDict[rowIndex]:
+    for tuple in row:
         assert len(colDict[tuple[1]]) > 0, "I don't think this array should ever be empty, if I do maintenance right"
         if len(colDict[tuple[1]]) > 1:
             break
@@ -372,68 +1384,69 @@ def resolveMatchRow(rowIndex, rowDict, colDict, finalMatchArray):
     if not rowConstrained and not colConstrained:
         return resolveNonConstrainedMatches(rowIndex, rowDict, colDict, finalMatchArray)
     elif rowConstrained and colConstrained:
-        finalMatchArray[rowIndex] = rowDict[rowIndex][0]
+        finalMatchArray[rowIndex] = row.first()
         # Remove the colDict entry so that it is not checked later when gathering otherNearMatches
-        del colDict[rowDict[rowIndex][0][1]]
+        del colDict[finalMatchArray[rowIndex][1]]
         del rowDict[rowIndex]
         return True
     elif rowConstrained:
-        biggestRatio = rowDict[rowIndex][0][0]
-        biggestIndex = 0
-        for i in xrange(1, len(rowDict[rowIndex])):
-            if rowDict[rowIndex][i][0] > biggestRatio:
-                biggestRatio = rowDict[rowIndex][i][0]
-                biggestIndex = i
-        finalMatchArray[rowIndex] = rowDict[rowIndex][biggestIndex]
-        del colDict[ rowDict[rowIndex][biggestIndex][1] ]
+        biggest = row.getBiggest()
+        finalMatchArray[rowIndex] = biggest
+        del colDict[biggest[1]]
         del rowDict[rowIndex]
         return True
     else:
-        colIndex = rowDict[rowIndex][0][1]
-        biggestRatio = colDict[colIndex][0][0]
-        biggestIndex = 0
-        for i in xrange(1, len(colDict[colIndex])):
-            if colDict[colIndex][i][0] > biggestRatio:
-                biggestRatio = colDict[colIndex][i][0]
-                biggestIndex = i
-        for i in xrange(len(colDict[colIndex])):
-            rovingColumnTuple = colDict[colIndex][i]
-            rovingRowIndex = rovingColumnTuple[2]
-            finalMatchArray[rovingRowIndex] = (rovingColumnTuple[0], rovingColumnTuple[1], rovingColumnTuple[2] if i == biggestIndex else -1)
+        col = colDict[colIndex]
+        biggestRowIndex = col.getBiggest()[2]
+        for tuple in col:
+            rovingRowIndex = tuple[2]
+            finalMatchArray[rovingRowIndex] = (tuple[0], tuple[1], rovingRowIndex if rovingRowIndex == biggestRowIndex else -1)
             del rowDict[rovingRowIndex]
         del colDict[colIndex]
-        return rowIndex == biggestIndex
+        return True
 
+# Finds the best match among the rows sharing a column with the anchor row, and resolves it. Only a row with a
+# tuple in one of the anchor's columns with at least the anchor's best ratio can take part in the best match, so
+# only those rows are visited (found from the top of the columns' rankings, see getRanked), in the order a scan of
+# the anchor's columns (each in row order) would come across them, as that decides the best ratio each row is
+# checked against. And only the top of a visited row's ranking (down to the best ratio so far) is looked at.
 def resolveNonConstrainedMatches(anchorRowIndex, rowDict, colDict, finalMatchArray):
     bestMatches = {}
     bestMatches["highestRatio"] = -0.1
     bestMatches["highestRowDict"] = bestMatches["highestColDict"] = None
     # build constraining range + visit/test first row
-    constrainingColRange = {}
-    anchorColumns = []
-    for tuple in rowDict[anchorRowIndex]:
-        constrainingColRange[tuple[1]] = True
-        anchorColumns.append(tuple[1])
-        updateBestMatches(tuple, bestMatches)
-    visitedRow = {}
-    for colIndex in anchorColumns: # perf note: the 'in' expression is only evaluated once
-        # traverse each column
-        for colIterator in xrange(1, len(colDict[colIndex])): # skips the anchor row (handled earlier)
-            colTuple = colDict[colIndex][colIterator]
-            # Get the row of this column entry and iterate (if the row hasn't been visited)
-            if colTuple[2] in visitedRow:
-                continue # Skip this row
+    anchorRow = rowDict[anchorRowIndex]
+    updateBestRankedMatches(anchorRow, bestMatches)
+    anchorColumns = [tuple[1] for tuple in anchorRow]
+    visits = [] # (index in anchorColumns of the first column the row is in, row index)
+    visitedRow = {anchorRowIndex: True}
+    for colIndex in anchorColumns:
+        col = colDict[colIndex]
+        for colTuple in col.getRanked():
+            if colTuple[0] < bestMatches["highestRatio"]:
+                break
+            if colTuple[2] in visitedRow or not colTuple in col:
+                continue
             visitedRow[colTuple[2]] = True
-            # pre-scan for >= best ratio results that are out the constraining range. This is a pre-
-            # scan because I would otherwise need to roll-back the state of the highestCol/RowDict
-            # objects if they found a (legitimate) higher value before stumbling on the out-of-range
-            # option.
-            for preScanRowTuple in rowDict[colTuple[2]]:
-                if preScanRowTuple[0] >= bestMatches["highestRatio"] and not preScanRowTuple[1] in constrainingColRange:
-                    break # invalidating this entire row
-            else: # loop-completed w/out breaking, row is safe.
-                for rowTuple in rowDict[colTuple[2]]:
-                    updateBestMatches(rowTuple, bestMatches)
+            for i in xrange(len(anchorColumns)):
+                if colTuple[2] in colDict[anchorColumns[i]].positions:
+                    visits.append((i, colTuple[2]))
+                    break
+    visits.sort()
+    for firstColumn, rowIndex in visits:
+        # pre-scan for >= best ratio results that are out the constraining range. This is a pre-
+        # scan because I would otherwise need to roll-back the state of the highestCol/RowDict
+        # objects if they found a (legitimate) higher value before stumbling on the out-of-range
+        # option.
+        row = rowDict[rowIndex]
+        for preScanRowTuple in row.getRanked():
+            if preScanRowTuple[0] < bestMatches["highestRatio"]:
+                updateBestRankedMatches(row, bestMatches) # row is safe.
+                break
+            if preScanRowTuple in row and not preScanRowTuple in anchorRow:
+                break # invalidating this entire row
+        else:
+            updateBestRankedMatches(row, bestMatches)
     # This has a stable ascending sort for ordinal keys, so regardless of the order they were added,
     # they will be processed in the correct order.
     highestRowDict = bestMatches["highestRowDict"]
@@ -455,6 +1468,15 @@ def resolveNonConstrainedMatches(anchorRowIndex, rowDict, colDict, finalMatchArr
     selectAndRemoveFromNonConstrainedMatches(tuple[2], tuple[1], rowDict, colDict, finalMatchArray)
     return anchorRowIndex == tuple[2]
 
+# Updates the best matches with the row's tuples, from the top of its ranking down to the best ratio (the lower
+# ones can't be among the best matches).
+def updateBestRankedMatches(row, best):
+    for tuple in row.getRanked():
+        if tuple[0] < best["highestRatio"]:
+            break
+        if tuple in row:
+            updateBestMatches(tuple, best)
+
 def updateBestMatches(tuple, best):
     if tuple[0] > best["highestRatio"]:
         best["highestRowDict"] = {}
@@ -478,27 +1500,32 @@ def selectAndRemoveFromNonConstrainedMatches(rowIndex, colIndex, rowDict, colDic
         if tuple[1] == colIndex:
             finalMatchArray[rowIndex] = tuple
         else:
-            col = colDict[tuple[1]]
-            for i in xrange(len(col)):
-                if tuple == col[i]:
-                    del col[i]
-                    break
+            colDict[tuple[1]].remove(tuple)
     # for each column, may need to remove isolated non-matching row entries, so they are not visited
     # later (they can't be matched).
     for tuple in selectedCol:
         if tuple[2] != rowIndex:
             row = rowDict[tuple[2]]
-            for i in xrange(len(row)):
-                if tuple == row[i]:
-                    if len(row) == 1: #don't leave a row vacant as a result
-                        finalMatchArray[row[i][2]] = (row[i][0], row[i][1], -1)
-                        del rowDict[row[i][2]]
-                    else:
-                        del row[i]
-                    break
+            if len(row) == 1: #don't leave a row vacant as a result
+                finalMatchArray[tuple[2]] = (tuple[0], tuple[1], -1)
+                del rowDict[tuple[2]]
+            else:
+                row.remove(tuple)
     del colDict[colIndex] # prevents searching this column for "near matches" later
     del rowDict[rowIndex]
 
+# Puts the links back in their state from before matching (with their matchWords, which preCheck4Correct replaced),
+# so the document can be diffed against another source.
+def resetLinkResults(doc, matchWords):
+    for link in doc.links:
+        link.words = matchWords[link.index]
+        link.status = "non-matched"
+        link.matchIndex = -1
+        link.matchRatio = 0.0
+        link.correctRatio = 0.0
+    doc.statsTargetLookups = 0
+    doc.statsTargetCacheHits = 0
+
 def applyOwnMatchArray(ownMatchResultsArray, ownLinks):
     assert len(ownMatchResultsArray) == len(ownLinks), 'Baseline and matched lists must have the same length'
     matchesCount = 0
@@ -530,6 +1557,29 @@ def applyOtherMatchArray(otherMatchResultsArray, nearMissesList, ownLinks):
         # sadly, not matched though...
     return matchesCount
 
+# Sets the matchRatio of each unmatched link that got no ratio from applyOtherMatchArray (as a near-miss or as the
+# best non-match of a baseline link) to its best ratio against the links of the other document (given its compact
+# index), scoring the link's words against them the way the baseline links are scored against the source links.
+# Only those links are scored, so this costs little next to matching. The status tells the unmatched links apart,
+# not matchIndex (a matched link's matchIndex is -1 when it is also the best non-match of another link). Must be
+# called after applyOtherMatchArray and before preCheck4Correct (which replaces the links' words). Returns the
+# number of links scored.
+def applyUnmatchedRatios(ownLinks, otherCompactIndex):
+    unmatchedLinks = [link for link in ownLinks if link.status == 'non-matched' and link.matchRatio == 0.0]
+    for link, ratio in izip(unmatchedLinks, getBestMatchRatios(otherCompactIndex, [link.words for link in unmatchedLinks])):
+        link.matchRatio = ratio
+    return len(unmatchedLinks)
+
+# Returns the best match ratio of each word list against the links of compactIndex (see StartBuildMatchResult)
+def getBestMatchRatios(compactIndex, wordLists):
+    global OTHER_INDEX
+    previousIndex = OTHER_INDEX
+    OTHER_INDEX = compactIndex
+    try:
+        return [max([tuple[0] for tuple in StartBuildMatchResult((wordList, -1, False))]) for wordList in wordLists]
+    finally:
+        OTHER_INDEX = previousIndex
+
 # If the paramter is true, returns a tuple where
 # 0 - skipped total
 # 1 - [ (otherIndex, hrefValue) ]
@@ -554,23 +1604,34 @@ def preCheck4Correct(doc, generateOtherLists = False):
             if generateOtherLists:
                 otherExternal.append((link.matchIndex, link.href))
             continue
-        hrefTarget = doc.getElementById(getLinkTarget(link.href))
+        hrefTarget = doc.getLinkTargetElement(link.href)
         if hrefTarget == None:
             link.status = "broken"
             continue
-        words = getDirectionalContextualWords(hrefTarget, True) + getDirectionalContextualWords(hrefTarget, False)
+        words = getTargetContextualWords(doc, hrefTarget)
         if generateOtherLists:
             otherWords.append((link.matchIndex,words))
         else: #in-place update the word list to be the target's word list!
             link.words = words
     return (skippedTotal, otherExternal, otherWords)
 
+# Many links share the same target; its words are extracted once and the same list is handed out after that
+# (callers must not modify it).
+def getTargetContextualWords(doc, elem):
+    doc.statsTargetLookups += 1
+    if elem._cachedContextualText == None:
+        elem._cachedContextualText = getDirectionalContextualWords(doc, elem, True) + getDirectionalContextualWords(doc, elem, False)
+    else:
+        doc.statsTargetCacheHits += 1
+    return elem._cachedContextualText
+
 # returns an array of results for each provided array as:
 # 0 - total own correct
 # 1 - [indexes of potentially correct external links]
 # 2 - [(indexOfCorrectLink,correctRatio)]
 # where the indexes are per the other document
-def check4Correct(doc, otherExternal, otherWords):
+# The word lists are scored by up to processCount processes.
+def check4Correct(doc, otherExternal, otherWords, processCount = 1):
     correctExternals = []
     correctWords = []
     for externTuple in otherExternal:
@@ -581,41 +1642,87 @@ def check4Correct(doc, otherExternal, otherWords):
             link.status = 'correct-external'
             link.correctRatio = 1.0
     totalOwnCorrect = len(correctExternals)
-    for wordTuple in otherWords:
-        index, words = wordTuple
+    for index, wordsToOwnWordsRatio, ownWordsToWordsRatio in getCorrectnessRatios(doc, otherWords, processCount):
         link = doc.links[index]
-        ownWords = link.words
-        wordsToOwnWordsRatio = getRatio(words, ownWords)
-        # If the lengths of the two lists are the same, then the same ratio of matches is interchangable
-        # e.g., for two lists with 4 items, if only 2 items match from one list to the other, more than
-        # 2 items cannot match if the lists were interchanged. This is not true when the lists have different
-        # lenghts, as the matching ratios can be different...
-        if len(words) == len(ownWords):
-            link.correctRatio = wordsToOwnWordsRatio
-            if wordsToOwnWordsRatio >= MATCH_RATIO_THRESHOLD:
-                link.status = 'correct'
-                totalOwnCorrect += 1
-                correctWords.append((link.matchIndex, wordsToOwnWordsRatio))
-            continue
-        link.correctRatio = getRatio(ownWords, words)
+        link.correctRatio = ownWordsToWordsRatio
         if link.correctRatio >= MATCH_RATIO_THRESHOLD:
             link.status = 'correct'
             totalOwnCorrect += 1
             correctWords.append((link.matchIndex, wordsToOwnWordsRatio))
     return (totalOwnCorrect, correctExternals, correctWords)
 
+# The ratio of ownWords found in otherWords, where each word of otherWords can only be found once.
 def getRatio(ownWords, otherWords):
-    otherWordsNoDup = [ {'word': w, 'notused': True} for w in otherWords ]
-    found = 0
-    for word in ownWords:
-        for otherWord in otherWordsNoDup:
-            if otherWord['notused'] and word == otherWord['word']:
-                found += 1
-                otherWord['notused'] = False
-                break
     if len(ownWords) == 0:
         return 0.0
-    return found / float(len(ownWords))
+    return getMatchingWordCount(Counter(ownWords), Counter(otherWords)) / float(len(ownWords))
+
+# The number of words that can be paired between two word histograms (the size of the multiset intersection).
+# This count is the same in both directions, so only the divisor differs between the two ratios of a pair.
+def getMatchingWordCount(histogram1, histogram2):
+    if len(histogram2) < len(histogram1):
+        histogram1, histogram2 = histogram2, histogram1
+    found = 0
+    for word, count in histogram1.iteritems():
+        otherCount = histogram2[word]
+        found += count if count < otherCount else otherCount
+    return found
+
+# Scores the otherWords word lists (see getRatioBatch) in chunks across a pool of processCount workers. Each
+# worker gets the document's link words and compact index once (read-only), and the results are merged
+# back in order, so they are identical to scoring everything in this process.
+def getCorrectnessRatios(doc, otherWords, processCount):
+    linkWords = [link.words for link in doc.links]
+    if processCount <= 1 or len(otherWords) <= CHECK_CHUNK_SIZE:
+        return getRatioBatch(doc.compactIndex, linkWords, otherWords)
+    startTime = time.time()
+    busy = Value('d', 0.0) if PROFILE else None
+    p = Pool(processCount, initCheckWorker, (doc.compactIndex, linkWords, busy))
+    chunks = [otherWords[i:i + CHECK_CHUNK_SIZE] for i in xrange(0, len(otherWords), CHECK_CHUNK_SIZE)]
+    ratios = []
+    for chunkRatios in p.imap(StartCheckRatioChunk, chunks):
+        ratios.extend(chunkRatios)
+    p.close()
+    if busy != None:
+        recordPoolUse('correctness', processCount, len(chunks), startTime, busy)
+    return ratios
+
+# Pool initializer for the correctness check workers.
+def initCheckWorker(compactIndex, linkWords, busy = None):
+    global CHECK_INDEX
+    global CHECK_LINK_WORDS
+    global CHECK_BUSY
+    CHECK_INDEX = compactIndex
+    CHECK_LINK_WORDS = linkWords
+    CHECK_BUSY = busy
+
+# Process entry point
+# Scores a chunk of (index, words) tuples against the link words given to the worker by initCheckWorker.
+def StartCheckRatioChunk(otherWordsChunk):
+    startTime = time.time()
+    ratios = getRatioBatch(CHECK_INDEX, CHECK_LINK_WORDS, otherWordsChunk)
+    if CHECK_BUSY != None:
+        addPoolBusyTime(CHECK_BUSY, startTime)
+    return ratios
+
+# Scores every (index, words) tuple of otherWords against linkWords[index] (the words of link index), returning
+# [(index, ratio of words found in the link's words, ratio of the link's words found in words)].
+# Word lists are often shared (see getTargetContextualWords), so each distinct list is interned and
+# counted only once.
+def getRatioBatch(compactIndex, linkWords, otherWords):
+    histograms = {} # id(words) <-> (words, histogram); keeping the list alive keeps its id unique
+    overflowVocabulary = {} # so that words unknown to the compact index still compare equal
+    results = []
+    for index, words in otherWords:
+        ownWords = linkWords[index]
+        for wordList in (words, ownWords):
+            if id(wordList) not in histograms:
+                histograms[id(wordList)] = (wordList, Counter(compactIndex.internWords(wordList, overflowVocabulary)))
+        found = getMatchingWordCount(histograms[id(words)][1], histograms[id(ownWords)][1])
+        wordsToOwnWordsRatio = 0.0 if len(words) == 0 else found / float(len(words))
+        ownWordsToWordsRatio = 0.0 if len(ownWords) == 0 else found / float(len(ownWords))
+        results.append((index, wordsToOwnWordsRatio, ownWordsToWordsRatio))
+    return results
 
 def applyCorrectnessResults(doc, externalCorrectList, wordCorrectList):
     for i in externalCorrectList:
@@ -628,7 +1735,50 @@ def applyCorrectnessResults(doc, externalCorrectList, wordCorrectList):
     return len(externalCorrectList) + len(wordCorrectList)
 
 # get HALF_WORD_COUNT words (or less if only less is available) in the indicated direction
-def getDirectionalContextualWords(elem, isBeforeText):
+# This is a slice of the document's word stream (see tokenizeDocument) that gives exactly the same
+# words as getDirectionalContextualWordsFromNodes: the same growing character window is emulated,
+# including words cut off by the window's edges (or split by the element itself).
+def getDirectionalContextualWords(doc, elem, isBeforeText):
+    wordStarts = doc.wordStarts
+    wordEnds = doc.wordEnds
+    textOffset = elem.textOffset
+    characterLimit = HALF_CONTEXT_MIN
+    if isBeforeText:
+        endWord = elem.wordOffset
+        if endWord < len(doc.words) and wordStarts[endWord] < textOffset:
+            endWord += 1 # the element splits this word; the part before it is included
+        while True:
+            startWord = endWord - HALF_WORD_COUNT
+            if startWord >= 0 and wordEnds[startWord] > textOffset - characterLimit:
+                return getClippedWords(doc, startWord, endWord, textOffset - characterLimit, textOffset)
+            if textOffset < characterLimit: # There just isn't any more text; drop the leading word, which is likely cut-off.
+                return getClippedWords(doc, 1, endWord, 0, textOffset)
+            characterLimit += 120 # growth factor on retry
+    else:
+        startWord = elem.wordOffset
+        while True:
+            endWord = startWord + HALF_WORD_COUNT
+            if endWord <= len(doc.words) and wordStarts[endWord - 1] < textOffset + characterLimit:
+                return getClippedWords(doc, startWord, endWord, textOffset, textOffset + characterLimit)
+            if doc.textLength - textOffset < characterLimit: # There just isn't any more text; drop the trailing word, which is likely cut-off.
+                return getClippedWords(doc, startWord, len(doc.words) - 1, textOffset, doc.textLength)
+            characterLimit += 120
+
+# Returns the words [startWord, endWord) of the stream with the first and last ones cut to the text
+# window [windowStart, windowEnd).
+def getClippedWords(doc, startWord, endWord, windowStart, windowEnd):
+    words = doc.words[startWord:endWord]
+    if len(words) > 0:
+        words[0] = getClippedWord(doc, startWord, windowStart, windowEnd)
+        words[-1] = getClippedWord(doc, endWord - 1, windowStart, windowEnd)
+    return words
+
+def getClippedWord(doc, wordIndex, windowStart, windowEnd):
+    wordStart = doc.wordStarts[wordIndex]
+    return doc.words[wordIndex][max(0, windowStart - wordStart):min(doc.wordEnds[wordIndex], windowEnd) - wordStart]
+
+# The reference implementation of getDirectionalContextualWords: walks the nodes to build up the text.
+def getDirectionalContextualWordsFromNodes(elem, isBeforeText):
     textCount = HALF_CONTEXT_MIN # should be enough, but if not, grow this variable.
     wordCount = 0
     #since lead or tail text may cut off a word (in the middle of a whole word), ask for one more word than needed and drop the potential half-word)
@@ -704,9 +1854,9 @@ def dumpDocument(doc, enumAll=False):
         counter += 1
     print "total nodes in document: " + str(counter)
 
-def getAndCompareRatio(elem1, elem2):
-    list1 = getDirectionalContextualWords(elem1, True) + getDirectionalContextualWords(elem1, False)
-    list2 = getDirectionalContextualWords(elem2, True) + getDirectionalContextualWords(elem2, False)
+def getAndCompareRatio(doc1, elem1, doc2, elem2):
+    list1 = getDirectionalContextualWords(doc1, elem1, True) + getDirectionalContextualWords(doc1, elem1, False)
+    list2 = getDirectionalContextualWords(doc2, elem2, True) + getDirectionalContextualWords(doc2, elem2, False)
     return getRatio(list1, list2)
 
 def getContextualText(elem):
@@ -716,7 +1866,6 @@ def getContextualText(elem):
 
 def runTests(mem):
     mem.ignoreList = {'http://test/test/test.com': True}
-    mem.progress = 0
     setGlobals(mem)
     # test 1
     parser = LinkAndTextHTMLParser()
@@ -771,10 +1920,10 @@ def runTests(mem):
     # test 7 - getAndCompareRatio
     doc = parser.parse("Here's some text that is the same<a href=hi>")
     doc2 = parser.parse("And this sentance won't match up anywhere<a href=bar>")
-    assert getAndCompareRatio(doc.links[0], doc.links[0]) == 1.0, 'test7: getAndCompareRatio working for same sentances'
-    assert getAndCompareRatio(doc.links[0], doc2.links[0]) < 0.09, 'test7: getAndCompareRatio working for non-similar sentances'
+    assert getAndCompareRatio(doc, doc.links[0], doc, doc.links[0]) == 1.0, 'test7: getAndCompareRatio working for same sentances'
+    assert getAndCompareRatio(doc, doc.links[0], doc2, doc2.links[0]) < 0.09, 'test7: getAndCompareRatio working for non-similar sentances'
     doc2 = parser.parse("Here's some text that isn't the same<a href=foo>")
-    assert getAndCompareRatio(doc.links[0], doc2.links[0]) > 0.85, 'test7: getAndCompareRatio working for similar sentances'
+    assert getAndCompareRatio(doc, doc.links[0], doc2, doc2.links[0]) > 0.85, 'test7: getAndCompareRatio working for similar sentances'
 
     # test 8 - (new) Validate the complexities of the match resolver
     array = [
@@ -1075,12 +2224,12 @@ def runTests(mem):
     markup1 += "source used for determining correctness is the WHATWG version of the spec."
     doc = parseTextToDocument(markup1)
     #dumpDocument(doc, True)
-    resultWordList = getDirectionalContextualWords(doc.links[0], True)
+    resultWordList = getDirectionalContextualWords(doc, doc.links[0], True)
     assert len(resultWordList) == HALF_WORD_COUNT, "test12: getDirectionalContextualWords returns "+str(HALF_WORD_COUNT)+" items from front of link"
     testList = ['the', 'semantically', 'correct', 'place', 'in', 'the', 'spec', 'or', 'other', 'linked']
     for i in xrange(len(testList)):
         assert testList[i] == resultWordList[i], "test12: validating expected words before link"
-    resultWordList = getDirectionalContextualWords(doc.links[0], False)
+    resultWordList = getDirectionalContextualWords(doc, doc.links[0], False)
     assert len(resultWordList) == HALF_WORD_COUNT, "test12: getDirectionalContextualWords returns "+str(HALF_WORD_COUNT)+" items from back of link"
     testList = ['spec', 'correctness', 'in', 'this', 'sense', 'can', 'only', 'be', 'determined', 'by']
     for i in xrange(len(testList)):
@@ -1113,11 +2262,792 @@ def runTests(mem):
     assert res.baseAllLinks[1].correctRatio == 1.0, 'test13: link matching validation: correct--1.0 ratio'
     assert res.baseAllLinks[1].lineNo == 2, 'test13: line number is correct (expected: 2)'
     
+    # test 14 - the 'numpy' match engine finds the same candidates as the loop engine (needs numpy)
+    if numpy != None:
+        markup1 =  "<p id=top>The <a href=#top>first</a> link and the <a href=#top>second</a> link and the <a href=#top>third</a> link</p>\n"
+        markup1 += "in the spec or other linked <a href='http://external/place1'>spec</a>. <a href=#matched>Correctness</a>, in this sense\n"
+        markup1 += "aa aa aa aa aa aa aa aa aa aa <a href='http://external'>aa</a> aa aa aa aa aa aa aa aa aa\n"
+        markup2 =  markup1.replace('second', 'other').replace('Correctness', 'Rightness') + "<a href=#top>unmatched</a> tail words"
+        doc = parseTextToDocument(markup1)
+        doc2 = parseTextToDocument(markup2)
+        buildIndex(doc)
+        buildIndex(doc2)
+        for ratio in [0.8, 0.5, 0.0]:
+            initMatchWorker(getRunConfig(mem)._replace(ratio=ratio), Value('i', 0), None, 0, doc2.compactIndex, buildIndexMatrices(doc2.compactIndex))
+            batchResults = buildMatchResultBatch([link.words for link in doc.links], 0)
+            for link in doc.links:
+                assert batchResults[link.index] == StartBuildMatchResult((link.words, link.index, False)), 'test14: numpy engine candidates are identical to the loop engine at ratio ' + str(ratio)
+        setGlobals(mem)
+
+    # test 15 - the pruned (MaxScore) query path finds the same candidates and best non-matches as the exhaustive one
+    markup1 =  "<p id=top>The <a href=#top>first</a> link and the <a href=#top>second</a> link and the <a href=#top>third</a> link</p>\n"
+    markup1 += "in the spec or other linked <a href='http://external/place1'>spec</a>. <a href=#matched>Correctness</a>, in this sense\n"
+    markup1 += "can only be determined by comparing the links to a canonical <a href=#top>correct</a> source. In the case of the\n"
+    markup1 += "aa aa aa aa aa aa aa aa aa aa <a href='http://external'>aa</a> aa aa aa aa aa aa aa aa aa\n"
+    markup2 =  markup1.replace('second', 'other').replace('Correctness', 'Rightness').replace('canonical', 'a') + "<a href=#top>unmatched</a> tail words"
+    doc = parseTextToDocument(markup1)
+    doc2 = parseTextToDocument(markup2)
+    buildIndex(doc)
+    buildIndex(doc2)
+    for ratio in [1.0, 0.95, 0.8, 0.5, 0.2]:
+        initMatchWorker(getRunConfig(mem)._replace(ratio=ratio), Value('i', 0), None, 0, doc2.compactIndex)
+        for link in doc.links:
+            assert buildPrunedMatchResult(link.words, link.index) == buildExhaustiveMatchResult(link.words, link.index), 'test15: pruned query results are identical to the exhaustive ones at ratio ' + str(ratio)
+    setGlobals(mem)
+
+    # test 16 - the compact index holds the same postings and link words as the index, and survives pickling
+    compactIndex = pickle.loads(pickle.dumps(doc2.compactIndex, pickle.HIGHEST_PROTOCOL))
+    assert compactIndex.indexedWordsLen == len(doc2.index), 'test16: every indexed word has postings'
+    assert len(compactIndex.vocabulary) == len(doc2.index) + len(doc2.unIndexed), 'test16: vocabulary holds indexed and too-common words'
+    for word in doc2.index:
+        start, end = compactIndex.getPostingsRange(compactIndex.getWordId(word))
+        postings = []
+        for n in xrange(start, end):
+            postings += [compactIndex.postingLinks[n], compactIndex.postingCounts[n]]
+        assert postings == doc2.index[word], 'test16: postings are identical for word ' + word
+    for word in doc2.unIndexed:
+        assert compactIndex.isTooCommon(compactIndex.getWordId(word)), 'test16: too-common words are flagged'
+    assert compactIndex.getWordId('not-a-word') == -1, 'test16: unknown words have no id'
+    for link in doc2.links:
+        start, end = compactIndex.getLinkWordsRange(link.index)
+        assert end - start == len(link.words) / 2, 'test16: each link has the same number of words'
+        for n in xrange(start, end):
+            word = link.words[(n - start) * 2]
+            assert compactIndex.linkWordIds[n] == compactIndex.getWordId(word), 'test16: link word ids are in word list order'
+            assert compactIndex.linkWordCounts[n] == link.words[(n - start) * 2 + 1], 'test16: link word counts are identical'
+    overflowVocabulary = {}
+    assert compactIndex.internWords(['unknown', 'aa', 'unknown'], overflowVocabulary) == compactIndex.internWords(['unknown', 'aa', 'unknown'], overflowVocabulary), 'test16: interned unknown words are stable'
+    assert compactIndex.byteSize() > 0, 'test16: index size is reported'
+
+    # test 17 - too-common words are decided by document frequency, regardless of the order of the links
+    markup1 = ''
+    for i in xrange(150):
+        markup1 += 'common words ' + ('rare' if i % 4 == 0 else 'often') + str(i % 3) + ' text number' + str(i) + ' <a href=#l' + str(i) + '>link</a> and more\n'
+    doc = parseTextToDocument(markup1)
+    buildIndex(doc)
+    assert 'common' in doc.unIndexed and 'common' not in doc.index, 'test17: words in more than 1/3 of the links are too common'
+    assert 'rare0' in doc.index and 'rare0' not in doc.unIndexed, 'test17: words in less than 1/3 of the links are indexed'
+    assert len(doc.index['rare0']) / 2 == len([link for link in doc.links if 'rare0' in link.words[0::2]]), 'test17: all postings of an indexed word are kept'
+    doc2 = parseTextToDocument(markup1)
+    doc2.links.reverse()
+    buildIndex(doc2)
+    assert doc2.unIndexed == doc.unIndexed, 'test17: the too-common words are the same for any link order'
+    assert sorted(doc2.index.keys()) == sorted(doc.index.keys()), 'test17: the indexed words are the same for any link order'
+
+    # test 18 - context words sliced from the word stream are identical to those built by walking the nodes
+    markups = [
+        markup1,
+        "The <b>freeway</b> can get quite backed-up; that's why I enjoy riding the <div id=target>Connector</div>. It saves me \nlots of time on my commute. Microsoft <i>is quite awesome</i> to provide such a service to their <span class=employee><a>employees</a></span> \nthat live in the <span>Pugot Sound</span> area. Of course, I could get to work a lot faster by driving my car,\nbut then I wouldn't be able to write tests while on the <a href=#target>bus</a>.",
+        u'split<a href=#in>wo</a>rds &amp; entities&#68;here, caf\xe9 <span id=in></span>--- . <a href=#x>',
+        '<a href=#first>at the start</a>' + 'some words ' * 30 + '<span id=last></span>'
+    ]
+    for markup in markups:
+        doc = parseTextToDocument(markup)
+        for halfWordCount in [1, 3, 10, 25]:
+            setGlobals(getRunConfig(mem)._replace(halfContextWords=halfWordCount))
+            node = doc.start
+            while node != None:
+                if not isinstance(node, TextNode):
+                    for isBeforeText in [True, False]:
+                        assert getDirectionalContextualWords(doc, node, isBeforeText) == getDirectionalContextualWordsFromNodes(node, isBeforeText), 'test18: word stream context words are identical (' + str(halfWordCount) + ' words, before: ' + str(isBeforeText) + ')'
+                node = node.next
+    setGlobals(mem)
+
+    # test 19 - link target context words are extracted once per target and reused
+    doc = parseTextToDocument('<p id=node>A node is the basic unit of a tree.</p> See <a href=#node>node</a>, <a href=#node>nodes</a>, <a href=#n%6Fde>node</a>, <a href=#tree>tree</a> and <a href=#missing>missing</a>. The <span id=tree>tree</span> ends here.')
+    for link in doc.links:
+        link.status = 'matched'
+        link.matchIndex = link.index
+    skippedTotal, otherExternal, otherWords = preCheck4Correct(doc, True)
+    assert [link.status for link in doc.links] == ['matched', 'matched', 'matched', 'matched', 'broken'], 'test19: the missing target is still reported as broken'
+    assert doc.statsTargetLookups == 4, 'test19: one context word lookup per link with a target'
+    assert doc.statsTargetCacheHits == 2, 'test19: repeated targets (including percent-encoded ones) are served from the cache'
+    nodeWords = getDirectionalContextualWords(doc, doc.getElementById('node'), True) + getDirectionalContextualWords(doc, doc.getElementById('node'), False)
+    assert [words for index, words in otherWords[0:3]] == [nodeWords] * 3, 'test19: cached words are identical to freshly extracted ones'
+    assert doc.getLinkTargetElement('#missing') == None, 'test19: missing targets resolve to None'
+
+    # test 20 - histogram ratios are identical to pairing the words one by one
+    def getPairedRatio(ownWords, otherWords):
+        unused = list(otherWords)
+        found = 0
+        for word in ownWords:
+            if word in unused:
+                unused.remove(word)
+                found += 1
+        return 0.0 if len(ownWords) == 0 else found / float(len(ownWords))
+    rand = random.Random(20)
+    vocabulary = ['a', 'b', 'c', 'd', 'e', 'unknown']
+    doc = parseTextToDocument(' '.join([rand.choice(vocabulary[:5]) for n in xrange(60)]) + ' <a href=#x>x</a> <a href=#y>y</a> <a href=#z>z</a>')
+    buildIndex(doc)
+    otherWords = []
+    for n in xrange(200):
+        link = doc.links[n % len(doc.links)]
+        link.words = [rand.choice(vocabulary) for i in xrange(rand.randint(0, 8))]
+        words = [rand.choice(vocabulary) for i in xrange(rand.randint(0, 8))]
+        assert getRatio(words, link.words) == getPairedRatio(words, link.words), 'test20: getRatio is identical to pairing words one by one'
+        assert getRatio(link.words, words) == getPairedRatio(link.words, words), 'test20: getRatio is identical to pairing words one by one (reversed)'
+        assert getRatioBatch(doc.compactIndex, [link.words for link in doc.links], [(link.index, words)]) == [(link.index, getPairedRatio(words, link.words), getPairedRatio(link.words, words))], 'test20: batched ratios are identical'
+        otherWords.append((link.index, words))
+    sharedWords = otherWords[0][1]
+    otherWords = [(index, sharedWords) for index, words in otherWords[:3]]
+    assert getRatioBatch(doc.compactIndex, [link.words for link in doc.links], otherWords) == [(index, getRatio(sharedWords, doc.links[index].words), getRatio(doc.links[index].words, sharedWords)) for index, words in otherWords], 'test20: shared word lists are scored correctly'
+
+    # test 21 - the correctness check gives the same results when spread across processes
+    doc = parseTextToDocument(markup1 + markup1)
+    buildIndex(doc)
+    for link in doc.links:
+        link.matchIndex = link.index
+        link.words = link.words[0::2] # as if preCheck4Correct replaced them with the target's words
+    otherWords = [(n % len(doc.links), [rand.choice(vocabulary) for i in xrange(rand.randint(0, 4))] + doc.links[n % len(doc.links)].words) for n in xrange(CHECK_CHUNK_SIZE * 3 + 1)]
+    serialResults = check4Correct(doc, [], otherWords)
+    serialRatios = [link.correctRatio for link in doc.links]
+    assert serialResults[0] > 0, 'test21: some links are correct'
+    assert check4Correct(doc, [], otherWords, 3) == serialResults, 'test21: parallel correctness results are identical'
+    assert [link.correctRatio for link in doc.links] == serialRatios, 'test21: parallel correctness ratios are identical'
+
+    # test 22 - streamed (chunked) reading and parsing is identical to reading and parsing everything at once
+    markup = u'<p id=top>Caf\xe9 &amp; cr\xe8me &#x2014; <a href=#top>top</a>&nbsp;of <a href="#end">the</a> <!-- note --> page</p>\n<span id=end>\u4e2d\u6587 end</span>&amp'
+    for encoded in [markup.encode('utf-8'), codecs.BOM_UTF8 + markup.encode('utf-8'), markup.encode('utf-16'), markup.encode('utf-16')[:-1], 'bad \xe9\xff\xc3 bytes\xe2\x82', '', '\xef\xbb']:
+        for chunkSize in [1, 2, 3, 5, 64]:
+            assert u''.join(readDocumentChunks(StringIO(encoded), 'test', chunkSize)) == toUnicode(encoded), 'test22: incremental decoding is identical to toUnicode (chunk size ' + str(chunkSize) + ')'
+    doc = parseTextToDocument(markup)
+    for chunkSize in [1, 7, 64]:
+        doc2 = parseChunksToDocument(readDocumentChunks(StringIO(markup.encode('utf-8')), 'test', chunkSize))
+        assert doc2.words == doc.words and doc2.wordStarts == doc.wordStarts and doc2.textLength == doc.textLength, 'test22: chunked parsing yields the same text and words'
+        assert [(link.href, link.id, link.wordOffset) for link in doc2.links] == [(link.href, link.id, link.wordOffset) for link in doc.links], 'test22: chunked parsing yields the same links'
+        assert sorted(doc2._idMap.keys()) == sorted(doc._idMap.keys()), 'test22: chunked parsing yields the same ids'
+
+    # test 23 - the fast-scan parser produces the same document as HTMLParser (differential test on random markup)
+    def getDocumentSummary(markup, parser, chunkSize):
+        try:
+            doc = parser.parseChunks([markup[i:i + chunkSize] for i in xrange(0, len(markup), chunkSize)])
+        except HTMLParseError as e:
+            return str(e)
+        nodes = []
+        node = doc.start
+        while node != None:
+            if isinstance(node, TextNode):
+                nodes.append(node.textContent)
+            else:
+                nodes.append((node.__class__.__name__, node.id, node.textOffset, node.wordOffset))
+            node = node.next
+        return (nodes, [(link.index, link.href, link.id, link.lineNo) for link in doc.links], sorted([(key, doc._idMap[key].textOffset) for key in doc._idMap]),
+                doc.droppedTags, doc.words, doc.wordStarts, doc.wordEnds, doc.textLength)
+    fragments = ['words and more words', ' ', '\n', '<p>', '</p>', '<P CLASS="x">', '<p id=x>', '<p ID="y">', '<p data-id=z>', '<p idx=1>', '<p class="a"b="c">',
+                 '<a href=#x>', '<A HREF="#y" id=ax>', '<a href>', '<a name=n>', '<a\vhref=#x>', '<a href=/x/>', '<p\vid=v>', '<br/>', '<br />', '<img src=x/>', '<img id=i/>',
+                 '<p title="a>b">', "<p title='c'>", '<p\nclass=n\n>', '<script>if (a<b) { x("<p id=s>") }</script>', '<style>p { }</style>', '<script src=x/>', '</script>', '</style >',
+                 '<!-- comment <a href=#c> -->', '<!DOCTYPE html>', '<?pi x?>', '<!bogus>', '</ p>', '</>', '< p>', '<', '>', '<p', '="x"',
+                 '&amp;', '&amp ', '&amp', '&#123;', '&#x2F', '&#;', '&', '&#', u'caf\xe9', u'\u4e2d\u6587', 'x_y 42']
+    rand = random.Random(23)
+    for n in xrange(400):
+        markup = u''.join([rand.choice(fragments) for i in xrange(rand.randint(0, 40))])
+        chunkSize = rand.choice([1, 5, 1000])
+        assert getDocumentSummary(markup, FastScanHTMLParser(), chunkSize) == getDocumentSummary(markup, LinkAndTextHTMLParser(), chunkSize), 'test23: fast-scan parser matches HTMLParser on ' + repr(markup)
+    assert getDocumentSummary(markup1, FastScanHTMLParser(), 1000) == getDocumentSummary(markup1, LinkAndTextHTMLParser(), 1000), 'test23: fast-scan parser matches HTMLParser'
+    assert isFastScanSupported(), 'test23: the HTMLParser internals used by the fast-scan parser are there'
+
+    # test 24 - compact node storage: text is coalesced, and the node view walks the same way in both directions
+    doc = parseTextToDocument(u'plain text &copy; with &#68; in it<span id="a"></span><span id="b"></span><a href="#a">text</a>tail')
+    assert doc.text == u'plain text &copy; with &#68; in ittexttail', 'test24: all text is coalesced into one string'
+    assert len(doc.textRunEnds) == 7 and len(doc.elements) == 3, 'test24: text runs and elements are stored as arrays'
+    forward = []
+    node = doc.start
+    while node != None:
+        forward.append(node)
+        node = node.next
+    backward = []
+    node = forward[-1]
+    while node != None:
+        backward.append(node)
+        node = node.prev
+    assert forward == backward[::-1], 'test24: prev is the inverse of next'
+    assert [node.id for node in forward if not isinstance(node, TextNode)] == ['a', 'b', ''], 'test24: elements are in order'
+    assert ''.join([node.textContent for node in forward if isinstance(node, TextNode)]) == doc.text, 'test24: text nodes cover the text'
+    assert doc.start.next == doc.start.next and doc.start.next != doc.start, 'test24: text node views compare by position'
+    assert parseTextToDocument('').start == None, 'test24: an empty document has no nodes'
+
+    # test 25 - parsed and indexed documents are cached on disk, and load back identical
+    def getIndexedDocumentSummary(doc):
+        nodes = []
+        node = doc.start
+        while node != None:
+            nodes.append(node.textContent if isinstance(node, TextNode) else (node.id, node.textOffset, node.wordOffset))
+            node = node.next
+        return (nodes, [(link.index, link.href, link.id, link.lineNo, link.status, link.words) for link in doc.links], sorted([(key, doc._idMap[key]._elementIndex) for key in doc._idMap]),
+                doc.droppedTags, doc.words, doc.wordStarts, doc.wordEnds, doc.textLength, doc.statsUniqueWordCount, doc.statsWordsTooCommonCount, pickle.dumps(doc.compactIndex))
+    cacheDir = tempfile.mkdtemp()
+    try:
+        docPath = os.path.join(cacheDir, 'doc.html')
+        with open(docPath, 'wb') as file:
+            file.write(codecs.BOM_UTF8 + (markup1 + '<p id="">empty</p><a href="#x" id="">dup</a><b id=sync>dup</b>').encode('utf-8'))
+        setGlobals(getRunConfig(mem)._replace(cacheDir=cacheDir))
+        doc = loadIndexedDocument(docPath)
+        assert not doc.loadedFromCache and len([name for name in os.listdir(cacheDir) if name.endswith('.ldcache')]) == 1, 'test25: a cache miss parses the document and saves it'
+        doc2 = loadIndexedDocument(docPath)
+        assert doc2.loadedFromCache, 'test25: the second load is a cache hit'
+        assert getIndexedDocumentSummary(doc2) == getIndexedDocumentSummary(doc), 'test25: the cached document is identical'
+        setGlobals(getRunConfig(mem)._replace(cacheDir=cacheDir, halfContextWords=mem.halfContextWords + 1))
+        assert not loadIndexedDocument(docPath).loadedFromCache, 'test25: the context word count is part of the cache key'
+        setGlobals(getRunConfig(mem)._replace(cacheDir=cacheDir))
+        for name in os.listdir(cacheDir):
+            if name.endswith('.ldcache'):
+                with open(os.path.join(cacheDir, name), 'wb') as file:
+                    file.write('damaged')
+        assert not loadIndexedDocument(docPath).loadedFromCache, 'test25: a damaged cache file is a cache miss'
+    finally:
+        shutil.rmtree(cacheDir)
+        setGlobals(mem)
+
+    # test 26 - incremental matching against an edited source gives the same results as matching it from scratch
+    def getLinkResults(res):
+        return ([(link.status, link.matchIndex, link.matchRatio, link.correctRatio) for link in res.baseAllLinks],
+                [(link.status, link.matchIndex, link.matchRatio, link.correctRatio) for link in res.srcAllLinks])
+    rand = random.Random(26)
+    vocabulary = ['w' + str(n) for n in xrange(40)]
+    paragraphs = ['<p id=p' + str(n) + '>' + ' '.join([rand.choice(vocabulary) for i in xrange(rand.randint(3, 25))]) + ' <a href=#p' + str(rand.randint(0, 59)) + '>link</a> ' + ' '.join([rand.choice(vocabulary) for i in xrange(rand.randint(0, 25))]) + '</p>' for n in xrange(60)]
+    stateDir = tempfile.mkdtemp()
+    try:
+        mem.incrementalState = os.path.join(stateDir, 'test.state')
+        res = diffLinksWithMarkupText(''.join(paragraphs), ''.join(paragraphs), mem)
+        assert mem.baseMatchedCount == len(paragraphs), 'test26: without a previous state all links are matched'
+        for edit in xrange(8):
+            edited = list(paragraphs)
+            for i in xrange(rand.randint(1, 4)):
+                n = rand.randrange(len(edited))
+                change = rand.choice(['remove', 'insert', 'rewrite'])
+                if change == 'remove':
+                    del edited[n]
+                elif change == 'insert':
+                    edited.insert(n, rand.choice(paragraphs))
+                else:
+                    edited[n] = edited[n].replace(' ' + rand.choice(vocabulary) + ' ', ' ' + rand.choice(vocabulary) + ' ')
+            mem.incrementalState = os.path.join(stateDir, 'test.state')
+            resIncremental = diffLinksWithMarkupText(''.join(paragraphs), ''.join(edited), mem)
+            assert mem.baseMatchedCount < len(paragraphs), 'test26: the previous state was used'
+            mem.incrementalState = None
+            res = diffLinksWithMarkupText(''.join(paragraphs), ''.join(edited), mem)
+            assert getLinkResults(resIncremental) == getLinkResults(res), 'test26: incremental results are identical (edit ' + str(edit) + ')'
+            assert resIncremental.statTotalMatches == res.statTotalMatches and resIncremental.statTotalCorrect == res.statTotalCorrect, 'test26: incremental totals are identical'
+        mem.incrementalState = os.path.join(stateDir, 'test.state')
+        mem.ratio /= 2
+        diffLinksWithMarkupText(''.join(paragraphs), ''.join(paragraphs), mem)
+        assert mem.baseMatchedCount == len(paragraphs), 'test26: a different ratio matches all links again'
+        mem.ratio *= 2
+    finally:
+        shutil.rmtree(stateDir)
+        mem.incrementalState = None
+        setGlobals(mem)
+
+    # test 27 - documents fetched over HTTP are decompressed as they stream in, cached, and revalidated (local test server)
+    content = codecs.BOM_UTF8 + (markup1 * 20).encode('utf-8')
+    compressed = StringIO()
+    gzipFile = gzip.GzipFile(fileobj=compressed, mode='wb')
+    gzipFile.write(content)
+    gzipFile.close()
+    compressed = compressed.getvalue()
+    requestHeaders = []
+    class TestHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requestHeaders.append(self.headers)
+            if (self.path == '/etag' and self.headers.getheader('If-None-Match') == '"v1"') or (self.path == '/modified' and self.headers.getheader('If-Modified-Since') == 'Sat, 01 Jan 2000 00:00:00 GMT'):
+                self.send_response(304)
+                self.end_headers()
+                return
+            gzipped = 'gzip' in (self.headers.getheader('Accept-Encoding') or '')
+            body = compressed if gzipped else content
+            self.send_response(200)
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            if self.path == '/etag':
+                self.send_header('ETag', '"v1"')
+            elif self.path == '/modified':
+                self.send_header('Last-Modified', 'Sat, 01 Jan 2000 00:00:00 GMT')
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+    def fetch(path):
+        stream = openDocumentStream(baseURL + path)
+        data = stream.read()
+        stream.close()
+        return (stream, data)
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), TestHTTPHandler)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    baseURL = 'http://127.0.0.1:' + str(server.server_address[1])
+    cacheDir = tempfile.mkdtemp()
+    try:
+        stream, data = fetch('/etag')
+        assert 'gzip' in requestHeaders[-1].getheader('Accept-Encoding'), 'test27: gzip is requested'
+        assert data == content and stream.transferredLength == len(compressed) < len(content), 'test27: the compressed response is decompressed'
+        assert u''.join(loadDocumentChunks(baseURL + '/etag')) == toUnicode(content), 'test27: the response is streamed to the decoder'
+        setGlobals(getRunConfig(mem)._replace(cacheDir=cacheDir))
+        for path in ['/etag', '/modified']:
+            stream, data = fetch(path)
+            assert not stream.fromCache and data == content, 'test27: the first request is a cache miss (' + path + ')'
+            stream, data = fetch(path)
+            assert stream.fromCache and stream.transferredLength == 0 and data == content, 'test27: the revalidated response is read from the cache (' + path + ')'
+        assert requestHeaders[-1].getheader('If-Modified-Since') != None, 'test27: revalidation uses Last-Modified'
+        stream, data = fetch('/plain')
+        stream, data = fetch('/plain')
+        assert not stream.fromCache and data == content, 'test27: responses without validators are not cached'
+        for name in os.listdir(cacheDir):
+            os.remove(os.path.join(cacheDir, name))
+        stream = openDocumentStream(baseURL + '/etag')
+        stream.read(10)
+        stream.close()
+        assert os.listdir(cacheDir) == [], 'test27: partially read responses are not cached'
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cacheDir)
+        setGlobals(mem)
+
+    # test 28 - batch mode (one baseline, many sources) gives the same results as diffing each source on its own
+    batchDir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for n, markup in enumerate([markup1, markup2, ''.join(paragraphs), ''.join(paragraphs[::-1]) + markup2]):
+            paths.append(os.path.join(batchDir, 'doc' + str(n) + '.html'))
+            with open(paths[-1], 'wb') as file:
+                file.write(markup)
+        srcPaths = [paths[1], paths[2], os.path.join(batchDir, 'missing.html'), paths[0], paths[3], paths[1]]
+        batchResults = list(diffLinksBatchWithFilenames(paths[3], srcPaths, mem))
+        assert len(batchResults) == len(srcPaths) and batchResults[2] == None, 'test28: one result per source (None for a missing one)'
+        for srcPath, res in zip(srcPaths, batchResults):
+            if res != None:
+                assert getLinkResults(res) == getLinkResults(diffLinksWithFilename(paths[3], srcPath, mem)), 'test28: batch results are identical (' + srcPath + ')'
+        assert getReportFileName(1, 'http://w3c.github.io/html/index.html') == '2-index.html.json' and getReportFileName(0, '"http://w3c.github.io/html/"') == '1-html.json', 'test28: report file names'
+    finally:
+        shutil.rmtree(batchDir)
+
+    # test 29 - a multipage directory is loaded as the single-page document it was split from
+    def getJoinedDocumentSummary(doc):
+        return (doc.text, list(doc.textRunEnds), [(link.href, link.id, link.words) for link in doc.links], sorted([(key, doc._idMap[key]._elementIndex) for key in doc._idMap]), doc.words, pickle.dumps(doc.compactIndex))
+    pageNames = ['index.html', 'zeta.html', 'alpha.html'] # in section order (not the order of their names)
+    pageMarkups = ['<p>Contents: <a href=#p10>zeta</a> <a href="#p35">alpha</a> <a href=#missing>none</a></p>' + ''.join(paragraphs[0:10]) + '\n', ''.join(paragraphs[10:35]) + '\n', ''.join(paragraphs[35:]) + '\n']
+    pageOfId = lambda elemId: 'index.html' if int(elemId) < 10 else 'zeta.html' if int(elemId) < 35 else 'alpha.html'
+    # the section pages in multipage.js's template: the section's nav#toc entry, and the prev_next bars around <main>
+    prevNext = '<p class=prev_next><a href=index.html#p0>&larr; Previous</a> &mdash; <a href=index.html#contents>Table of Contents</a> &mdash; <a href=alpha.html#p35>Next &rarr;</a></p>'
+    pageTemplate = '<!DOCTYPE html><title>Spec</title><header><h1>Spec</h1></header>\n<nav id=toc>' + prevNext + '<ol class=toc><li><a href=zeta.html#p10>zeta</a></ol></nav>\n<main>%s</main>\n' + prevNext + '\n'
+    multipageDir = tempfile.mkdtemp()
+    try:
+        for name, markup in zip(pageNames, pageMarkups):
+            with open(os.path.join(multipageDir, name), 'wb') as file:
+                file.write((pageTemplate if name != 'index.html' else '%s') % re.sub(r'href=("?)#p(\d+)', lambda match: 'href=' + match.group(1) + pageOfId(match.group(2)) + '#p' + match.group(2), markup))
+        singlePagePath = os.path.join(multipageDir, 'single.txt')
+        with open(singlePagePath, 'wb') as file:
+            file.write(''.join(pageMarkups))
+        doc = loadIndexedDocument(multipageDir)
+        assert getJoinedDocumentSummary(doc) == getJoinedDocumentSummary(parseAndIndexChunks([''.join(pageMarkups).decode('utf-8')])), 'test29: the joined pages are the single-page document'
+        assert doc.links[0].lineNo == 1 and doc.links[3].lineNo == 1 and doc.links[13].lineNo == 3, 'test29: line numbers are those within each page'
+        assert getMainContent(u'a\n<MAIN class=x>b\n<main>c</main>d</main >e') == (u'b\n<main>c</main>d', 1) and getMainContent(u'<p>a</p>') == (u'<p>a</p>', 0), 'test29: the content of <main>'
+        assert getLinkResults(diffLinksWithFilename(singlePagePath, multipageDir, mem)) == getLinkResults(diffLinksWithFilename(singlePagePath, singlePagePath, mem)), 'test29: diffing against the multipage directory is the same as against the single page'
+        assert getPageOrder(['a.html', 'b.html', 'c.html'], None) == ['a.html', 'b.html', 'c.html'], 'test29: without index.html the pages are in name order'
+        assert getLocalPageName('./b.html#x', ['b.html']) == 'b.html' and getLocalPageName('http://b.html#x', ['b.html']) == None, 'test29: local page names'
+    finally:
+        shutil.rmtree(multipageDir)
+
+    # test 30 - the JSON and NDJSON reports are valid, and have the same content
+    res = diffLinksWithMarkupText(markup1, markup2 + u"<a href='#say-\"hi\"' id=caf\xe9>q</a><a href='\x01\\path&mdash;'>r</a>", mem)
+    for statsOnly in [False, True]:
+        setGlobals(getRunConfig(mem)._replace(showAllStats=not statsOnly))
+        output = StringIO()
+        writer = ReportWriter(output)
+        dumpJSONReport(res, writer)
+        writer.flush()
+        report = json.loads(output.getvalue())
+        assert report['sourceDoc']['linksTotal'] == len(res.srcAllLinks) and report['matchingLinksTotal'] == res.statTotalMatches, 'test30: the JSON report is valid'
+        setGlobals(getRunConfig(mem)._replace(showAllStats=not statsOnly, reportFormat='ndjson'))
+        output = StringIO()
+        writer = ReportWriter(output)
+        dumpJSONReport(res, writer)
+        writer.flush()
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert lines[0]['sourceDoc'] == dict((key, report['sourceDoc'][key]) for key in ['linksTotal', 'nonMatchedTotal']) and lines[0]['correctLinksTotal'] == report['correctLinksTotal'], 'test30: the first NDJSON line has the statistics'
+        if not statsOnly:
+            assert lines[1:] == [dict(link, doc='baselineDoc') for link in report['baselineDoc']['linkIndex']] + [dict(link, doc='sourceDoc') for link in report['sourceDoc']['linkIndex']], 'test30: then one NDJSON line per link'
+            assert report['sourceDoc']['linkIndex'][-2]['href'] == '#say-"hi"' and report['sourceDoc']['linkIndex'][-2]['id'] == 'caf&#233;' and report['sourceDoc']['linkIndex'][-1]['href'] == '\x01\\path&#8212;', 'test30: hrefs and ids are escaped'
+        else:
+            assert len(lines) == 1 and 'linkIndex' not in report['baselineDoc'], 'test30: no links with -statsonly'
+    setGlobals(mem)
+    output = StringIO()
+    writer = ReportWriter(output)
+    dumpJSONDocResults(0, [], 'baselineDoc', 0, False, writer)
+    writer.flush()
+    assert json.loads('{' + output.getvalue() + '}')['baselineDoc']['linkIndex'] == [], 'test30: an empty link list is valid'
+    link = LinkElement(0, '#x', 1, '')
+    link.matchRatio, link.correctRatio = 1.0 / 80000, 2.0 / 3
+    assert json.loads(str(link))['matchRatio'] == 0.0 and json.loads(str(link))['correctRatio'] == 0.667 and json.loads(getPercentText(1, 80000)) == 0.0, 'test30: small ratios are valid JSON numbers'
+
+    # test 31 - the synthetic spec generator (for -benchmark) is deterministic and follows its parameters
+    baselineMarkup, sourceMarkup = generateSyntheticSpecPair(200, seed=31)
+    assert generateSyntheticSpecPair(200, seed=31) == (baselineMarkup, sourceMarkup), 'test31: the same parameters generate the same documents'
+    doc = parseTextToDocument(baselineMarkup)
+    assert len(doc.links) == 200 and 0 < len(doc._idMap) < 100, 'test31: one link per paragraph, some of them with an id before them'
+    assert len(parseTextToDocument(sourceMarkup).links) < 200, 'test31: some paragraphs are left out of the source'
+    baselineMarkup, sourceMarkup = generateSyntheticSpecPair(200, idDensity=0.0, sharedTextRatio=1.0, seed=31)
+    assert baselineMarkup == sourceMarkup and 'href="#' not in baselineMarkup, 'test31: all text shared, and no ids to link to'
+
+    # test 32 - profiling records the phases of both processes and the use of the worker pools, without changing the results
+    mem.cpuCount = 2
+    expected = getLinkResults(diffLinksWithMarkupText(markup1, markup2, mem))
+    profileDir = tempfile.mkdtemp()
+    try:
+        mem.profilePath = os.path.join(profileDir, 'profile.json')
+        mem.baseProfile = None
+        setGlobals(mem)
+        PROFILE_PHASES.clear()
+        del PROFILE_POOLS[:]
+        res = diffLinksWithMarkupText(markup1, markup2, mem)
+        writeProfileFile(mem, mem.profilePath)
+        with open(mem.profilePath, 'rb') as file:
+            profile = json.load(file)
+    finally:
+        shutil.rmtree(profileDir)
+    baselinePhases = profile['processes']['baseline']['phases']
+    sourcePhases = profile['processes']['source']['phases']
+    assert all(phase in baselinePhases for phase in ['parse', 'index', 'match', 'resolve', 'apply', 'pre-check', 'correctness', 'wait']), 'test32: the baseline phases are profiled'
+    assert all(phase in sourcePhases for phase in ['parse', 'index', 'apply', 'pre-check', 'correctness', 'wait']), 'test32: the source phases are profiled'
+    assert all(phase['wallSeconds'] >= 0 and phase['calls'] > 0 and phase['peakMemoryGrowthKB'] >= 0 for phase in baselinePhases.values() + sourcePhases.values()), 'test32: every phase has its time, calls and memory growth'
+    pools = profile['processes']['baseline']['pools']
+    assert len(pools) == 1 and pools[0]['pool'] == 'match' and pools[0]['processes'] == 2 and 0 < pools[0]['busySeconds'] and 0 < pools[0]['utilization'] <= 1, 'test32: the matching pool use is recorded'
+    assert getLinkResults(res) == expected, 'test32: same results as without profiling'
+    PROFILE_PHASES.clear()
+    clock = [100.0] # a stubbed clock and peak memory, so that the times and memory growth are exact
+    peakMemory = [1000]
+    realTime = time.time
+    realPeakMemoryKB = globals()['getPeakMemoryKB']
+    time.time = lambda: clock[0]
+    globals()['getPeakMemoryKB'] = lambda: peakMemory[0]
+    try:
+        with ProfilePhase('outer'):
+            clock[0] += 1.0
+            peakMemory[0] += 300
+            with ProfilePhase('inner'):
+                clock[0] += 2.0
+                peakMemory[0] += 200
+            clock[0] += 0.5
+    finally:
+        time.time = realTime
+        globals()['getPeakMemoryKB'] = realPeakMemoryKB
+    assert PROFILE_PHASES['outer'][0] == 1.5 and PROFILE_PHASES['inner'][0] == 2.0 and PROFILE_PHASES['outer'][2] == PROFILE_PHASES['inner'][2] == 1, 'test32: phase times are exclusive of their nested phases'
+    assert PROFILE_PHASES['outer'][3] == 500 and PROFILE_PHASES['inner'][3] == 200, 'test32: the memory growth of a phase includes its nested phases'
+    mem.profilePath = None
+    mem.cpuCount = multiprocessing.cpu_count()
+    setGlobals(mem)
+    PROFILE_PHASES.clear()
+    with ProfilePhase('output'):
+        pass
+    assert len(PROFILE_PHASES) == 0, 'test32: nothing is recorded unless profiling'
+
+    # test 33 - a dense block of conflicts (every row matching every column) resolves like test8 describes, with
+    # the rows and cols shrinking well past the point where their removed tuples are compacted away (see ResolverLine)
+    array = [[(0.9 if (row + col) % 7 == 0 else 0.8, col, row) for col in xrange(30)] for row in xrange(30)]
+    misses = resolveMatchResultConflicts(array)
+    assert [tuple[1] for tuple in array] == [0, 6, 5, 4, 3, 2, 1, 7, 13, 12, 11, 10, 9, 8, 14, 20, 19, 18, 17, 16, 15, 21, 27, 26, 25, 24, 23, 22, 28, 29], 'test33: the best ratio first, then top-left'
+    assert all(array[row][2] == row and array[row][0] == (0.9 if (row + array[row][1]) % 7 == 0 else 0.8) for row in xrange(30)) and misses == [], 'test33: every row matched'
+    line = ResolverLine(1, [(0.5, col, 0) for col in xrange(20)] + [(0.9, 20, 0)])
+    for col in xrange(19):
+        line.remove((0.5, col, 0))
+    assert len(line) == 2 and list(line) == [(0.5, 19, 0), (0.9, 20, 0)] and len(line.tuples) < 21 and line.getBiggest() == (0.9, 20, 0), 'test33: removing tuples from a line'
+
+    # test 34 - conflicts resolved in parallel, one connected component at a time, give the same results as serially
+    rand = random.Random(34)
+    array = []
+    for row in xrange(400):
+        block = row / 20 * 20 # rows only conflict within their block of 20 (cols too), except for the few linking two blocks
+        candidates = [(rand.choice([0.8, 0.85, 0.9]), col, row) for col in xrange(block, block + 20) if rand.random() < 0.2]
+        if rand.random() < 0.02:
+            candidates.append((0.8, (block + 20) % 400, row))
+        if row % 10 == 5: # and some rows have only columns of their own
+            candidates = [(0.85, 1000 + 2 * row, row), (0.9, 1001 + 2 * row, row)]
+        array.append(candidates if len(candidates) > 0 else [(0.5, block, -1)])
+    serialArray = list(array)
+    serialMisses = resolveMatchResultConflicts(serialArray)
+    rowResults = {}
+    colResults = {}
+    bucketMatchResultRows(array, 0, len(array), rowResults, colResults)
+    components = getConflictComponents(colResults)
+    componentRows = set(sum(components, []))
+    assert 5 < len(components) < 40 and all([len(component) > 1 for component in components]) and len(componentRows) == len(sum(components, [])), 'test34: the rows split into components'
+    assert all([set([tuple[2] for tuple in colResults[tuple[1]]]) <= set(component) for component in components for row in component for tuple in rowResults[row]]), 'test34: no column is shared between components'
+    assert 0 < len(rowResults) - len(componentRows) and all([len(colResults[tuple[1]]) == 1 for row in rowResults if row not in componentRows for tuple in rowResults[row]]), 'test34: the other rows share no column'
+    assert not isWorthResolvingInParallel(colResults), 'test34: too few conflicts to resolve in parallel'
+    p = Pool(2)
+    misses = resolveConflictComponents(array, rowResults, colResults, p, taskTuples=30)
+    assert array == serialArray and misses == serialMisses, 'test34: same results and near-misses as resolving serially'
+    denseColResults = {}
+    bucketMatchResultRows([[(0.9, col, row) for col in xrange(row / 20 * 20, row / 20 * 20 + 20)] for row in xrange(RESOLVE_PARALLEL_MIN_TUPLES / 20)], 0, RESOLVE_PARALLEL_MIN_TUPLES / 20, {}, denseColResults)
+    assert isWorthResolvingInParallel(denseColResults), 'test34: enough dense conflicts to resolve in parallel'
+    array = [[(0.9, col, row) for col in xrange(5)] for row in xrange(5)] + [[(0.9, 5 + row, 5 + row)] for row in xrange(5)]
+    rowResults = {}
+    colResults = {}
+    bucketMatchResultRows(array, 0, len(array), rowResults, colResults)
+    misses = resolveConflictComponents(array, rowResults, colResults, p, taskTuples=30)
+    p.close()
+    assert array == [(0.9, row, row) for row in xrange(10)] and misses == [], 'test34: one component is resolved serially'
+
+    # test 35 - with -unmatchedratios, the unmatched source links get their best ratio against the baseline links
+    markup1 = '<p>one two three four five six seven eight nine ten <a href=#x>first</a> eleven twelve thirteen fourteen fifteen sixteen seventeen eighteen nineteen twenty</p><p id=x>more words here</p>'
+    markup2 = markup1.replace('more words here', 'apple banana cherry date one two three four five <a href=#y>second</a> kiwi lemon mango')
+    res = diffLinksWithMarkupText(markup1, markup2, mem)
+    assert res.srcAllLinks[1].matchIndex == -1 and res.srcAllLinks[1].matchRatio == 0.0, 'test35: no ratio for the unmatched link by default'
+    mem.unmatchedRatios = True
+    setGlobals(mem)
+    res = diffLinksWithMarkupText(markup1, markup2, mem)
+    mem.unmatchedRatios = False
+    setGlobals(mem)
+    assert res.srcAllLinks[1].matchIndex == -1 and res.srcAllLinks[1].matchRatio == 6 / 13.0, 'test35: 6 of the 13 words of the unmatched link are in the first link'
+    assert res.srcAllLinks[0].matchRatio == 1.0 and res.statTotalMatches == 1, 'test35: the matches are unchanged'
+    baselineDoc = parseAndIndexChunks([markup1.decode('utf-8')])
+    sourceDoc = parseAndIndexChunks([markup2.decode('utf-8')] * 3)
+    sourceDoc.links[1].matchRatio = 0.615 # a near-miss
+    sourceDoc.links[3].status = 'matched' # and the best non-match of another link
+    sourceDoc.links[3].matchRatio = 0.9
+    assert applyUnmatchedRatios(sourceDoc.links, baselineDoc.compactIndex) == 4 and all([sourceDoc.links[i].matchRatio > 0.0 for i in [0, 2, 4, 5]]), 'test35: only the links without a ratio are scored'
+    assert sourceDoc.links[1].matchRatio == 0.615 and sourceDoc.links[3].matchIndex == -1 and sourceDoc.links[3].matchRatio == 0.9, 'test35: the ratios of near-misses and of matched links are kept'
+
     print 'All tests passed'
 
+# Benchmarks (see -benchmark)
+# =====================================================
+# Each size is run in its own process, on a synthetic baseline/source pair (see generateSyntheticSpecPair) that
+# only depends on the parameters and the seed, with every phase run serially (one process) so that the timings
+# don't depend on the number of CPUs. Results are appended to a JSON file, and compared with the previous run in
+# it that had the same benchmark version and settings.
+
+BENCHMARK_VERSION = 1 # change it whenever the generated documents or what is measured change (older results aren't comparable)
+BENCHMARK_SIZES = [1000, 3000, 10000] # links per document
+BENCHMARK_PHASES = ['parse', 'index', 'match', 'resolve', 'correctness']
+# The parameters of the synthetic specs (see generateSyntheticSpecPair). They are deliberately not settable: runs
+# are only compared when they are of the same documents, so changing them is a change of BENCHMARK_VERSION.
+BENCHMARK_GENERATOR_PARAMS = {'idDensity': 0.2, 'sharedTextRatio': 0.9, 'conflictRate': 0.05, 'seed': 0}
+
+# Returns a (baseline markup, source markup) pair of synthetic specs, with linkCount paragraphs of (Zipf
+# distributed) words that each end with a link:
+# idDensity - the share of paragraphs preceded by a heading with an id (the targets of the '#id' links)
+# sharedTextRatio - the share of paragraphs that are the same in the source; the others are either reworded
+#                   (half of their words replaced) or left out of the source
+# conflictRate - the share of paragraphs that repeat an earlier paragraph's words, so that their links have
+#                more than one equally good match
+def generateSyntheticSpecPair(linkCount, idDensity = 0.2, sharedTextRatio = 0.9, conflictRate = 0.05, seed = 0):
+    rand = random.Random(seed)
+    vocabulary = ['w' + str(n) for n in xrange(4000)]
+    cumulativeWeights = []
+    totalWeight = 0.0
+    for n in xrange(len(vocabulary)):
+        totalWeight += 1.0 / (n + 1)
+        cumulativeWeights.append(totalWeight)
+    getWord = lambda: vocabulary[min(bisect_right(cumulativeWeights, rand.random() * totalWeight), len(vocabulary) - 1)]
+    baseline = []
+    source = []
+    ids = []
+    paragraphs = []
+    for n in xrange(linkCount):
+        if rand.random() < idDensity:
+            ids.append('s' + str(n))
+            heading = '<h3 id="' + ids[-1] + '">' + getWord() + ' ' + getWord() + '</h3>\n'
+            baseline.append(heading)
+            source.append(heading)
+        if len(paragraphs) > 0 and rand.random() < conflictRate:
+            words = rand.choice(paragraphs)
+        else:
+            words = [getWord() for i in xrange(rand.randint(5, 30))]
+        paragraphs.append(words)
+        if len(ids) > 0 and rand.random() < 0.7:
+            href = '#' + rand.choice(ids)
+        else:
+            href = 'http://example.org/' + str(rand.randint(0, 200))
+        link = '<a href="' + href + '">' + getWord() + '</a>'
+        baseline.append('<p>' + ' '.join(words) + ' ' + link + '</p>\n')
+        if rand.random() < sharedTextRatio:
+            source.append(baseline[-1])
+        elif rand.random() < 0.5:
+            source.append('<p>' + ' '.join([word if rand.random() < 0.5 else getWord() for word in words]) + ' ' + link + '</p>\n')
+    return (''.join(baseline), ''.join(source))
+
+def getPeakMemoryKB():
+    try:
+        import resource
+    except ImportError: # not on Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kilobytes on Linux
+
+# Process entry point
+# Runs the phases on a synthetic spec pair, and sends back their timings (seconds) and the peak memory use.
+def StartBenchmark(config, linkCount, generatorParams, comm):
+    setGlobals(config)
+    baselineMarkup, sourceMarkup = generateSyntheticSpecPair(linkCount, **generatorParams)
+    result = {'linkCount': linkCount, 'startMemoryKB': getPeakMemoryKB()}
+    result.update(generatorParams)
+    phaseStart = time.time()
+    baselineDoc = parseTextToDocument(baselineMarkup)
+    sourceDoc = parseTextToDocument(sourceMarkup)
+    result['parseSeconds'] = time.time() - phaseStart
+    phaseStart = time.time()
+    buildIndex(baselineDoc)
+    buildIndex(sourceDoc)
+    result['indexSeconds'] = time.time() - phaseStart
+    phaseStart = time.time()
+    initMatchWorker(config, Value('i', 0), None, 0, sourceDoc.compactIndex, buildIndexMatrices(sourceDoc.compactIndex) if MATCH_ENGINE == 'numpy' else None)
+    matchResults = []
+    for firstIndex in xrange(0, len(baselineDoc.links), MATCH_CHUNK_SIZE):
+        matchResults += StartBuildMatchResultChunk(([link.words for link in baselineDoc.links[firstIndex:firstIndex + MATCH_CHUNK_SIZE]], firstIndex, 0, 0))
+    result['matchSeconds'] = time.time() - phaseStart
+    phaseStart = time.time()
+    rowResults = {}
+    colResults = {}
+    over50Count = bucketMatchResultRows(matchResults, 0, len(matchResults), rowResults, colResults)
+    nearMisses = resolveMatchResultConflicts(matchResults, rowResults, colResults, over50Count)
+    result['resolveSeconds'] = time.time() - phaseStart
+    phaseStart = time.time()
+    result['matches'] = applyOwnMatchArray(matchResults, baselineDoc.links)
+    applyOtherMatchArray(matchResults, nearMisses, sourceDoc.links)
+    skippedCount, checkExternals, checkWords = preCheck4Correct(baselineDoc, True)
+    preCheck4Correct(sourceDoc)
+    result['correct'] = check4Correct(sourceDoc, checkExternals, checkWords)[0]
+    result['correctnessSeconds'] = time.time() - phaseStart
+    result['baselineLinks'] = len(baselineDoc.links)
+    result['sourceLinks'] = len(sourceDoc.links)
+    result['peakMemoryKB'] = getPeakMemoryKB()
+    comm.send(result)
+
+def getCommitId():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmarks(mem, resultsPath):
+    config = getRunConfig(mem)
+    setGlobals(config)
+    run = {'benchmarkVersion': BENCHMARK_VERSION, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': getCommitId(), 'python': platform.python_version(),
+           'platform': platform.platform(), 'matchEngine': MATCH_ENGINE, 'parser': PARSER, 'ratio': MATCH_RATIO_THRESHOLD, 'halfContextWords': HALF_WORD_COUNT, 'results': []}
+    for linkCount in BENCHMARK_SIZES:
+        print 'Benchmarking ' + str(linkCount) + ' links...'
+        forBenchmark, forResult = Pipe()
+        p = Process(target=StartBenchmark, args=(config, linkCount, BENCHMARK_GENERATOR_PARAMS, forBenchmark), name='Proc_benchmark')
+        p.start()
+        forBenchmark.close() # only the benchmark process holds it now, so recv fails (rather than waits) if it dies
+        try:
+            run['results'].append(forResult.recv())
+        except EOFError:
+            print 'The benchmark of ' + str(linkCount) + ' links failed; no results were written'
+            return
+        finally:
+            p.join()
+    runs = []
+    if os.path.isfile(resultsPath):
+        try:
+            with open(resultsPath, 'r') as file:
+                runs = json.load(file)['runs']
+        except (IOError, ValueError, KeyError):
+            print "Ignoring unreadable benchmark results file: '" + resultsPath + "'"
+    comparableKeys = ['benchmarkVersion', 'matchEngine', 'parser', 'ratio', 'halfContextWords']
+    previousRuns = [previous for previous in runs if [previous.get(key) for key in comparableKeys] == [run[key] for key in comparableKeys]]
+    dumpBenchmarkRun(run, previousRuns[-1] if len(previousRuns) > 0 else None)
+    runs.append(run)
+    try:
+        with open(resultsPath, 'w') as file:
+            json.dump({'runs': runs}, file, indent=1, sort_keys=True)
+    except IOError:
+        print "Unable to write the benchmark results file: '" + resultsPath + "'"
+
+def dumpBenchmarkRun(run, previousRun):
+    print ''
+    print 'Seconds per phase' + ('' if previousRun == None else ' (and relative to commit ' + str(previousRun['commit']) + ' of ' + previousRun['date'] + ')') + ':'
+    print '  links  ' + ''.join([phase.rjust(20) for phase in BENCHMARK_PHASES]) + '  peak memory (KB)'
+    for result in run['results']:
+        previousResults = [previous for previous in previousRun['results'] if previous['linkCount'] == result['linkCount']] if previousRun != None else []
+        columns = []
+        for phase in BENCHMARK_PHASES:
+            column = '%.3f' % result[phase + 'Seconds']
+            if len(previousResults) > 0 and previousResults[0][phase + 'Seconds'] > 0:
+                column += ' (%.2fx)' % (result[phase + 'Seconds'] / previousResults[0][phase + 'Seconds'])
+            columns.append(column.rjust(20))
+        print '  ' + str(result['linkCount']).rjust(5) + '  ' + ''.join(columns) + '  ' + str(result['peakMemoryKB'])
+
 # Input processing
 # =====================================================
 
+# Profiling (see -profile)
+# =====================================================
+# Each process adds up the time spent in each of its phases (PROFILE_PHASES) and the use of the worker pools it
+# ran (PROFILE_POOLS). Phase times are exclusive: the time spent in a phase nested inside another one (such as
+# loading, which happens while the document is being parsed) only counts towards the inner phase. The memory use
+# of a phase is how much it raised the process's peak resident set size (the most of any of its calls, including
+# its nested phases), as only the peak so far can be read. The baseline process hands its profile over in
+# mem.baseProfile, and the main (source) process writes both to the profile file.
+
+PROFILE_VERSION = 2 # change it whenever the contents of the profile file (or their meaning) change
+PROFILE_PHASES = {} # phase name <-> [wall seconds, CPU seconds, calls, peak memory growth KB]
+PROFILE_POOLS = []
+PROFILE_STACK = [] # [wall seconds, CPU seconds] spent in the nested phases of each phase in progress
+
+# Context manager timing a phase of the current process; does nothing unless profiling.
+class ProfilePhase(object):
+    def __init__(self, name):
+        self.name = name
+        self.profiled = False
+
+    def __enter__(self):
+        self.profiled = PROFILE
+        if self.profiled:
+            self.startWall = time.time()
+            self.startCPU = getCPUSeconds()
+            self.startPeakMemory = getPeakMemoryKB()
+            PROFILE_STACK.append([0.0, 0.0])
+
+    def __exit__(self, type, value, traceback):
+        if not self.profiled:
+            return
+        wall = time.time() - self.startWall
+        cpu = getCPUSeconds() - self.startCPU
+        nestedWall, nestedCPU = PROFILE_STACK.pop()
+        if len(PROFILE_STACK) > 0:
+            PROFILE_STACK[-1][0] += wall
+            PROFILE_STACK[-1][1] += cpu
+        phase = PROFILE_PHASES.setdefault(self.name, [0.0, 0.0, 0, None])
+        phase[0] += wall - nestedWall
+        phase[1] += cpu - nestedCPU
+        phase[2] += 1
+        if self.startPeakMemory != None:
+            phase[3] = max(phase[3], getPeakMemoryKB() - self.startPeakMemory)
+
+def getCPUSeconds():
+    times = os.times()
+    return times[0] + times[1] # user + system
+
+# Adds the time since startTime to a pool's busy time (a shared Value, see recordPoolUse). Called by the workers.
+def addPoolBusyTime(busy, startTime):
+    with busy.get_lock():
+        busy.value += time.time() - startTime
+
+# Records a run of tasks on a pool of processCount workers, from startTime until now. The utilization is the share
+# of the workers' time spent on tasks (rather than starting up, waiting for tasks, or waiting to hand back results).
+def recordPoolUse(name, processCount, taskCount, startTime, busy):
+    wallSeconds = time.time() - startTime
+    PROFILE_POOLS.append({'pool': name, 'processes': processCount, 'tasks': taskCount, 'wallSeconds': wallSeconds, 'busySeconds': busy.value,
+                          'utilization': busy.value / (processCount * wallSeconds) if wallSeconds > 0 else 0.0})
+
+def getProcessProfile():
+    phases = {}
+    for name, (wallSeconds, cpuSeconds, calls, peakMemoryGrowthKB) in PROFILE_PHASES.iteritems():
+        phases[name] = {'wallSeconds': wallSeconds, 'cpuSeconds': cpuSeconds, 'calls': calls, 'peakMemoryGrowthKB': peakMemoryGrowthKB}
+    return {'phases': phases, 'pools': list(PROFILE_POOLS), 'peakMemoryKB': getPeakMemoryKB()}
+
+def writeProfileFile(mem, profilePath):
+    profile = {'profileVersion': PROFILE_VERSION, 'processes': {'baseline': mem.baseProfile, 'source': getProcessProfile()}}
+    try:
+        with open(profilePath, 'wb') as file:
+            json.dump(profile, file, indent=1, sort_keys=True)
+            file.write('\n')
+    except (IOError, OSError):
+        print "Unable to write the profile file: '" + profilePath + "'"
+
 def cmdSimpleHelp():
     print "Usage:"
     print "  linkdiff [flags]  <baseline html file>  <source html file>"
@@ -1139,6 +3069,11 @@ def cmdhelp():
     print "Usage:"
     print ""
     print "  linkdiff [flags] <baseline html file> <source html file>"
+    print "  linkdiff [flags] -batch <source list file> <baseline html file> <report directory>"
+    print ""
+    print "  Either html file can also be a directory of multipage output (index.html plus a page per"
+    print "  section, as written by multipage.js), which is diffed as the single-page document it was"
+    print "  split from."
     print ""
     print "    The baseline and source files may be paths to the respective files on disk, or URLs."
     print "    The only supported protocols for URLs are 'http' and 'https'; any other protocol will"
@@ -1166,6 +3101,38 @@ def cmdhelp():
     print "      apply the strings to href values, so exact matches are required. The ignore list applies"
     print "      to both baseline and source html files"
     print ""
+    print "  -batch <source list file>"
+    print ""
+    print "    Example: linkdiff -batch branches.txt baseline.html reports"
+    print ""
+    print "      Diffs the baseline against each source listed in the file (one file path or URL per"
+    print "      line; empty lines and lines starting with # are skipped), loading, parsing and indexing"
+    print "      the baseline only once. The JSON output for each source is written to its own file in"
+    print "      the report directory (created if needed), named after its position in the list and its"
+    print "      file name."
+    print ""
+    print "  -out <report file>"
+    print ""
+    print "    Example: linkdiff -out report.json baseline.html source.html"
+    print ""
+    print "      Writes the report to the given file instead of the standard output."
+    print ""
+    print "  -format <json|ndjson>"
+    print ""
+    print "    Example: linkdiff -format ndjson baseline.html source.html"
+    print ""
+    print "      The report format. 'json' (the default) is a single JSON object. 'ndjson' writes one"
+    print "      JSON object per line: first the statistics, then each link (the same objects as in the"
+    print "      'linkIndex' lists of the JSON report, with the name of their document in 'doc')."
+    print ""
+    print "  -unmatchedratios"
+    print ""
+    print "    Example: linkdiff -unmatchedratios baseline.html source.html"
+    print ""
+    print "      Reports the best match ratio of each source document link that was not matched (its"
+    print "      'matchRatio', otherwise only known for some of them) by scoring just those links against"
+    print "      the baseline document's links. Adds little to the processing time."
+    print ""
     print "  -statsonly"
     print ""
     print "    Example: linkdiff -statsonly http://location/of/baseline ../source/doc/location.htm"
@@ -1201,6 +3168,66 @@ def cmdhelp():
     print "      improve the chances of fewer duplicate matches--however this may dramatically"
     print "      increase link matching elapsed time as a result."
     print ""
+    print "  -matchengine <loop|numpy>"
+    print ""
+    print "    Example: linkdiff -matchengine numpy baseline.html source.html"
+    print ""
+    print "      Selects the implementation used to score baseline links against the source document's"
+    print "      index. The default 'loop' engine scores one link at a time in pure Python. The 'numpy'"
+    print "      engine scores batches of links at once using sparse term-count matrices and requires"
+    print "      the numpy and scipy packages. Both engines produce identical results."
+    print ""
+    print "  -parser <htmlparser|fastscan>"
+    print ""
+    print "    Example: linkdiff -parser fastscan baseline.html source.html"
+    print ""
+    print "      Selects how the documents are scanned for links, ids and text. The default 'htmlparser'"
+    print "      passes every tag through Python's HTMLParser. The 'fastscan' parser skips over tags that"
+    print "      are not links and have no id without parsing their attributes, which is faster on large"
+    print "      documents. Both parsers produce identical results."
+    print ""
+    print "  -cache <directory>"
+    print ""
+    print "    Example: linkdiff -cache ~/.linkdiff baseline.html source.html"
+    print ""
+    print "      Keeps each parsed and indexed document in the given directory (created if needed),"
+    print "      keyed by a hash of its content and the -contextwords value. When a document with the"
+    print "      same content is diffed again, it is loaded from there instead of being parsed and"
+    print "      indexed again. Useful when diffing against the same baseline repeatedly."
+    print "      Documents fetched over HTTP are kept there too, and are only downloaded again"
+    print "      when the server reports that they changed (ETag/Last-Modified revalidation)."
+    print ""
+    print "  -incremental <state file>"
+    print ""
+    print "    Example: linkdiff -incremental nightly.state baseline.html source.html"
+    print ""
+    print "      Saves the link matching results to the given file, and (when it exists) uses the results"
+    print "      of the previous run saved there to only match baseline links against the source links"
+    print "      that changed since. The report is identical to that of a full run. When the baseline"
+    print "      document or the -ratio/-contextwords values change, all links are matched again."
+    print ""
+    print "  -profile <profile file>"
+    print ""
+    print "    Example: linkdiff -profile profile.json baseline.html source.html"
+    print ""
+    print "      Writes the wall time, CPU time and memory growth (how much it raised the process's peak"
+    print "      resident set size) of each phase (load, parse, index, cache, match, resolve, apply,"
+    print "      unmatched ratios, pre-check, correctness, output, and the time spent waiting for the"
+    print "      other process) of both the baseline and the source processes to the given JSON file,"
+    print "      together with the peak memory use of each process and the utilization of the worker"
+    print "      pools (matching, conflict resolution and correctness checking). With -batch, the"
+    print "      phases of all sources add up."
+    print ""
+    print "  -benchmark <results file>"
+    print ""
+    print "    Example: linkdiff -matchengine numpy -benchmark results.json"
+    print ""
+    print "      Times the parsing, indexing, matching, conflict resolution and correctness checking of"
+    print "      synthetic documents of a few sizes (each phase using a single process), and appends the"
+    print "      timings and peak memory use to the results file together with the current commit."
+    print "      Shows how the timings compare with the previous run in the file with the same settings."
+    print "      Takes the place of the html files, so it comes after any other flags."
+    print ""
     print "  -runtests"
     print ""
     print "    Example: linkdiff -runtests"
@@ -1215,12 +3242,48 @@ IGNORE_LIST = None
 CPU_COUNT = None
 PROCESS_ERROR = None
 HALF_WORD_COUNT = None
+MATCH_ENGINE = None
+PARSER = None
+CACHE_DIR = None
+INCREMENTAL_STATE = None # path of the state file for incremental matching
+REPORT_FORMAT = None
+PROFILE = None # true when the phases are profiled (see -profile)
+UNMATCHED_RATIOS = None # true to score the unmatched source links (see applyUnmatchedRatios)
+MATCH_PROGRESS = None # Set only in matching worker processes (see initMatchWorker)
+MATCH_BUSY = None
+MATCH_MEM = None
+MATCH_SOURCE_NUMBER = 0
+OTHER_INDEX = None
+OTHER_INDEX_MATRICES = None
+MATCH_CHUNK_SIZE = 128 # maximum number of baseline links scored together in one matching task
+CHECK_CHUNK_SIZE = 256 # number of word lists scored together in one correctness check task
+RESOLVE_PARALLEL_MIN_TUPLES = 50000 # candidate tuples in conflict needed for conflicts to be resolved in parallel (see resolveConflictComponents)
+RESOLVE_PARALLEL_MIN_ROW_TUPLES = 8 # and per row in conflict (with fewer, handing the rows to the workers costs more than it saves)
+RESOLVE_TASK_TUPLES = 4096 # minimum number of candidate tuples resolved together in one task
+CHECK_INDEX = None # Set only in correctness check worker processes (see initCheckWorker)
+CHECK_LINK_WORDS = None
+CHECK_BUSY = None
+REPORT_BUFFER_SIZE = 1 << 20 # bytes of report output collected before each write (see ReportWriter)
+REPORT_CHUNK_SIZE = 1024 # links rendered together (see dumpJSONDocResults)
+READ_CHUNK_SIZE = 65536 # bytes read (and fed to the parser) at a time when loading a document
+HTTP_CACHE_VERSION = 1 # change it whenever the format of the cached HTTP responses changes
+CACHE_VERSION = 1 # part of the cache key (see getCacheKey); change it whenever parsing or indexing produces something different
+INCREMENTAL_STATE_VERSION = 1 # change it whenever the contents of the incremental state file (or their meaning) change
 HALF_CONTEXT_MIN = 110 # Tuned using (W3C HTML spec text) -- NOT CONFIGURABLE
 
 def getSharedMemory():
     processManager = Manager()
     return processManager.Namespace()
 
+# Immutable snapshot of the configuration values held in the shared memory namespace. Reading
+# each value from the Namespace is a round-trip to the Manager process, so the snapshot is taken
+# once and passed to worker processes instead. Has the same attribute names, so setGlobals accepts
+# either one.
+RunConfig = namedtuple('RunConfig', 'showStatus showAllStats ratio error ignoreList cpuCount halfContextWords matchEngine parser cacheDir incrementalState reportFormat profilePath unmatchedRatios')
+
+def getRunConfig(mem):
+    return RunConfig(mem.showStatus, mem.showAllStats, mem.ratio, mem.error, mem.ignoreList, mem.cpuCount, mem.halfContextWords, mem.matchEngine, mem.parser, mem.cacheDir, mem.incrementalState, mem.reportFormat, mem.profilePath, mem.unmatchedRatios)
+
 def setGlobals(mem):
     global CPU_COUNT
     global IGNORE_LIST
@@ -1229,6 +3292,13 @@ def setGlobals(mem):
     global PROCESS_ERROR
     global SHOW_STATUS
     global HALF_WORD_COUNT
+    global MATCH_ENGINE
+    global PARSER
+    global CACHE_DIR
+    global INCREMENTAL_STATE
+    global REPORT_FORMAT
+    global PROFILE
+    global UNMATCHED_RATIOS
     SHOW_STATUS = mem.showStatus
     SHOW_ALL_STATUS = mem.showAllStats
     MATCH_RATIO_THRESHOLD = mem.ratio
@@ -1236,6 +3306,13 @@ def setGlobals(mem):
     IGNORE_LIST = mem.ignoreList
     CPU_COUNT = mem.cpuCount
     HALF_WORD_COUNT = mem.halfContextWords
+    MATCH_ENGINE = mem.matchEngine
+    PARSER = mem.parser
+    CACHE_DIR = mem.cacheDir
+    INCREMENTAL_STATE = mem.incrementalState
+    REPORT_FORMAT = mem.reportFormat
+    PROFILE = mem.profilePath != None
+    UNMATCHED_RATIOS = mem.unmatchedRatios
 
 def diffLinksWithFilename(baselineFilename, srcFilename, mem):
     forBaseline, forSource = Pipe()
@@ -1245,6 +3322,16 @@ def diffLinksWithFilename(baselineFilename, srcFilename, mem):
     p.join()
     return output
 
+# Diffs the baseline against each of the sources in turn; returns a generator of their results (None for a
+# source that couldn't be loaded). The baseline is loaded, parsed and indexed only once.
+def diffLinksBatchWithFilenames(baselineFilename, srcFilenames, mem):
+    forBaseline, forSource = Pipe()
+    p = Process(target=StartBaselineProcessorWithFileName, args=(baselineFilename, mem, forBaseline, len(srcFilenames)), name='Proc_baseline_w_filename')
+    p.start()
+    for srcFilename in srcFilenames:
+        yield StartSourceWithFilename(srcFilename, mem, forSource)
+    p.join()
+
 def diffLinksWithMarkupText(baselineText, sourceText, mem):
     forBaseline, forSource = Pipe()
     p = Process(target=StartBaselineProcessorWithMarkupText, args=(baselineText, mem, forBaseline), name='Proc_baseline_w_text')
@@ -1256,84 +3343,181 @@ def diffLinksWithMarkupText(baselineText, sourceText, mem):
 # Process entry points
 ## ----------------------------
 
-def StartBaselineProcessorWithFileName(baseLineFilenameToLoad, mem, comm):
+def StartBaselineProcessorWithFileName(baseLineFilenameToLoad, mem, comm, sourceCount = 1):
     setGlobals(mem)
-    baseDocText = loadDocumentText(baseLineFilenameToLoad)
-    if baseDocText == None:
+    baselineDoc = loadIndexedDocument(baseLineFilenameToLoad)
+    if baselineDoc == None:
         mem.error = True
         return
-    StartBaselineProcessorWithMarkupText(baseDocText, mem, comm)
+    StartBaselineProcessorWithDocument(baselineDoc, mem, comm, sourceCount)
 
 def StartBaselineProcessorWithMarkupText(text, mem, comm):
     setGlobals(mem)
-    baselineDoc = parseTextToDocument(text)
-    buildIndex(baselineDoc)
+    StartBaselineProcessorWithDocument(parseAndIndexChunks([text]), mem, comm)
+
+# Diffs the baseline document against sourceCount source documents, one after the other (each from its own
+# call to StartSourceWithDocument). The baseline is parsed and indexed once, and the matching pool is started
+# for the first source and kept for the others.
+def StartBaselineProcessorWithDocument(baselineDoc, mem, comm, sourceCount = 1):
     mem.baseIndexWordsTooCommonCount = baselineDoc.statsWordsTooCommonCount
     mem.baseIndexUniqueWordCount = baselineDoc.statsUniqueWordCount
-    assert comm.recv() == 'start:baseline matching', 'Expected start:baseline matching signal from other process...'
-    statusUpdate('Matching baseline document links to source document...(this may take a few minutes)')
+    mem.baseCompactIndexBytes = baselineDoc.statsCompactIndexBytes
+    if UNMATCHED_RATIOS:
+        mem.baseIndex = baselineDoc.compactIndex # for scoring the unmatched source links (see StartSourceWithDocument)
+    matchWords = [link.words for link in baselineDoc.links] # preCheck4Correct replaces them, see resetLinkResults
+    progress = Value('i', 0)
+    busy = Value('d', 0.0) if PROFILE else None
+    p = None
+    for sourceNumber in xrange(sourceCount):
+        with ProfilePhase('wait'):
+            message = comm.recv()
+        if message == 'skip:source':
+            continue
+        assert message == 'start:baseline matching', 'Expected start:baseline matching signal from other process...'
+        if sourceNumber > 0:
+            resetLinkResults(baselineDoc, matchWords)
+        statusUpdate('Matching baseline document links to source document...(this may take a few minutes)')
+        incrementalStatePath = None
+        if INCREMENTAL_STATE != None:
+            incrementalStatePath = INCREMENTAL_STATE if sourceCount == 1 else INCREMENTAL_STATE + '.' + str(sourceNumber + 1)
+        with ProfilePhase('match'):
+            p = matchBaselineLinks(baselineDoc, matchWords, mem, p, progress, busy, sourceNumber, incrementalStatePath)
+        mem.baseAllLinksLen = len(baselineDoc.links)
+        comm.send('apply:baseline matches')
+        with ProfilePhase('apply'):
+            mem.totalMatchCount = applyOwnMatchArray(mem.baselineMatches, baselineDoc.links)
+        with ProfilePhase('pre-check'):
+            mem.baseSkippedCount, mem.checkExternals, mem.checkWords = preCheck4Correct(baselineDoc, True)
+        mem.baseTargetLookups = baselineDoc.statsTargetLookups
+        mem.baseTargetCacheHits = baselineDoc.statsTargetCacheHits
+        comm.send('start:correctness check')
+        with ProfilePhase('wait'):
+            assert comm.recv() == 'apply:correctness results', 'Expected apply:correctness results signal from other process...'
+        with ProfilePhase('correctness'):
+            mem.totalCorrectCount = applyCorrectnessResults(baselineDoc, mem.externalCorrectResults, mem.wordCorrectResults)
+        if SHOW_ALL_STATUS:
+            with ProfilePhase('output'):
+                mem.baseAllLinks = packLinkResults(baselineDoc.links)
+        if PROFILE:
+            mem.baseProfile = getProcessProfile()
+        comm.send('done')
+    if p != None:
+        p.close()
+
+# Matches the baseline links (their matchWords) against the source index (mem.srcIndex), and puts the resolved
+# matches and near-misses in mem.baselineMatches and mem.nearMisses. The pool p is started if None, for the given
+# source (see initMatchWorker), with the progress and (when profiling) busy time counters. Returns the pool.
+def matchBaselineLinks(baselineDoc, matchWords, mem, p, progress, busy, sourceNumber, incrementalStatePath):
+    # The config and source index are shipped to each worker once via the initializer; tasks carry only the word list.
     srcIndex = mem.srcIndex
-    srcNonIndexed = mem.srcUnIndexed
-    srcLinksLen = mem.srcLinksLen
-    mem.progress = 0
-    p = Pool(CPU_COUNT)
+    baselineLinksLen = len(baselineDoc.links)
+    baselineMatches = None
+    if incrementalStatePath != None:
+        baselineSignature = hashlib.md5(''.join(getLinkSignatures(baselineDoc.compactIndex))).digest()
+        srcSignatures = getLinkSignatures(srcIndex)
+        previousState = loadIncrementalState(incrementalStatePath)
+        if previousState != None:
+            baselineMatches = buildIncrementalMatchResults(matchWords, baselineSignature, srcIndex, srcSignatures, previousState)
+    if baselineMatches == None:
+        baselineMatches = [None] * baselineLinksLen
+    pendingRows = [i for i in xrange(baselineLinksLen) if baselineMatches[i] == None]
+    pendingRowsLen = len(pendingRows)
+    mem.baseMatchedCount = pendingRowsLen
+    onePercent = pendingRowsLen / 100 if pendingRowsLen > 1000 else pendingRowsLen + 1
+    # Each task scores a contiguous chunk of links (a few chunks per worker at least, so the load stays balanced)
+    chunkSize = max(1, min(MATCH_CHUNK_SIZE, pendingRowsLen / (CPU_COUNT * 4)))
     inputParamsArray = []
-    onePercent = len(baselineDoc.links) / 100 if len(baselineDoc.links) > 1000 else len(baselineDoc.links) + 1
-    for ownIndex in xrange(len(baselineDoc.links)):
-        inputParamsArray.append((baselineDoc.links[ownIndex].words, srcIndex, srcNonIndexed, srcLinksLen, ownIndex, ownIndex % onePercent + 1 == onePercent, mem))
-    baselineMatches = p.map(StartBuildMatchResult, inputParamsArray) # blocking until multi-process map completes
-    p.close()
-    nearMisses = resolveMatchResultConflicts(baselineMatches)
+    n = 0
+    while n < pendingRowsLen:
+        firstIndex = pendingRows[n]
+        end = n + 1
+        while end < pendingRowsLen and end - n < chunkSize and pendingRows[end] == firstIndex + end - n:
+            end += 1
+        progressTicks = len([i for i in xrange(n, end) if i % onePercent + 1 == onePercent])
+        inputParamsArray.append((matchWords[firstIndex:firstIndex + end - n], firstIndex, progressTicks, sourceNumber))
+        n = end
+    # Stream the chunk results (in order) and bucket them for conflict resolution while the rest are still being scored
+    rawMatches = [None] * baselineLinksLen if incrementalStatePath != None else None
+    rowResults = {}
+    colResults = {}
+    nextRow, over50Count = bucketReadyMatchResultRows(baselineMatches, 0, rowResults, colResults, rawMatches)
+    if len(inputParamsArray) > 0:
+        startTime = time.time()
+        progress.value = 0
+        if busy != None:
+            busy.value = 0.0
+        if p == None:
+            srcIndexMatrices = buildIndexMatrices(srcIndex) if MATCH_ENGINE == 'numpy' else None
+            p = Pool(CPU_COUNT, initMatchWorker, (getRunConfig(mem), progress, mem, sourceNumber, srcIndex, srcIndexMatrices, busy))
+        for chunkIndex, chunkResults in enumerate(p.imap(StartBuildMatchResultChunk, inputParamsArray)):
+            firstIndex = inputParamsArray[chunkIndex][1]
+            baselineMatches[firstIndex:firstIndex + len(chunkResults)] = chunkResults
+            nextRow, chunkOver50Count = bucketReadyMatchResultRows(baselineMatches, nextRow, rowResults, colResults, rawMatches)
+            over50Count += chunkOver50Count
+        if busy != None:
+            recordPoolUse('match', CPU_COUNT, len(inputParamsArray), startTime, busy)
+    assert nextRow == baselineLinksLen, 'All baseline links must have match results'
+    if incrementalStatePath != None:
+        saveIncrementalState(incrementalStatePath, baselineSignature, srcIndex, srcSignatures, rawMatches)
+    with ProfilePhase('resolve'):
+        mem.nearMisses = resolveMatchResultConflicts(baselineMatches, rowResults, colResults, over50Count, p, busy)
     mem.baselineMatches = baselineMatches
-    mem.nearMisses = nearMisses
-    mem.baseAllLinksLen = len(baselineDoc.links)
-    comm.send('apply:baseline matches')
-    mem.totalMatchCount = applyOwnMatchArray(baselineMatches, baselineDoc.links)
-    mem.baseSkippedCount, mem.checkExternals, mem.checkWords = preCheck4Correct(baselineDoc, True)
-    comm.send('start:correctness check')
-    assert comm.recv() == 'apply:correctness results', 'Expected apply:correctness results signal from other process...'
-    mem.totalCorrectCount = applyCorrectnessResults(baselineDoc, mem.externalCorrectResults, mem.wordCorrectResults)
-    if SHOW_ALL_STATUS:
-        mem.baseAllLinks = baselineDoc.links
-    comm.send('done')
+    return p
 
 def StartSourceWithFilename(sourceFilename, mem, comm):
     setGlobals(mem)
-    sourceDocText = loadDocumentText(sourceFilename)
-    if sourceDocText == None or mem.error:
-        return
-    return StartSourceWithMarkupText(sourceDocText, mem, comm)
+    sourceDoc = loadIndexedDocument(sourceFilename, 'Parallel parsing baseline and source documents...', 'Parallel indexing baseline and source documents...')
+    return StartSourceWithDocument(sourceDoc, mem, comm)
 
 def StartSourceWithMarkupText(text, mem, comm):
     setGlobals(mem)
-    sourceDoc = parseTextToDocument(text, 'Parallel parsing baseline and source documents...')
-    buildIndex(sourceDoc, 'Parallel indexing baseline and source documents...')
+    return StartSourceWithDocument(parseAndIndexChunks([text], 'Parallel parsing baseline and source documents...', 'Parallel indexing baseline and source documents...'), mem, comm)
+
+def StartSourceWithDocument(sourceDoc, mem, comm):
     if mem.error:
         return None
-    mem.srcIndex = sourceDoc.index
-    mem.srcUnIndexed = sourceDoc.unIndexed
-    mem.srcLinksLen = len(sourceDoc.links)
+    if sourceDoc == None:
+        comm.send('skip:source') # the baseline process moves on to the next source (if any)
+        return None
+    mem.srcIndex = sourceDoc.compactIndex
     comm.send('start:baseline matching')
-    assert comm.recv() == 'apply:baseline matches', 'Expected apply:baseline matches signal from other process...'
-    totalMatchCount = applyOtherMatchArray(mem.baselineMatches, mem.nearMisses, sourceDoc.links)
-    srcSkippedTotal = preCheck4Correct(sourceDoc)[0]
-    assert comm.recv() == 'start:correctness check', 'Expected start:correctness check signal from other process...'
-    srcCorrectTotal, mem.externalCorrectResults, mem.wordCorrectResults = check4Correct(sourceDoc, mem.checkExternals, mem.checkWords)
+    with ProfilePhase('wait'):
+        assert comm.recv() == 'apply:baseline matches', 'Expected apply:baseline matches signal from other process...'
+    with ProfilePhase('apply'):
+        totalMatchCount = applyOtherMatchArray(mem.baselineMatches, mem.nearMisses, sourceDoc.links)
+    if UNMATCHED_RATIOS:
+        with ProfilePhase('unmatched ratios'):
+            applyUnmatchedRatios(sourceDoc.links, mem.baseIndex)
+    with ProfilePhase('pre-check'):
+        srcSkippedTotal = preCheck4Correct(sourceDoc)[0]
+    with ProfilePhase('wait'):
+        assert comm.recv() == 'start:correctness check', 'Expected start:correctness check signal from other process...'
+    with ProfilePhase('correctness'):
+        srcCorrectTotal, mem.externalCorrectResults, mem.wordCorrectResults = check4Correct(sourceDoc, mem.checkExternals, mem.checkWords, CPU_COUNT)
     comm.send('apply:correctness results')
     resultOb = lambda : None # a cheat to get an object with __dict__ ability.
     resultOb.srcAllLinks = sourceDoc.links if SHOW_ALL_STATUS else None
-    assert comm.recv() == 'done', 'Expected done signal from other process...'
+    with ProfilePhase('wait'):
+        assert comm.recv() == 'done', 'Expected done signal from other process...'
     assert totalMatchCount == mem.totalMatchCount, 'Total matches should be identical between both processes'
     resultOb.statBaseAllLinksLen = mem.baseAllLinksLen
     resultOb.statSrcAllLinksLen = len(sourceDoc.links)
     resultOb.statTotalMatches = mem.totalMatchCount
     resultOb.statPotentialMatches = min(mem.baseAllLinksLen, len(sourceDoc.links)) - max(mem.baseSkippedCount, srcSkippedTotal)
     resultOb.statTotalCorrect = min(mem.totalCorrectCount, srcCorrectTotal)
-    resultOb.baseAllLinks = mem.baseAllLinks if SHOW_ALL_STATUS else None
+    with ProfilePhase('output'):
+        resultOb.baseAllLinks = unpackLinkResults(mem.baseAllLinks) if SHOW_ALL_STATUS else None
     resultOb.statBaseIndexWordsTooCommonCount = mem.baseIndexWordsTooCommonCount
     resultOb.statBaseIndexUniqueWordCount = mem.baseIndexUniqueWordCount
     resultOb.statSrcIndexWordsTooCommonCount = sourceDoc.statsWordsTooCommonCount
     resultOb.statSrcIndexUniqueWordCount = sourceDoc.statsUniqueWordCount
+    resultOb.statBaseCompactIndexBytes = mem.baseCompactIndexBytes
+    resultOb.statSrcCompactIndexBytes = sourceDoc.statsCompactIndexBytes
+    resultOb.statBaseMatchedCount = mem.baseMatchedCount
+    resultOb.statBaseTargetLookups = mem.baseTargetLookups
+    resultOb.statBaseTargetCacheHits = mem.baseTargetCacheHits
+    resultOb.statSrcTargetLookups = sourceDoc.statsTargetLookups
+    resultOb.statSrcTargetCacheHits = sourceDoc.statsTargetCacheHits
     
     return resultOb
 
@@ -1367,6 +3551,63 @@ def setContextWords(halfWordCount, mem):
     mem.halfContextWords = halfWordCount
     statusUpdate('Will use ' + str(halfWordCount) + ' (x2) words for context matching')
 
+def setMatchEngine(engine, mem):
+    if engine == None:
+        return
+    if engine not in ('loop', 'numpy'):
+        print "Unknown match engine '" + engine + "'; expected 'loop' or 'numpy'"
+        return
+    if engine == 'numpy' and numpy == None:
+        print "The 'numpy' match engine requires the numpy and scipy packages; using the 'loop' engine"
+        return
+    mem.matchEngine = engine
+    statusUpdate('Using match engine: ' + engine)
+
+def setParser(parser, mem):
+    if parser == None:
+        return
+    if parser not in ('htmlparser', 'fastscan'):
+        print "Unknown parser '" + parser + "'; expected 'htmlparser' or 'fastscan'"
+        return
+    if parser == 'fastscan' and not isFastScanSupported():
+        statusUpdate("The 'fastscan' parser is not supported by this version of Python's HTMLParser; using 'htmlparser'")
+        return
+    mem.parser = parser
+    statusUpdate('Using parser: ' + parser)
+
+def setCacheDir(cacheDir, mem):
+    if cacheDir == None:
+        return
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            print "Unable to create the cache directory '" + cacheDir + "'; not using a cache"
+            return
+    mem.cacheDir = cacheDir
+    statusUpdate('Using cache directory: ' + cacheDir)
+
+def setIncrementalState(statePath, mem):
+    if statePath == None:
+        return
+    mem.incrementalState = statePath
+    statusUpdate('Using incremental matching state file: ' + statePath)
+
+def setReportFormat(reportFormat, mem):
+    if reportFormat == None:
+        return
+    if reportFormat not in ('json', 'ndjson'):
+        print "Unknown report format '" + reportFormat + "'; expected 'json' or 'ndjson'"
+        return
+    mem.reportFormat = reportFormat
+    statusUpdate('Using report format: ' + reportFormat)
+
+def setProfilePath(profilePath, mem):
+    if profilePath == None:
+        return
+    mem.profilePath = profilePath
+    statusUpdate('Writing the profile of the run to: ' + profilePath)
+
 def setIgnoreList(newListFile, mem):
     localIgnoreList = {}
     if newListFile == None:
@@ -1396,6 +3637,14 @@ def processCmdParams():
     mem.cpuCount = multiprocessing.cpu_count()
     mem.ignoreList = {}
     mem.halfContextWords = 10
+    mem.matchEngine = 'loop'
+    mem.parser = 'htmlparser'
+    mem.cacheDir = None
+    mem.incrementalState = None
+    mem.reportFormat = 'json'
+    mem.profilePath = None
+    mem.baseProfile = None
+    mem.unmatchedRatios = False
     if len(sys.argv) == 1:
         return cmdSimpleHelp()
     if '-h' in sys.argv or '-H' in sys.argv or '/h' in sys.argv or '-?' in sys.argv or '/?' in sys.argv:
@@ -1417,6 +3666,9 @@ def processCmdParams():
     if '-statsonly' in sys.argv:
         mem.showAllStats = False
         expectedArgs += 1
+    if '-unmatchedratios' in sys.argv:
+        mem.unmatchedRatios = True
+        expectedArgs += 1
     if '-ratio' in sys.argv:
         setRatio(getFlagValue('-ratio'), mem)
         expectedArgs += 2
@@ -1426,70 +3678,591 @@ def processCmdParams():
     if '-contextwords' in sys.argv:
         setContextWords(getFlagValue('-contextwords'), mem)
         expectedArgs += 2
+    if '-matchengine' in sys.argv:
+        setMatchEngine(getFlagValue('-matchengine'), mem)
+        expectedArgs += 2
+    if '-parser' in sys.argv:
+        setParser(getFlagValue('-parser'), mem)
+        expectedArgs += 2
+    if '-cache' in sys.argv:
+        setCacheDir(getFlagValue('-cache'), mem)
+        expectedArgs += 2
+    if '-incremental' in sys.argv:
+        setIncrementalState(getFlagValue('-incremental'), mem)
+        expectedArgs += 2
+    if '-format' in sys.argv:
+        setReportFormat(getFlagValue('-format'), mem)
+        expectedArgs += 2
+    if '-profile' in sys.argv:
+        setProfilePath(getFlagValue('-profile'), mem)
+        expectedArgs += 2
+    reportPath = None
+    if '-out' in sys.argv:
+        reportPath = getFlagValue('-out')
+        expectedArgs += 2
     if '-ignorelist' in sys.argv:
         setIgnoreList(getFlagValue('-ignorelist'), mem)
         expectedArgs += 2
+    srcFilenames = None
+    if '-batch' in sys.argv:
+        srcFilenames = getSourceList(getFlagValue('-batch'))
+        if srcFilenames == None:
+            return
+        expectedArgs += 2
+    if '-benchmark' in sys.argv: # like the html files, the results file comes last
+        if sys.argv.index('-benchmark') != len(sys.argv) - 2:
+            return cmdSimpleHelp()
+        return runBenchmarks(mem, sys.argv[-1])
     if len(sys.argv) < expectedArgs:
         return cmdSimpleHelp()
-    outStruct = diffLinksWithFilename(sys.argv[expectedArgs - 2], sys.argv[expectedArgs - 1], mem)
-    if outStruct != None:
-        dumpJSONResults(outStruct)
+    if srcFilenames != None:
+        writeBatchReports(sys.argv[expectedArgs - 2], srcFilenames, sys.argv[expectedArgs - 1], mem)
+    else:
+        outStruct = diffLinksWithFilename(sys.argv[expectedArgs - 2], sys.argv[expectedArgs - 1], mem)
+        if outStruct == None:
+            return
+        with ProfilePhase('output'):
+            if reportPath == None:
+                dumpJSONResults(outStruct)
+            else:
+                dumpStatistics(outStruct)
+                writeReportFile(outStruct, reportPath)
+    if PROFILE:
+        writeProfileFile(mem, mem.profilePath)
+
+def getSourceList(listFile):
+    if listFile == None:
+        return None
+    text = getTextFromLocalFile(listFile)
+    if text == None:
+        return None
+    srcFilenames = [line.strip().encode('utf-8') for line in text.splitlines() if line.strip() != '' and not line.strip().startswith('#')]
+    if len(srcFilenames) == 0:
+        print "Source list error: no sources listed in '" + listFile + "'"
+        return None
+    return srcFilenames
+
+def writeBatchReports(baselineFilename, srcFilenames, reportDir, mem):
+    if not os.path.isdir(reportDir):
+        try:
+            os.makedirs(reportDir)
+        except OSError:
+            print "Unable to create the report directory '" + reportDir + "'"
+            return
+    for sourceNumber, outStruct in enumerate(diffLinksBatchWithFilenames(baselineFilename, srcFilenames, mem)):
+        if outStruct == None:
+            print "'" + srcFilenames[sourceNumber] + "': no report (the documents could not be diffed)"
+            continue
+        reportPath = os.path.join(reportDir, getReportFileName(sourceNumber, srcFilenames[sourceNumber]))
+        with ProfilePhase('output'):
+            dumpStatistics(outStruct)
+            written = writeReportFile(outStruct, reportPath)
+        if written:
+            print "'" + srcFilenames[sourceNumber] + "': " + reportPath
+
+# e.g. '2-index.html.json' for the second source, 'http://w3c.github.io/html/index.html'
+def getReportFileName(sourceNumber, srcFilename):
+    name = re.sub(r'[^\w.-]+', '_', os.path.basename(srcFilename.strip('"').rstrip('/')))
+    return str(sourceNumber + 1) + '-' + (name if name.strip('.') != '' else 'source') + '.' + REPORT_FORMAT
+
+# Returns true if the report was written
+def writeReportFile(ob, reportPath):
+    try:
+        with open(reportPath, 'wb') as file:
+            writer = ReportWriter(file)
+            dumpJSONReport(ob, writer)
+            writer.flush()
+        return True
+    except (IOError, OSError):
+        print "Unable to write the report file: '" + reportPath + "'"
+        return False
+
+def dumpJSONResults(ob, writer = None):
+    dumpStatistics(ob)
+    statusUpdate('')
+    statusUpdate('\nJSON output:')
+    statusUpdate('')
+    if writer == None:
+        writer = ReportWriter(sys.stdout)
+    dumpJSONReport(ob, writer)
+    writer.flush()
+
+# Collects the report output, and writes it to the file in blocks of REPORT_BUFFER_SIZE bytes or so (rather
+# than line by line). Text is written as UTF-8.
+class ReportWriter(object):
+    def __init__(self, file):
+        self.file = file
+        self.parts = []
+        self.partsLength = 0
 
-def dumpJSONResults(ob):
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.parts.append(text)
+        self.partsLength += len(text)
+        if self.partsLength >= REPORT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.parts))
+        self.file.flush()
+        self.parts = []
+        self.partsLength = 0
+
+def dumpStatistics(ob):
     statusUpdate('\nIndex statistics:')
     statusUpdate('  Baseline index:')
     statusUpdate('    Total context words rejected due to being to common: ' + str(ob.statBaseIndexWordsTooCommonCount))
     statusUpdate('    Total unique words used for context matching: ' + str(ob.statBaseIndexUniqueWordCount))
+    statusUpdate('    Compact index size (bytes): ' + str(ob.statBaseCompactIndexBytes))
     statusUpdate('  Source index:')
     statusUpdate('    Total context words rejected due to being to common: ' + str(ob.statSrcIndexWordsTooCommonCount))
     statusUpdate('    Total unique words used for context matching: ' + str(ob.statSrcIndexUniqueWordCount))
-    statusUpdate('')
-    statusUpdate('\nJSON output:')
-    statusUpdate('')
-    print '{'
-    print '  "ratioThreshold": ' + str(MATCH_RATIO_THRESHOLD) + ','
-    print '  "matchingLinksTotal": ' + str(ob.statTotalMatches) + ','
-    print '  "correctLinksTotal": ' + str(ob.statTotalCorrect) + ','
-    print '  "potentialMatchingLinksSetSize": ' + str(ob.statPotentialMatches) + ','
-    if ob.statPotentialMatches == 0:
-        print '  "percentMatched": 0.000,'
-    else:
-        print '  "percentMatched": ' + str(float(ob.statTotalMatches) / float(ob.statPotentialMatches))[:5] + ','
-    if ob.statPotentialMatches == 0:
-        print '  "percentCorrect": 0.000,'
-    else:
-        print '  "percentCorrect": ' + str(float(ob.statTotalCorrect) / float(ob.statPotentialMatches))[:5] + ','
-    dumpJSONDocResults(ob.statBaseAllLinksLen, ob.baseAllLinks, 'baselineDoc', ob.statTotalMatches, False)
-    dumpJSONDocResults(ob.statSrcAllLinksLen, ob.srcAllLinks, 'sourceDoc', ob.statTotalMatches, True)
-    print '}'
-
-def dumpJSONDocResults(linksLen, links, docName, numMatchingLinks, addTrailingComma):
-    print '  "' + docName + '": {'
-    print '    "linksTotal": ' + str(linksLen) + ','
-    print '    "nonMatchedTotal": ' + str(linksLen - numMatchingLinks) + (',' if SHOW_ALL_STATUS else '')
+    statusUpdate('    Compact index size (bytes): ' + str(ob.statSrcCompactIndexBytes))
+    statusUpdate('\nMatching statistics:')
+    carriedOverText = ' (the others carried over from the previous run)' if ob.statBaseMatchedCount < ob.statBaseAllLinksLen else ''
+    statusUpdate('  Baseline links matched: ' + str(ob.statBaseMatchedCount) + ' of ' + str(ob.statBaseAllLinksLen) + carriedOverText)
+    statusUpdate('\nCorrectness check statistics:')
+    statusUpdate('  Baseline link targets: ' + getCacheHitRateText(ob.statBaseTargetLookups, ob.statBaseTargetCacheHits))
+    statusUpdate('  Source link targets: ' + getCacheHitRateText(ob.statSrcTargetLookups, ob.statSrcTargetCacheHits))
+
+def dumpJSONReport(ob, writer):
+    if REPORT_FORMAT == 'ndjson':
+        return dumpNDJSONReport(ob, writer)
+    writer.write('{\n')
+    writer.write('  "ratioThreshold": ' + str(MATCH_RATIO_THRESHOLD) + ',\n')
+    writer.write('  "matchingLinksTotal": ' + str(ob.statTotalMatches) + ',\n')
+    writer.write('  "correctLinksTotal": ' + str(ob.statTotalCorrect) + ',\n')
+    writer.write('  "potentialMatchingLinksSetSize": ' + str(ob.statPotentialMatches) + ',\n')
+    writer.write('  "percentMatched": ' + getPercentText(ob.statTotalMatches, ob.statPotentialMatches) + ',\n')
+    writer.write('  "percentCorrect": ' + getPercentText(ob.statTotalCorrect, ob.statPotentialMatches) + ',\n')
+    dumpJSONDocResults(ob.statBaseAllLinksLen, ob.baseAllLinks, 'baselineDoc', ob.statTotalMatches, True, writer)
+    dumpJSONDocResults(ob.statSrcAllLinksLen, ob.srcAllLinks, 'sourceDoc', ob.statTotalMatches, False, writer)
+    writer.write('}\n')
+
+# The same report as newline-delimited JSON: a first line with the statistics (the JSON report without the
+# "linkIndex" lists), then one line per link (the same objects as in the "linkIndex" lists, with the name of
+# their document in "doc"): the baseline document's links first, then the source document's.
+def dumpNDJSONReport(ob, writer):
+    writer.write('{"ratioThreshold":' + str(MATCH_RATIO_THRESHOLD) + ',"matchingLinksTotal":' + str(ob.statTotalMatches) + ',"correctLinksTotal":' + str(ob.statTotalCorrect) +
+                 ',"potentialMatchingLinksSetSize":' + str(ob.statPotentialMatches) + ',"percentMatched":' + getPercentText(ob.statTotalMatches, ob.statPotentialMatches) +
+                 ',"percentCorrect":' + getPercentText(ob.statTotalCorrect, ob.statPotentialMatches) +
+                 ',"baselineDoc":{"linksTotal":' + str(ob.statBaseAllLinksLen) + ',"nonMatchedTotal":' + str(ob.statBaseAllLinksLen - ob.statTotalMatches) + '}' +
+                 ',"sourceDoc":{"linksTotal":' + str(ob.statSrcAllLinksLen) + ',"nonMatchedTotal":' + str(ob.statSrcAllLinksLen - ob.statTotalMatches) + '}}\n')
     if SHOW_ALL_STATUS:
-        print '    "linkIndex": [ '
-        for link in links:
-            print '      ' + str(link) + (',' if link.index < linksLen - 1 else '')
+        for docName, links in [('baselineDoc', ob.baseAllLinks), ('sourceDoc', ob.srcAllLinks)]:
+            prefix = '{"doc":"' + docName + '",'
+            for start in xrange(0, len(links), REPORT_CHUNK_SIZE):
+                writer.write(''.join([prefix + str(link)[1:] + '\n' for link in links[start:start + REPORT_CHUNK_SIZE]]))
 
-        print '    ]'
-    print '  }' + (',' if addTrailingComma else '')
+def getPercentText(count, total):
+    if total == 0:
+        return '0.000'
+    return '%.3f' % (float(count) / float(total))
+
+def getCacheHitRateText(lookups, hits):
+    hitRate = 0.0 if lookups == 0 else float(hits) / float(lookups)
+    return str(lookups) + ' context word lookups, ' + str(hits) + ' served from cache (' + str(hitRate * 100)[:5] + '%)'
+
+def dumpJSONDocResults(linksLen, links, docName, numMatchingLinks, addTrailingComma, writer):
+    writer.write('  "' + docName + '": {\n')
+    writer.write('    "linksTotal": ' + str(linksLen) + ',\n')
+    writer.write('    "nonMatchedTotal": ' + str(linksLen - numMatchingLinks) + (',' if SHOW_ALL_STATUS else '') + '\n')
+    if SHOW_ALL_STATUS:
+        writer.write('    "linkIndex": [ \n')
+        for start in xrange(0, len(links), REPORT_CHUNK_SIZE):
+            records = ',\n      '.join([str(link) for link in links[start:start + REPORT_CHUNK_SIZE]])
+            writer.write(('      ' if start == 0 else ',\n      ') + records)
+        if len(links) > 0:
+            writer.write('\n')
+        writer.write('    ]\n')
+    writer.write('  }' + (',' if addTrailingComma else '') + '\n')
 
 def statusUpdate(text):
     if SHOW_STATUS:
         print text
 
+# For non-fatal problems: goes to stderr, so it never gets mixed into a report written to stdout
+def warningUpdate(text):
+    sys.stderr.write(text + '\n')
+
 def statusUpdateInline(text):
     if SHOW_STATUS:
         print text + "\r",
 
-def loadDocumentText(urlOrPath):
+# Loads, parses and indexes the document, or returns None if it can't be loaded. With a cache directory (see
+# -cache), the parsed and indexed document is saved there under a key made from its content, and is loaded
+# from there (skipping both parsing and indexing) the next time the same content is seen. The cache needs the
+# whole (undecoded) content up front to compute the key, so the document is then read before it is parsed.
+def loadIndexedDocument(urlOrPath, parseStatusText = None, indexStatusText = None):
+    if isMultipageDirectory(urlOrPath):
+        return loadMultipageDocument(urlOrPath, parseStatusText, indexStatusText)
+    if CACHE_DIR == None:
+        chunks = loadDocumentChunks(urlOrPath)
+        if chunks == None:
+            return None
+        return parseAndIndexChunks(chunks, parseStatusText, indexStatusText)
+    raw = loadDocumentBytes(urlOrPath)
+    if raw == None:
+        return None
+    cacheKey = getCacheKey(raw)
+    doc = loadCachedDocument(cacheKey)
+    if doc != None:
+        statusUpdate("Loaded the parsed and indexed '" + urlOrPath + "' from the cache")
+        return doc
+    doc = parseAndIndexChunks(readDocumentChunks(StringIO(raw), urlOrPath), parseStatusText, indexStatusText)
+    if doc != None:
+        saveCachedDocument(cacheKey, doc)
+    return doc
+
+# Parses and indexes the chunks, or returns None if reading them failed (the error was already reported by readDocumentChunks)
+def parseAndIndexChunks(chunks, parseStatusText = None, indexStatusText = None):
+    try:
+        doc = parseChunksToDocument(chunks, parseStatusText)
+    except IOError:
+        return None
+    with ProfilePhase('index'):
+        buildIndex(doc, indexStatusText)
+    return doc
+
+# Multipage documents
+# A directory of multipage output (see multipage.js: index.html plus a page per section, with the links to ids
+# rewritten to 'page.html#id') is diffed as the single document it was split from. The pages are parsed in
+# parallel, one per process, and joined in section order: index.html first, then the other pages in the order
+# that index.html first links to them. Links to one of the pages get back their '#id' form, so they resolve
+# through the joined id map like links within a single-page document. Of every page but index.html, only the
+# content of <main> is kept: the rest is the page template (its nav#toc entry and the p.prev_next bars above and
+# below the section), which the single-page document doesn't have.
+
+def isMultipageDirectory(urlOrPath):
+    if urlOrPath[0:1] == '"':
+        urlOrPath = urlOrPath[1:-1]
+    return os.path.isdir(urlOrPath)
+
+# Like loadIndexedDocument, for a multipage directory. With a cache directory, the key is made from the names and
+# contents of all the pages.
+def loadMultipageDocument(dirPath, parseStatusText = None, indexStatusText = None):
+    if dirPath[0:1] == '"':
+        dirPath = dirPath[1:-1]
+    names = sorted([name for name in os.listdir(dirPath) if name.endswith('.html') and os.path.isfile(os.path.join(dirPath, name))])
+    if len(names) == 0:
+        print "No pages (.html files) found in the directory: '" + dirPath + "'"
+        return None
+    paths = [os.path.join(dirPath, name) for name in names]
+    if CACHE_DIR != None:
+        digests = []
+        for name, path in zip(names, paths):
+            raw = loadDocumentBytes(path)
+            if raw == None:
+                return None
+            digests.append(name + '\0' + hashlib.sha1(raw).digest())
+        cacheKey = getCacheKey('\0'.join(digests))
+        doc = loadCachedDocument(cacheKey)
+        if doc != None:
+            statusUpdate("Loaded the parsed and indexed '" + dirPath + "' from the cache")
+            return doc
+    if parseStatusText != None:
+        statusUpdate(parseStatusText)
+    statusUpdate('Parsing the ' + str(len(names)) + " pages of '" + dirPath + "'...")
+    with ProfilePhase('parse'):
+        p = Pool(min(CPU_COUNT, len(paths)))
+        pages = p.map(StartParsePage, paths)
+        p.close()
+        if None in pages:
+            return None
+        pageIndexes = dict(izip(names, xrange(len(names))))
+        doc = joinPages([pages[pageIndexes[name]] for name in getPageOrder(names, pages)], names)
+    with ProfilePhase('index'):
+        buildIndex(doc, indexStatusText)
+    if CACHE_DIR != None:
+        saveCachedDocument(cacheKey, doc)
+    return doc
+
+# Process entry point
+# Parses the page, and returns what joinPages needs of it (as plain values, the Document itself being only
+# picklable once indexed), or None if the page can't be loaded.
+def StartParsePage(path):
+    chunks = loadDocumentChunks(path)
+    if chunks == None:
+        return None
+    try:
+        lineOffset = 0
+        if os.path.basename(path) != 'index.html':
+            chunks, lineOffset = getMainContent(u''.join(chunks))
+            chunks = [chunks]
+        doc = parseChunksToDocument(chunks)
+    except IOError:
+        return None
+    elements = [(elem.id, elem.href, elem.lineNo + lineOffset) if isinstance(elem, LinkElement) else (elem.id,) for elem in doc.elements]
+    return (doc.text, doc.textRunEnds, doc.elementOffsets, elements, doc.droppedTags)
+
+# The markup within the page's <main> element, and the number of lines before it (so that line numbers stay
+# those within the page). The whole page if it has no <main>.
+MAIN_START_TAG = re.compile(r'<main(?:\s[^>]*)?>', re.IGNORECASE)
+MAIN_END_TAG = re.compile(r'</main\s*>', re.IGNORECASE)
+
+def getMainContent(markup):
+    start = MAIN_START_TAG.search(markup)
+    if start == None:
+        return (markup, 0)
+    ends = [end.start() for end in MAIN_END_TAG.finditer(markup, start.end())]
+    content = markup[start.end():ends[-1] if len(ends) > 0 else len(markup)]
+    return (content, markup.count(u'\n', 0, start.end()))
+
+# index.html first, then the other pages in the order index.html first links to them, then any others (by name)
+def getPageOrder(names, pages):
+    order = []
+    if 'index.html' in names:
+        order.append('index.html')
+        for elementState in pages[names.index('index.html')][3]:
+            if len(elementState) == 3:
+                name = getLocalPageName(elementState[1], names)
+                if name != None and name not in order:
+                    order.append(name)
+    return order + [name for name in names if name not in order]
+
+# The name of the page the href refers to, if it is one of the names (else None)
+def getLocalPageName(href, names):
+    name = href.split('#', 1)[0]
+    if name[:2] == './':
+        name = name[2:]
+    return name if name in names else None
+
+# Joins the pages (see StartParsePage) into one Document, in the given order. A newline is put between pages
+# if needed, so that the words at the end of one page and the start of the next are kept apart.
+def joinPages(pages, names):
+    doc = Document()
+    textParts = []
+    textLength = 0
+    for text, textRunEnds, elementOffsets, elementStates, droppedTags in pages:
+        if textLength > 0 and not textParts[-1][-1:].isspace():
+            textParts.append(u'\n')
+            textLength += 1
+            doc.textRunEnds.append(textLength)
+        for elementIndex, elementState in enumerate(elementStates):
+            if len(elementState) == 3:
+                elemId, href, lineNo = elementState
+                if '#' in href and getLocalPageName(href, names) != None:
+                    href = href[href.index('#'):]
+                elem = LinkElement(len(doc.links), href, lineNo, elemId)
+                doc.links.append(elem)
+            else:
+                elem = Element(elementState[0])
+            elem.textOffset = elementOffsets[elementIndex] + textLength
+            elem._doc = doc
+            elem._elementIndex = len(doc.elements)
+            doc.elements.append(elem)
+            doc.elementOffsets.append(elem.textOffset)
+            if (not isinstance(elem, LinkElement) or elem.id != "") and elem.id not in doc._idMap: # as the parser does
+                doc._idMap[elem.id] = elem
+        textParts.append(text)
+        doc.textRunEnds.extend([end + textLength for end in textRunEnds])
+        doc.droppedTags += droppedTags
+        textLength += len(text)
+    doc.text = u''.join(textParts)
+    tokenizeDocument(doc)
+    return doc
+
+# The document's cache file name: its content hash, plus everything else that changes the parsed and indexed result
+def getCacheKey(raw):
+    return hashlib.sha1(raw).hexdigest() + '-' + str(HALF_WORD_COUNT) + '-' + str(CACHE_VERSION)
+
+def getCachePath(cacheKey):
+    return os.path.join(CACHE_DIR, cacheKey + '.ldcache')
+
+def loadCachedDocument(cacheKey):
+    with ProfilePhase('cache'):
+        return loadPickleFile(getCachePath(cacheKey))
+
+def saveCachedDocument(cacheKey, doc):
+    with ProfilePhase('cache'):
+        savePickleFile(getCachePath(cacheKey), doc)
+
+# Returns the unpickled content of the file, or None if it doesn't exist or can't be read (a damaged file is
+# treated as missing, and gets overwritten).
+def loadPickleFile(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as file:
+            return cPickle.load(file)
+    except Exception:
+        warningUpdate("Ignoring unreadable file: '" + path + "'")
+        return None
+
+def savePickleFile(path, value):
+    tempPath = path + '.' + str(os.getpid()) + '.tmp' # written aside and renamed into place, so readers never see a partial file
+    try:
+        with open(tempPath, 'wb') as file:
+            cPickle.dump(value, file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tempPath, path)
+    except (IOError, OSError):
+        warningUpdate("Unable to write file: '" + path + "'")
+
+# Returns the open file or network stream of the document, or None (after saying why) if it can't be opened.
+def openDocumentStream(urlOrPath):
     if urlOrPath[0:1] == '"':
         urlOrPath = urlOrPath[1:-1]
     if urlOrPath[:7] == "http://" or urlOrPath[:8] == "https://":
-        return loadURL(urlOrPath)
-    else: #assume file path...
-        return getTextFromLocalFile(urlOrPath) # may return None
+        if SHOW_STATUS:
+            print "Getting '" + urlOrPath + "' from the network..."
+        return openURLStream(urlOrPath)
+    #assume file path...
+    normalizedfileString = os.path.abspath(urlOrPath)
+    if not os.path.isfile(normalizedfileString):
+        print "File not found: '" + urlOrPath + "' is not a file (or was not found)"
+        return None
+    return open(urlOrPath, 'rb')
+
+# HTTP fetching
+# Documents are requested gzip-compressed, and decompressed as they stream in. With a cache directory (see -cache),
+# each response is also saved there (its validators, followed by the decompressed body), and the next request for
+# the same URL is made conditional on them: if the server answers 304 Not Modified, the saved body is used.
+
+def getHTTPCachePath(url):
+    return os.path.join(CACHE_DIR, hashlib.sha1(url).hexdigest() + '.http')
+
+# Returns the saved response for the URL, as a tuple of its header (a dict) and the file positioned at its body,
+# or None if there isn't one (or it can't be read).
+def openCachedHTTPResponse(url):
+    path = getHTTPCachePath(url)
+    if not os.path.isfile(path):
+        return None
+    file = open(path, 'rb')
+    try:
+        header = cPickle.load(file)
+        if header['version'] == HTTP_CACHE_VERSION and header['url'] == url:
+            return (header, file)
+    except Exception:
+        warningUpdate("Ignoring unreadable file: '" + path + "'")
+    file.close()
+    return None
+
+# Returns a stream (see HTTPDocumentStream) of the document at the URL, or None if it can't be fetched.
+def openURLStream(url):
+    cached = openCachedHTTPResponse(url) if CACHE_DIR != None else None
+    request = urllib2.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if cached != None:
+        if cached[0]['etag'] != None:
+            request.add_header('If-None-Match', cached[0]['etag'])
+        if cached[0]['lastModified'] != None:
+            request.add_header('If-Modified-Since', cached[0]['lastModified'])
+    response = None
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code == 304 and cached != None:
+            statusUpdate("'" + url + "' was not modified; using the cached copy")
+            return HTTPDocumentStream(url, cached[1], None, True)
+        print 'Error opening network location: ' + url + ' (HTTP status ' + str(e.code) + ')'
+    except (IOError, httplib.HTTPException):
+        print 'Error opening network location: ' + url
+    if cached != None:
+        cached[1].close()
+    if response == None:
+        return None
+    return HTTPDocumentStream(url, response, getHTTPCachePath(url) if CACHE_DIR != None else None, False)
+
+# A file-like (read and close) stream of a document fetched over HTTP, or of its cached copy (fromCache). It
+# decompresses the body if it was gzip-compressed and, given a cache path, saves the response there once it has
+# been read completely.
+class HTTPDocumentStream(object):
+    def __init__(self, url, response, cachePath, fromCache):
+        self.url = url
+        self.response = response
+        self.fromCache = fromCache
+        self.transferredLength = 0 # body bytes received from the network (compressed, if it was)
+        self.contentLength = 0 # body bytes after decompression
+        self.buffer = ''
+        self.done = False
+        self.decompressor = None
+        self.cacheFile = None
+        if fromCache:
+            return
+        headers = response.info()
+        if (headers.getheader('Content-Encoding') or '').strip().lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) # 16: expect a gzip header and trailer
+        self.expectedLength = headers.getheader('Content-Length')
+        if cachePath != None:
+            header = {'version': HTTP_CACHE_VERSION, 'url': url, 'etag': headers.getheader('ETag'), 'lastModified': headers.getheader('Last-Modified')}
+            if header['etag'] != None or header['lastModified'] != None: # nothing to revalidate with otherwise
+                self.cachePath = cachePath
+                self.cacheTempPath = cachePath + '.' + str(os.getpid()) + '.tmp'
+                try:
+                    self.cacheFile = open(self.cacheTempPath, 'wb')
+                    cPickle.dump(header, self.cacheFile, cPickle.HIGHEST_PROTOCOL)
+                except (IOError, OSError):
+                    warningUpdate("Unable to write file: '" + cachePath + "'")
+                    self.cacheFile = None
+
+    def read(self, size = -1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            raw = self.response.read(READ_CHUNK_SIZE if size < 0 else size)
+            if raw == '':
+                self.done = True
+                data = self.decompressor.flush() if self.decompressor != None else ''
+            elif self.fromCache:
+                data = raw
+            else:
+                self.transferredLength += len(raw)
+                data = self.decompressor.decompress(raw) if self.decompressor != None else raw
+            self.contentLength += len(data)
+            self.buffer += data
+            if self.cacheFile != None:
+                self.cacheFile.write(data)
+            if self.done:
+                self.finish()
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def finish(self):
+        if self.fromCache:
+            statusUpdate("Read '" + self.url + "' from the cache: " + str(self.contentLength) + ' bytes (0 bytes transferred)')
+            return
+        if self.expectedLength != None and str(self.transferredLength) != self.expectedLength.strip():
+            raise IOError('Incomplete response: ' + str(self.transferredLength) + ' of ' + self.expectedLength.strip() + ' bytes received')
+        compressionText = ' (gzip)' if self.decompressor != None else ''
+        statusUpdate("Fetched '" + self.url + "': " + str(self.transferredLength) + ' bytes transferred' + compressionText + ', ' + str(self.contentLength) + ' bytes of content')
+        if self.cacheFile != None:
+            try:
+                self.cacheFile.close()
+                os.rename(self.cacheTempPath, self.cachePath)
+            except (IOError, OSError):
+                warningUpdate("Unable to write file: '" + self.cachePath + "'")
+            self.cacheFile = None
+
+    def close(self):
+        self.response.close()
+        if self.cacheFile != None: # the response wasn't read completely, so it isn't cached
+            self.cacheFile.close()
+            os.remove(self.cacheTempPath)
+            self.cacheFile = None
+
+# Returns a generator of the document's text (see readDocumentChunks), or None if it can't be opened.
+def loadDocumentChunks(urlOrPath):
+    with ProfilePhase('load'):
+        stream = openDocumentStream(urlOrPath)
+    if stream == None:
+        return None
+    return readDocumentChunks(stream, urlOrPath)
+
+# Returns the document's raw (undecoded) content, or None if it can't be loaded.
+def loadDocumentBytes(urlOrPath):
+    with ProfilePhase('load'):
+        stream = openDocumentStream(urlOrPath)
+    if stream == None:
+        return None
+    try:
+        with ProfilePhase('load'):
+            return stream.read()
+    except IOError:
+        print 'Error reading: ' + urlOrPath
+        return None
+    finally:
+        stream.close()
 
 def getTextFromLocalFile(fileString):
     if fileString[0:1] == '"':
@@ -1501,25 +4274,44 @@ def getTextFromLocalFile(fileString):
     with open(fileString, 'r') as file:
         return toUnicode(file.read())
 
-def loadURL(url):
+# Generator of the stream's text, read and decoded incrementally in chunks of (at most) chunkSize bytes so
+# that the raw bytes are never held all at once. The encoding is sniffed from the BOM (if any) like toUnicode
+# does, and the results are identical to it. Closes the stream when done; read errors are reported and re-raised.
+def readDocumentChunks(stream, name, chunkSize = READ_CHUNK_SIZE):
     try:
-        if SHOW_STATUS:
-            print "Getting '" + url + "' from the network..."
-        urlhandle = urllib.urlopen(url)
-        contents = toUnicode(urlhandle.read())
-        urlhandle.close()
-        return contents
+        raw = ''
+        while len(raw) < len(codecs.BOM_UTF8): # enough to sniff any of the BOMs
+            with ProfilePhase('load'):
+                data = stream.read(chunkSize)
+            if data == '':
+                break
+            raw += data
+        decoder = codecs.getincrementaldecoder(getEncoding(raw))('replace')
+        while raw != '':
+            text = decoder.decode(raw)
+            if text != u'':
+                yield text
+            with ProfilePhase('load'):
+                raw = stream.read(chunkSize)
+        text = decoder.decode('', True)
+        if text != u'':
+            yield text
     except IOError:
-        print 'Error opening network location: ' + url
-        return None
+        print 'Error reading: ' + name
+        raise
+    finally:
+        stream.close()
 
-def toUnicode(raw):
+def getEncoding(raw):
     if raw.startswith(codecs.BOM_UTF16_LE) or raw.startswith(codecs.BOM_UTF16_BE):
-        return raw.decode("utf-16", "replace")
+        return "utf-16"
     elif raw.startswith(codecs.BOM_UTF8):
-        return raw.decode("utf-8-sig", "replace") #decoding errors substitute the replacement character
+        return "utf-8-sig"
     else:
-        return raw.decode("utf-8", "replace") # assume it.
+        return "utf-8" # assume it.
+
+def toUnicode(raw):
+    return raw.decode(getEncoding(raw), "replace") #decoding errors substitute the replacement character
 
 def isPython64bit():
     return platform.architecture()[0] == '64bit'